@@ -1,11 +1,31 @@
 import json
+from datetime import datetime, timedelta
+from functools import update_wrapper
 
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.db.models import BooleanField, Count, DateTimeField, ExpressionWrapper, Q
+from django.http import Http404, HttpResponse, JsonResponse, QueryDict
 from django.template.defaultfilters import linebreaksbr
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.utils.html import format_html
 from django.utils.translation import gettext as _
+from django.views.decorators.clickjacking import xframe_options_sameorigin
 
+from .conf import settings
 from .models import Attachment, Email, Log
+from .pagination import EstimatedCountPaginator
+from .search import search_emails
+
+CURSOR_VAR = "before"
+LOGS_CURSOR_VAR = "logs_after"
+
+# Logged emails never change, so their parts can be cached for a day
+CACHE_MAX_AGE = 24 * 60 * 60
 
 
 class LogInline(admin.StackedInline):
@@ -50,6 +70,73 @@ class LogInline(admin.StackedInline):
         ),
     )
     extra = 0
+    # Logs shown per page
+    per_page = 50
+    template = "admin/email_log/email/log_inline.html"
+
+    def get_fieldsets(self, request, obj=None):
+        if not settings.EMAIL_LOG_ADMIN_LAZY:
+            return super().get_fieldsets(request, obj)
+        return [
+            (name, {**options, "fields": self.lazy_fields(options["fields"])})
+            for name, options in self.fieldsets
+        ]
+
+    def get_readonly_fields(self, request, obj=None):
+        if not settings.EMAIL_LOG_ADMIN_LAZY:
+            return super().get_readonly_fields(request, obj)
+        return self.lazy_fields(self.readonly_fields)
+
+    def lazy_fields(self, fields):
+        return [("raw_link" if field == "raw" else field) for field in fields]
+
+    def get_queryset(self, request):
+        """Return one page of the email's logs, without their heavy columns.
+
+        Pages follow each other by ``(timestamp, id)``, read from the
+        ``(email, timestamp)`` index.  The number of logs of each type is
+        counted with one ``GROUP BY`` for the summary shown above them.
+
+        """
+        queryset = super().get_queryset(request)
+        object_id = request.resolver_match.kwargs.get("object_id")
+        logs = queryset.filter(email_id=object_id)
+        self.type_counts = list(
+            logs.order_by("type").values_list("type").annotate(Count("pk"))
+        )
+        self.cursor = request.GET.get(LOGS_CURSOR_VAR)
+        page = logs.order_by("timestamp", "pk")
+        after = self.parse_cursor(self.cursor)
+        if after is not None:
+            timestamp, pk = after
+            page = page.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+            )
+        rows = list(page.values_list("pk", "timestamp")[: self.per_page + 1])
+        self.next_cursor = None
+        if len(rows) > self.per_page:
+            pk, timestamp = rows[self.per_page - 1]
+            self.next_cursor = f"{timestamp.isoformat()},{pk}"
+        deferred = ["metadata"]
+        if settings.EMAIL_LOG_ADMIN_LAZY:
+            deferred.append("raw")
+        return queryset.filter(
+            pk__in=[pk for pk, timestamp in rows[: self.per_page]]
+        ).defer(*deferred)
+
+    def parse_cursor(self, cursor):
+        """Return the timestamp and id of a cursor, or None to start over."""
+        try:
+            timestamp, pk = cursor.rsplit(",", 1)
+            return datetime.fromisoformat(timestamp), int(pk)
+        except (AttributeError, ValueError):
+            return None
+
+    def raw_link(self, obj):
+        url = reverse("admin:email_log_email_log_raw", args=[obj.email_id, obj.pk])
+        return format_html('<a href="{}">{}</a>', url, _("Show raw event"))
+
+    raw_link.short_description = "raw"
 
     def has_add_permission(self, request, obj):
         return False
@@ -95,9 +182,132 @@ class AttachmentInline(admin.StackedInline):
         return False
 
 
+class RecentDateFieldListFilter(admin.DateFieldListFilter):
+    """Date filter showing the last ``EMAIL_LOG_ADMIN_DATE_WINDOW`` days by default
+
+    "Any date" becomes an explicit choice, so the first page of a large table
+    only reads recent rows.
+
+    """
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        super().__init__(field, request, params, model, model_admin, field_path)
+        self.window = settings.EMAIL_LOG_ADMIN_DATE_WINDOW
+        if self.window is None:
+            return
+        # Django 4.2 stores the link values as strings, so the dates are
+        # computed again the same way DateFieldListFilter does.
+        now = timezone.now()
+        if timezone.is_aware(now):
+            now = timezone.localtime(now)
+        if isinstance(field, DateTimeField):
+            today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        else:
+            today = now.date()
+        tomorrow = today + timedelta(days=1)
+        self.since = today - timedelta(days=self.window)
+        self.links = (
+            (_("Past %(days)s days") % {"days": self.window}, {}),
+            (self.links[0][0], {self.lookup_kwarg_until: str(tomorrow)}),
+        ) + self.links[1:]
+
+    def queryset(self, request, queryset):
+        if self.window is not None and not self.date_params:
+            return queryset.filter(**{self.lookup_kwarg_since: self.since})
+        return super().queryset(request, queryset)
+
+
+class RecipientListFilter(admin.SimpleListFilter):
+    """Filter emails by an address they were sent to, typed into a search box"""
+
+    title = _("recipient address")
+    parameter_name = "recipient"
+    template = "admin/email_log/email/recipient_filter.html"
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def choices(self, changelist):
+        query_string = changelist.get_query_string(remove=[self.parameter_name])
+        yield {
+            "selected": self.value() is None,
+            "query_string": query_string,
+            "display": _("All"),
+            "parameter_name": self.parameter_name,
+            "value": self.value() or "",
+            "hidden_params": [
+                (name, value)
+                for name, values in QueryDict(query_string[1:]).lists()
+                for value in values
+            ],
+        }
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.sent_to(self.value())
+        return queryset
+
+
+class KeysetChangeList(ChangeList):
+    """Change list paging through emails by date sent and id
+
+    Each page is read from an index range instead of counting rows and
+    skipping the ones on earlier pages.  Pages only link to the next one.
+
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = request.GET.get(CURSOR_VAR)
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Links to other filters or searches start at the newest email again
+        return super().get_query_string(new_params, [CURSOR_VAR, *(remove or [])])
+
+    def get_results(self, request):
+        queryset = self.queryset.order_by("-date_sent", "-pk")
+        if self.cursor:
+            date_sent, pk = self.parse_cursor(self.cursor)
+            queryset = queryset.filter(
+                Q(date_sent__lt=date_sent) | Q(date_sent=date_sent, pk__lt=pk)
+            )
+        results = list(queryset[: self.list_per_page + 1])
+        self.result_list = results[: self.list_per_page]
+        self.next_page_url = None
+        if len(results) > self.list_per_page:
+            last = self.result_list[-1]
+            cursor = f"{last.date_sent.isoformat()},{last.pk}"
+            self.next_page_url = self.get_query_string({CURSOR_VAR: cursor})
+        self.first_page_url = self.get_query_string() if self.cursor else None
+        self.result_count = len(self.result_list)
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = False
+        self.paginator = None
+
+    def parse_cursor(self, cursor):
+        try:
+            date_sent, pk = cursor.rsplit(",", 1)
+            return datetime.fromisoformat(date_sent), int(pk)
+        except ValueError:
+            raise IncorrectLookupParameters(f"Invalid cursor: {cursor}")
+
+
 class EmailAdmin(admin.ModelAdmin):
     list_display = ["recipients", "from_email", "subject", "date_sent", "ok"]
-    list_filter = ["date_sent", "ok"]
+    list_filter = [("date_sent", RecentDateFieldListFilter), "ok"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     readonly_fields = [
         "from_email",
         "recipients",
@@ -107,7 +317,7 @@ class EmailAdmin(admin.ModelAdmin):
         "headers",
         "subject",
         "body_formatted",
-        "html_message",
+        "html_message_source",
         "html_message_preview",
         "date_sent",
         "ok",
@@ -148,11 +358,109 @@ class EmailAdmin(admin.ModelAdmin):
             "Plain HTML message",
             {
                 "classes": ("collapse",),
-                "fields": ("html_message",),
+                "fields": ("html_message_source",),
             },
         ),
     ]
 
+    def get_urls(self):
+        def wrap(view):
+            def wrapper(*args, **kwargs):
+                return self.admin_site.admin_view(view, cacheable=True)(*args, **kwargs)
+
+            return update_wrapper(wrapper, view)
+
+        return [
+            path(
+                "<path:object_id>/html/",
+                wrap(self.html_message_view),
+                name="email_log_email_html",
+            ),
+            path(
+                "<path:object_id>/html/source/",
+                wrap(self.html_message_source_view),
+                name="email_log_email_html_source",
+            ),
+            path(
+                "<path:object_id>/logs/<int:log_id>/raw/",
+                wrap(self.log_raw_view),
+                name="email_log_email_log_raw",
+            ),
+        ] + super().get_urls()
+
+    def get_viewable_object(self, request, object_id):
+        email = self.get_object(request, object_id)
+        if email is None:
+            raise Http404(_("Email not found"))
+        if not self.has_view_permission(request, email):
+            raise PermissionDenied
+        return email
+
+    def cacheable(self, response):
+        patch_cache_control(response, private=True, max_age=CACHE_MAX_AGE)
+        return response
+
+    @xframe_options_sameorigin
+    def html_message_view(self, request, object_id):
+        """Serve the HTML message for the preview iframe."""
+        email = self.get_viewable_object(request, object_id)
+        response = HttpResponse(email.get_html_message())
+        # Scripts in the message must not run with the admin's origin
+        response["Content-Security-Policy"] = "sandbox"
+        return self.cacheable(response)
+
+    def html_message_source_view(self, request, object_id):
+        email = self.get_viewable_object(request, object_id)
+        response = HttpResponse(
+            email.get_html_message(), content_type="text/plain; charset=utf-8"
+        )
+        return self.cacheable(response)
+
+    def log_raw_view(self, request, object_id, log_id):
+        email = self.get_viewable_object(request, object_id)
+        try:
+            raw = email.logs.values_list("raw", flat=True).get(pk=log_id)
+        except Log.DoesNotExist:
+            raise Http404(_("Log not found"))
+        return self.cacheable(JsonResponse(raw, safe=False))
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if not settings.EMAIL_LOG_ADMIN_LAZY:
+            return queryset
+        has_html_message = ~Q(html_message="") | Q(
+            html_message_compressed__isnull=False
+        )
+        return queryset.defer("html_message", "html_message_compressed").annotate(
+            has_html_message=ExpressionWrapper(
+                has_html_message | Q(html_message_content__isnull=False),
+                output_field=BooleanField(),
+            )
+        )
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if settings.EMAIL_LOG_RECIPIENTS:
+            return [*list_filter, RecipientListFilter]
+        return list_filter
+
+    def get_changelist(self, request, **kwargs):
+        if settings.EMAIL_LOG_ADMIN_KEYSET_PAGINATION:
+            return KeysetChangeList
+        return super().get_changelist(request, **kwargs)
+
+    def get_search_results(self, request, queryset, search_term):
+        emails = search_emails(queryset, search_term)
+        if emails is not None:
+            return emails, False
+        return super().get_search_results(request, queryset, search_term)
+
+    def get_sortable_by(self, request):
+        # Keyset pages are always ordered by date sent
+        if settings.EMAIL_LOG_ADMIN_KEYSET_PAGINATION:
+            return ()
+        return super().get_sortable_by(request)
+
     def has_delete_permission(self, request, *args, **kwargs):
         return request.user.is_superuser
 
@@ -164,11 +472,29 @@ class EmailAdmin(admin.ModelAdmin):
 
     headers.short_description = "Extra headers"
 
+    def html_message_source(self, obj):
+        if settings.EMAIL_LOG_ADMIN_LAZY:
+            if not obj.has_html_message:
+                return ""
+            url = reverse("admin:email_log_email_html_source", args=[obj.pk])
+            return format_html('<a href="{}">{}</a>', url, _("Show HTML source"))
+        return obj.get_html_message()
+
+    html_message_source.short_description = "HTML message"
+
     def html_message_preview(self, obj):
-        if obj.html_message:
+        if settings.EMAIL_LOG_ADMIN_LAZY:
+            if not obj.has_html_message:
+                return "No HTML content"
+            return format_html(
+                '<iframe style="border: 1px solid #e8e8e8; max-width: 800px; max-height: 600px" sandbox loading="lazy" src="{}"></iframe>',  # noqa: ignore E501
+                reverse("admin:email_log_email_html", args=[obj.pk]),
+            )
+        html_message = obj.get_html_message()
+        if html_message:
             return format_html(
                 '<iframe style="border: 1px solid #e8e8e8; max-width: 800px; max-height: 600px" srcdoc="{}"></iframe>',  # noqa: ignore E501
-                obj.html_message,
+                html_message,
             )
         else:
             return "No HTML content"
@@ -176,7 +502,7 @@ class EmailAdmin(admin.ModelAdmin):
     html_message_preview.short_description = "HTML message"
 
     def body_formatted(self, obj):
-        return linebreaksbr(obj.body)
+        return linebreaksbr(obj.get_body())
 
     body_formatted.short_description = "body"
 
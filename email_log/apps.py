@@ -10,6 +10,12 @@ class EmailLogConfig(AppConfig):
     default_auto_field = "django.db.models.AutoField"
 
     def ready(self):
+        from django.db.models.signals import post_delete
+        from .models import Attachment
+        from .signal_handlers import delete_unreferenced_attachment_file
+
+        post_delete.connect(delete_unreferenced_attachment_file, sender=Attachment)
+
         if "anymail" in django_settings.INSTALLED_APPS:
             from anymail.signals import post_send, tracking
             from .signal_handlers import handle_tracking_event, log_successful_email
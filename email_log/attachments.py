@@ -0,0 +1,122 @@
+import base64
+import hashlib
+import io
+from functools import partial
+from email.mime.base import MIMEBase
+
+from django.core.files.base import ContentFile, File
+
+CHUNK_SIZE = File.DEFAULT_CHUNK_SIZE
+
+
+class ChunkReader(io.RawIOBase):
+    """Read-only file object over the byte strings returned by ``chunks()``
+
+    Seeking back to the start calls ``chunks()`` again, so the content can be
+    read more than once without keeping it in memory.
+
+    """
+
+    def __init__(self, chunks):
+        self._chunks_factory = chunks
+        self.seek(0)
+
+    def readable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek to the start")
+        self._chunks = iter(self._chunks_factory())
+        self._pending = memoryview(b"")
+        return 0
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def chunked_file(chunks, size: int, name: str = None) -> File:
+    """Return a File streaming the byte strings returned by ``chunks()``."""
+    file = File(ChunkReader(chunks), name=name)
+    file.size = size
+    return file
+
+
+def file_digest(file: File) -> str:
+    """Return the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_text(text: str, chunk_size: int = CHUNK_SIZE):
+    """Yield the UTF-8 encoding of ``text`` in chunks."""
+    for start in range(0, len(text), chunk_size):
+        end = start + chunk_size
+        yield text[start:end].encode()
+
+
+def decode_base64(payload: str, chunk_size: int = CHUNK_SIZE):
+    """Yield the decoded bytes of a base64 ``payload`` in chunks."""
+    leftover = ""
+    for start in range(0, len(payload), chunk_size):
+        end = start + chunk_size
+        # Line breaks mean slices of the payload aren't aligned to the four
+        # character groups base64 decodes, so carry any partial group over.
+        data = leftover + "".join(payload[start:end].split())
+        aligned = len(data) - len(data) % 4
+        leftover = data[aligned:]
+        if aligned:
+            yield base64.b64decode(data[:aligned])
+    if len(leftover) > 1:
+        yield base64.b64decode(leftover + "=" * (-len(leftover) % 4))
+
+
+def base64_size(payload: str) -> int:
+    """Return the number of bytes a base64 ``payload`` decodes to."""
+    whitespace = sum(payload.count(character) for character in " \t\r\n")
+    encoded = len(payload) - whitespace
+    tail = payload[-8:].rstrip()
+    padding = len(tail) - len(tail.rstrip("="))
+    return encoded * 3 // 4 - padding
+
+
+def text_file(text: str, name: str = None) -> File:
+    """Return a File streaming the UTF-8 encoding of ``text``."""
+    if text.isascii():
+        size = len(text)
+    else:
+        size = sum(len(chunk) for chunk in encode_text(text))
+    return chunked_file(partial(encode_text, text), size, name=name)
+
+
+def content_file(content, name: str = None) -> File:
+    """Return a File for ``str`` or ``bytes`` attachment content."""
+    if isinstance(content, str):
+        return text_file(content, name=name)
+    # BytesIO shares the buffer of the bytes it wraps, so this doesn't copy
+    return ContentFile(content, name=name)
+
+
+def mime_file(attachment: MIMEBase) -> File:
+    """Return a File for the decoded payload of a MIME attachment."""
+    name = attachment.get_filename()
+    if attachment.is_multipart():
+        return ContentFile(attachment.as_bytes(), name=name)
+    encoding = attachment.get("Content-Transfer-Encoding", "").strip().lower()
+    # get_payload() encodes the whole payload once just to look for surrogate
+    # escapes, so read the (always str) payload directly.
+    payload = attachment._payload
+    if encoding == "base64" and isinstance(payload, str):
+        chunks = partial(decode_base64, payload)
+        return chunked_file(chunks, base64_size(payload), name=name)
+    return ContentFile(attachment.get_payload(decode=True), name=name)
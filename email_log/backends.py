@@ -1,12 +1,89 @@
-from django.core.files.base import ContentFile
+from asgiref.sync import sync_to_async
 from django.core.mail import EmailMessage
 from django.core.mail import get_connection
 from django.core.mail.backends.base import BaseEmailBackend
-from email.mime.base import MIMEBase
+from django.db import connections, router
 
+import asyncio
 import logging
+import threading
+from email.mime.base import MIMEBase
 from .conf import settings
-from .models import Attachment, Email
+from .models import Email, Recipient
+from .policies import LOG, LOG_IF_FAILED, LOGGED, get_decision
+from .recorder import (
+    build_email,
+    get_contents,
+    get_recipients,
+    log_attachments,
+    save_recipients,
+    saving_contents,
+)
+from .writer import QueuedLogWriter
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer() -> QueuedLogWriter:
+    """Return the process-wide queued log writer, creating it on first use."""
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = QueuedLogWriter(
+                write=write_queued_records,
+                max_size=settings.EMAIL_LOG_QUEUE_MAX_SIZE,
+                flush_size=settings.EMAIL_LOG_QUEUE_FLUSH_SIZE,
+                flush_interval=settings.EMAIL_LOG_QUEUE_FLUSH_INTERVAL,
+                full_policy=settings.EMAIL_LOG_QUEUE_FULL_POLICY,
+                max_bytes=settings.EMAIL_LOG_QUEUE_MAX_BYTES,
+                sizeof=queued_record_size,
+            )
+        return _log_writer
+
+
+def queued_record_size(record: tuple) -> int:
+    """Return the size of the attachments a queued record keeps in memory."""
+    email, message = record
+    if message is None:
+        return 0
+    size = 0
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            size += sum(
+                len(part.get_payload())
+                for part in attachment.walk()
+                if not part.is_multipart()
+            )
+        else:
+            size += len(attachment[1])
+    return size
+
+
+def save_emails(emails: list):
+    """Save built emails with their contents and recipients."""
+    connection = connections[router.db_for_write(Email)]
+    with saving_contents(emails):
+        if connection.features.can_return_rows_from_bulk_insert:
+            Email.objects.bulk_create(
+                emails, batch_size=settings.EMAIL_LOG_BULK_BATCH_SIZE
+            )
+        else:
+            for email in emails:
+                email.save()
+    save_recipients(emails)
+
+
+def write_queued_records(records: list):
+    """Save queued ``(email, message)`` records to the database."""
+    save_emails([email for email, message in records])
+
+    if settings.EMAIL_LOG_SAVE_ATTACHMENTS:
+        for email, message in records:
+            # Messages logged without their attachments are queued without
+            # the message
+            if message is not None:
+                log_attachments(email, message)
 
 
 class EmailBackend(BaseEmailBackend):
@@ -16,88 +93,295 @@ class EmailBackend(BaseEmailBackend):
         super(EmailBackend, self).__init__(**kwargs)
         self.connection = get_connection(settings.EMAIL_LOG_BACKEND, **kwargs)
 
+    def open(self):
+        return self.connection.open()
+
+    def close(self):
+        self.connection.close()
+
     def send_messages(self, email_messages):
-        num_sent = 0
-        for message in email_messages:
-            recipients = "; ".join(message.to)
-            cc_recipients = "; ".join(message.cc) if message.cc else ""
-            bcc_recipients = "; ".join(message.bcc) if message.bcc else ""
-            reply_to = "; ".join(message.reply_to) if message.reply_to else ""
+        email_messages = list(email_messages)
+        if not email_messages:
+            return 0
+        new_conn_created = self._open_for_batch()
+        try:
+            if settings.EMAIL_LOG_QUEUE:
+                return sum(self._send_message_queued(m) for m in email_messages)
+            if self._can_write_in_bulk():
+                return self._send_messages_in_bulk(email_messages)
+            return sum(self._send_message(message) for message in email_messages)
+        finally:
+            if new_conn_created:
+                self.close()
+
+    def _open_for_batch(self):
+        """Open the wrapped connection so every message in a batch reuses it.
+
+        Messages are still handed to the wrapped backend one at a time so that
+        each one gets its own sent count.  If the connection cannot be opened
+        here, each send will try again and fail (or not) on its own, so that
+        the failed messages are still logged.
+
+        """
+        try:
+            return self.open()
+        except Exception:
+            return False
+
+    def _send_message(self, message: EmailMessage) -> int:
+        """Send a single message, logging it with its own queries."""
+        decision = get_decision(message)
+        if decision not in LOGGED:
+            return self._send_unlogged(message, decision)
+        email = None
+        try:
+            email = build_email(message)
+            with saving_contents([email]):
+                email.save()
+            save_recipients([email])
+        except Exception:
             email = None
-            html_message = self._get_html_message(message)
+            logging.error("Failed to save email to database (create)", exc_info=True)
+
+        if settings.EMAIL_LOG_SAVE_ATTACHMENTS and decision == LOG:
+            log_attachments(email, message)
+
+        message.connection = self.connection
+        sent = message.send()
+        if sent and email:
+            email.ok = True
             try:
-                email = Email.objects.create(
-                    from_email=message.from_email,
-                    recipients=recipients,
-                    cc_recipients=cc_recipients,
-                    bcc_recipients=bcc_recipients,
-                    reply_to=reply_to,
-                    extra_headers=message.extra_headers,
-                    subject=message.subject,
-                    body=message.body,
-                    html_message=html_message,
-                )
+                email.save()
             except Exception:
                 logging.error(
-                    "Failed to save email to database (create)", exc_info=True
+                    "Failed to save email to database (update)", exc_info=True
                 )
+        return sent
 
-            if settings.EMAIL_LOG_SAVE_ATTACHMENTS:
-                self._log_attachments(email, message)
-
-            message.connection = self.connection
-            num_sent += message.send()
-            if num_sent > 0 and email:
-                email.ok = True
-                try:
-                    email.save()
-                except Exception:
-                    logging.error(
-                        "Failed to save email to database (update)", exc_info=True
-                    )
+    def _send_message_queued(self, message: EmailMessage) -> int:
+        """Send a single message and queue its log record for the writer."""
+        decision = get_decision(message)
+        if decision not in LOGGED:
+            return self._send_unlogged(message, decision)
+        message.connection = self.connection
+        sent = 0
+        try:
+            sent = message.send()
+        finally:
+            email = build_email(message)
+            email.ok = bool(sent)
+            save_attachments = settings.EMAIL_LOG_SAVE_ATTACHMENTS and decision == LOG
+            get_log_writer().put((email, message if save_attachments else None))
+        return sent
+
+    def _send_unlogged(self, message: EmailMessage, decision: str) -> int:
+        """Send a message the policy doesn't log, unless sending fails.
+
+        Skipped messages cost no database queries at all.
+
+        """
+        message.connection = self.connection
+        sent = 0
+        try:
+            sent = message.send()
+        finally:
+            if decision == LOG_IF_FAILED and not sent:
+                self._log_failure(message)
+        return sent
+
+    def _log_failure(self, message: EmailMessage):
+        """Log a message that wasn't sent."""
+        email = build_email(message)
+        save_attachments = settings.EMAIL_LOG_SAVE_ATTACHMENTS
+        if settings.EMAIL_LOG_QUEUE:
+            get_log_writer().put((email, message if save_attachments else None))
+            return
+        try:
+            with saving_contents([email]):
+                email.save()
+            save_recipients([email])
+        except Exception:
+            logging.error("Failed to save email to database (create)", exc_info=True)
+            return
+        if save_attachments:
+            log_attachments(email, message)
+
+    def _can_write_in_bulk(self) -> bool:
+        """Return True if log rows may be written with one query per batch.
+
+        Bulk writes need the primary keys of the created rows back, which not
+        every database supports.
+
+        """
+        if not settings.EMAIL_LOG_BULK_WRITES:
+            return False
+        connection = connections[router.db_for_write(Email)]
+        return connection.features.can_return_rows_from_bulk_insert
+
+    def _send_messages_in_bulk(self, email_messages):
+        """Send messages, logging them with a fixed number of queries."""
+        decisions = [get_decision(message) for message in email_messages]
+        emails = [
+            build_email(message) if decision in LOGGED else None
+            for message, decision in zip(email_messages, decisions)
+        ]
+        try:
+            created = [email for email in emails if email is not None]
+            with saving_contents(created):
+                Email.objects.bulk_create(
+                    created, batch_size=settings.EMAIL_LOG_BULK_BATCH_SIZE
+                )
+            save_recipients(created)
+        except Exception:
+            emails = [None] * len(email_messages)
+            logging.error("Failed to save email to database (create)", exc_info=True)
+
+        num_sent = 0
+        sent_pks = []
+        try:
+            for message, decision, email in zip(email_messages, decisions, emails):
+                if decision not in LOGGED:
+                    num_sent += self._send_unlogged(message, decision)
+                    continue
+                if settings.EMAIL_LOG_SAVE_ATTACHMENTS and decision == LOG and email:
+                    log_attachments(email, message)
+
+                message.connection = self.connection
+                sent = message.send()
+                num_sent += sent
+                if sent and email:
+                    sent_pks.append(email.pk)
+        finally:
+            # Messages sent before one that raised are still marked as sent
+            self._mark_sent(sent_pks)
         return num_sent
 
-    def _get_html_message(self, message: EmailMessage) -> str:
-        """Retrieve html message from the email message."""
-        if hasattr(message, "alternatives") and len(message.alternatives) > 0:
-            for alternative in message.alternatives:
-                if alternative[1] == "text/html":
-                    return alternative[0]
-        return ""
-
-    def _log_attachments(self, email: Email, message: EmailMessage):
-        """Retrieve all attachments from email and create them."""
-        attachment_files = {}
-        for attachment in message.attachments:
-            if isinstance(attachment, MIMEBase):
-                attachment_files[attachment.get_filename()] = {
-                    "file": ContentFile(attachment.get_payload()),
-                }
-            else:
-                name, content, type = attachment
-                attachment_files[name] = {
-                    "file": ContentFile(content),
-                }
-                if type != "application/octet-stream":
-                    attachment_files[name].update({"mimetype": type})
-
-        if attachment_files:
-            self._create_attachments(email, attachment_files)
-
-    def _create_attachments(self, email: Email, files: dict):
-        """Create attachments and save it to database."""
-        for filename, filedata in files.items():
-            content = filedata.get("file", None)
-            mimetype = filedata.get("mimetype", None)
-            attachment = Attachment()
-
-            attachment.name = filename
-            attachment.email = email
-            if mimetype:
-                attachment.mimetype = mimetype
-
-            attachment.file.save(
-                filename,
-                content=content,
-                save=True,
+    def _mark_sent(self, pks: list):
+        """Set ``ok`` on the given emails with as few UPDATE queries as possible."""
+        try:
+            for batch in self._pk_batches(pks):
+                Email.objects.filter(pk__in=batch).update(ok=True)
+        except Exception:
+            logging.error("Failed to save email to database (update)", exc_info=True)
+
+    def _pk_batches(self, pks: list):
+        """Split primary keys into batches small enough for one query each."""
+        if not pks:
+            return
+        batch_size = settings.EMAIL_LOG_BULK_BATCH_SIZE
+        if not batch_size:
+            connection = connections[router.db_for_write(Email)]
+            batch_size = connection.ops.bulk_batch_size(["pk"], pks)
+        for start in range(0, len(pks), batch_size):
+            end = start + batch_size
+            yield pks[start:end]
+
+
+class AsyncEmailBackend(EmailBackend):
+    """Wrapper email backend that can also record and send emails from async code
+
+    ``asend_messages`` writes the ``Email`` rows with the async ORM while the
+    wrapped backend sends the messages in a worker thread.
+
+    """
+
+    async def asend_messages(self, email_messages):
+        email_messages = list(email_messages)
+        if not email_messages:
+            return 0
+        if settings.EMAIL_LOG_QUEUE:
+            return await sync_to_async(self.send_messages, thread_sensitive=False)(
+                email_messages
+            )
+
+        decisions = [get_decision(message) for message in email_messages]
+        emails = [
+            build_email(message) if decision in LOGGED else None
+            for message, decision in zip(email_messages, decisions)
+        ]
+        created, (sent, error) = await asyncio.gather(
+            self._acreate_emails([email for email in emails if email is not None]),
+            # Not thread sensitive, so sending doesn't wait for the database
+            # queries that run in the shared sync thread.
+            sync_to_async(self._send_each, thread_sensitive=False)(email_messages),
+        )
+        if created:
+            if settings.EMAIL_LOG_SAVE_ATTACHMENTS:
+                await sync_to_async(self._log_all_attachments)(
+                    emails, email_messages, decisions
+                )
+            await self._amark_sent(
+                [email.pk for email, count in zip(emails, sent) if email and count]
             )
+        # Messages after the one that raised weren't sent either
+        sent_counts = sent + [0] * (len(email_messages) - len(sent))
+        failed = [
+            message
+            for message, decision, count in zip(email_messages, decisions, sent_counts)
+            if decision == LOG_IF_FAILED and not count
+        ]
+        if failed:
+            await sync_to_async(self._log_failures)(failed)
+        if error is not None:
+            raise error
+        return sum(sent)
+
+    async def _acreate_emails(self, emails: list) -> bool:
+        """Insert the Email rows, returning whether that succeeded."""
+        connection = connections[router.db_for_write(Email)]
+        try:
+            if get_contents(emails):
+                # The contents are locked in a transaction, which the async
+                # ORM can't open
+                await sync_to_async(save_emails)(emails)
+                return True
+            if connection.features.can_return_rows_from_bulk_insert:
+                await Email.objects.abulk_create(
+                    emails, batch_size=settings.EMAIL_LOG_BULK_BATCH_SIZE
+                )
+            else:
+                for email in emails:
+                    await email.asave()
+            if settings.EMAIL_LOG_RECIPIENTS:
+                await Recipient.objects.abulk_create(get_recipients(emails))
+        except Exception:
+            logging.error("Failed to save email to database (create)", exc_info=True)
+            return False
+        return True
+
+    async def _amark_sent(self, pks: list):
+        """Set ``ok`` on the given emails with as few UPDATE queries as possible."""
+        try:
+            for batch in self._pk_batches(pks):
+                await Email.objects.filter(pk__in=batch).aupdate(ok=True)
+        except Exception:
+            logging.error("Failed to save email to database (update)", exc_info=True)
+
+    def _send_each(self, email_messages: list):
+        """Send messages over one connection.
+
+        Return the sent count of every message that was sent and the exception
+        that stopped sending, if any.
+
+        """
+        sent = []
+        new_conn_created = self._open_for_batch()
+        try:
+            for message in email_messages:
+                message.connection = self.connection
+                sent.append(message.send())
+        except Exception as error:
+            return sent, error
+        finally:
+            if new_conn_created:
+                self.close()
+        return sent, None
+
+    def _log_all_attachments(self, emails: list, email_messages: list, decisions: list):
+        for email, message, decision in zip(emails, email_messages, decisions):
+            if decision == LOG:
+                log_attachments(email, message)
+
+    def _log_failures(self, email_messages: list):
+        for message in email_messages:
+            self._log_failure(message)
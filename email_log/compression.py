@@ -0,0 +1,52 @@
+"""zlib compression of the body and HTML message of logged emails
+
+Compressed content is stored in the ``body_compressed`` and
+``html_message_compressed`` binary fields, leaving the text fields empty.
+The optional ``EMAIL_LOG_COMPRESSION_DICTIONARY`` is a preset dictionary of
+content common to many emails, which helps compress short messages.
+
+"""
+
+import zlib
+
+from .conf import settings
+
+COMPRESSED_FIELDS = ("body", "html_message")
+
+
+def compress(text: str) -> bytes:
+    dictionary = settings.EMAIL_LOG_COMPRESSION_DICTIONARY
+    if dictionary:
+        compressor = zlib.compressobj(zdict=dictionary)
+    else:
+        compressor = zlib.compressobj()
+    return compressor.compress(text.encode()) + compressor.flush()
+
+
+def decompress(data) -> str:
+    # PostgreSQL returns binary fields as memoryview
+    data = bytes(data)
+    dictionary = settings.EMAIL_LOG_COMPRESSION_DICTIONARY
+    if dictionary:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj()
+    return (decompressor.decompress(data) + decompressor.flush()).decode()
+
+
+def compress_email(email):
+    """Move the non-empty text fields of an email to its compressed fields."""
+    for name in COMPRESSED_FIELDS:
+        value = getattr(email, name)
+        if value:
+            setattr(email, f"{name}_compressed", compress(value))
+            setattr(email, name, "")
+
+
+def decompress_email(email):
+    """Move the compressed fields of an email back to its text fields."""
+    for name in COMPRESSED_FIELDS:
+        value = getattr(email, f"{name}_compressed")
+        if value is not None:
+            setattr(email, name, decompress(value))
+            setattr(email, f"{name}_compressed", None)
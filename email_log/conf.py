@@ -8,7 +8,28 @@ class Settings:
         EMAIL_LOG_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
         EMAIL_LOG_SAVE_ATTACHMENTS = False
         EMAIL_LOG_ATTACHMENTS_PATH = ""
+        EMAIL_LOG_ATTACHMENTS_DEDUPLICATE = False
+        EMAIL_LOG_ATTACHMENTS_WORKERS = 1
         EMAIL_LOG_CONNECT_ANYMAIL_SIGNALS = False
+        EMAIL_LOG_BULK_WRITES = False
+        EMAIL_LOG_BULK_BATCH_SIZE = None
+        EMAIL_LOG_QUEUE = False
+        EMAIL_LOG_QUEUE_MAX_SIZE = 10000
+        EMAIL_LOG_QUEUE_MAX_BYTES = 100 * 1024 * 1024
+        EMAIL_LOG_QUEUE_FLUSH_SIZE = 500
+        EMAIL_LOG_QUEUE_FLUSH_INTERVAL = 1.0
+        EMAIL_LOG_QUEUE_FULL_POLICY = "block"
+        EMAIL_LOG_PENDING_EVENTS_TTL = None
+        EMAIL_LOG_CAPTURE = {}
+        EMAIL_LOG_COMPRESS = False
+        EMAIL_LOG_COMPRESSION_DICTIONARY = None
+        EMAIL_LOG_DEDUPLICATE_BODIES = False
+        EMAIL_LOG_POLICY = None
+        EMAIL_LOG_RECIPIENTS = False
+        EMAIL_LOG_ADMIN_COUNT_LIMIT = 10000
+        EMAIL_LOG_ADMIN_DATE_WINDOW = 30
+        EMAIL_LOG_ADMIN_KEYSET_PAGINATION = False
+        EMAIL_LOG_ADMIN_LAZY = False
 
     def __init__(self):
         self.defaults = Settings.Default()
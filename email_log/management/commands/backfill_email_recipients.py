@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from email_log.models import Email, Recipient
+from email_log.recorder import RECIPIENT_FIELDS, get_recipients
+
+
+class Command(BaseCommand):
+    help = (
+        "Save the recipients of logged emails that have none, in batches of "
+        "consecutive primary keys."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of emails read per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        total = 0
+        last_pk = 0
+        emails = (
+            Email.objects.filter(
+                ~Exists(Recipient.objects.filter(email=OuterRef("pk")))
+            )
+            .order_by("pk")
+            .only("pk", *RECIPIENT_FIELDS)
+        )
+        while batch := list(emails.filter(pk__gt=last_pk)[:batch_size]):
+            last_pk = batch[-1].pk
+            recipients = get_recipients(batch)
+            with transaction.atomic():
+                Recipient.objects.bulk_create(recipients)
+            total += len(recipients)
+        self.stdout.write(f"Saved {total} recipients.")
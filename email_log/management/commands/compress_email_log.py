@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from email_log.compression import compress_email, decompress_email
+from email_log.models import Email
+
+FIELDS = ["body", "html_message", "body_compressed", "html_message_compressed"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compress the body and HTML message of logged emails, in batches of "
+        "consecutive primary keys."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of emails updated per transaction.",
+        )
+        parser.add_argument(
+            "--decompress",
+            action="store_true",
+            help="Store compressed emails uncompressed again.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if options["decompress"]:
+            emails = Email.objects.exclude(
+                body_compressed__isnull=True, html_message_compressed__isnull=True
+            )
+            convert, verb = decompress_email, "Decompressed"
+        else:
+            emails = Email.objects.exclude(body="", html_message="")
+            convert, verb = compress_email, "Compressed"
+
+        total = 0
+        last_pk = 0
+        emails = emails.order_by("pk").only("pk", *FIELDS)
+        while batch := list(emails.filter(pk__gt=last_pk)[:batch_size]):
+            last_pk = batch[-1].pk
+            for email in batch:
+                convert(email)
+            with transaction.atomic():
+                Email.objects.bulk_update(batch, FIELDS)
+            total += len(batch)
+        self.stdout.write(f"{verb} {total} emails.")
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.db.utils import OperationalError
+
+from email_log.models import Email
+from email_log.partitions import is_partitioned
+from email_log.search import (
+    SEARCH_FIELDS,
+    drop_fts_table_sql,
+    drop_trigram_indexes_sql,
+    fts_table_sql,
+    trigram_index_sql,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the indexes used to search logged emails: trigram indexes on "
+        "PostgreSQL and an FTS5 table on SQLite."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--drop",
+            action="store_true",
+            help="Drop the search indexes instead of creating them.",
+        )
+
+    def handle(self, *args, **options):
+        self.connection = connections[router.db_for_write(Email)]
+        quote = self.connection.ops.quote_name
+        table = Email._meta.db_table
+        if self.connection.vendor == "postgresql":
+            if options["drop"]:
+                self.execute_sql(drop_trigram_indexes_sql(quote, table))
+            else:
+                self.create_trigram_indexes(quote, table)
+        elif self.connection.vendor == "sqlite":
+            # Recreating the table also restores triggers dropped by a
+            # migration that rebuilt the email table.
+            self.execute_sql(drop_fts_table_sql(quote))
+            if not options["drop"]:
+                self.create_fts_table(quote, table)
+        else:
+            raise CommandError("Indexed search requires PostgreSQL or SQLite.")
+
+    def execute_sql(self, statements):
+        with self.connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    def create_trigram_indexes(self, quote, table):
+        with self.connection.cursor() as cursor:
+            partitioned = is_partitioned(cursor, table)
+        self.execute_sql(["CREATE EXTENSION IF NOT EXISTS pg_trgm"])
+        self.execute_sql(
+            trigram_index_sql(quote, table, field, partitioned)
+            for field in SEARCH_FIELDS
+        )
+
+    def create_fts_table(self, quote, table):
+        try:
+            self.execute_sql(fts_table_sql(quote, table))
+        except OperationalError:
+            self.execute_sql(drop_fts_table_sql(quote))
+            raise CommandError(
+                "SQLite was built without FTS5 or is older than 3.34, which "
+                "added the trigram tokenizer."
+            )
@@ -0,0 +1,220 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from email_log.models import Attachment, Email, Log, Recipient
+from email_log.partitions import (
+    PARTITIONED_MODELS,
+    add_months,
+    check_boundary_sql,
+    convert_table_sql,
+    create_partition_sql,
+    detach_partition_sql,
+    drop_partition_sql,
+    get_partitions,
+    is_partitioned,
+    month_start,
+    prepare_indexes_sql,
+)
+from email_log.search import has_trigram_indexes
+
+
+class Command(BaseCommand):
+    help = "Manage monthly range partitions of the email and log tables on PostgreSQL."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="Turn the email and log tables into partitioned tables.",
+        )
+        parser.add_argument(
+            "--premake",
+            type=int,
+            default=3,
+            help="Number of future months to create partitions for.",
+        )
+        parser.add_argument(
+            "--retain",
+            type=int,
+            help="Remove partitions that end more than this many months ago.",
+        )
+        parser.add_argument(
+            "--detach-only",
+            action="store_true",
+            help="Detach old partitions instead of dropping them.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help=(
+                "Number of emails of a removed partition whose attachments, "
+                "recipients and logs are deleted per transaction."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Print the SQL instead of running it.",
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options["dry_run"]
+        self.connection = connections[router.db_for_write(Email)]
+        self.quote = self.connection.ops.quote_name
+        is_postgresql = self.connection.vendor == "postgresql"
+        if not is_postgresql and not (self.dry_run and options["retain"] is None):
+            raise CommandError("Partitioning requires PostgreSQL.")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+        self.chunk_size = options["chunk_size"]
+
+        current_month = month_start(timezone.now())
+        # The table converted last covers every month before its boundary
+        self.legacy_bounds = {}
+        if options["convert"]:
+            self.convert(boundary=add_months(current_month, 1))
+        with transaction.atomic(using=self.connection.alias):
+            self.premake(current_month, options["premake"])
+        if options["retain"] is not None:
+            cutoff = add_months(current_month, -options["retain"])
+            self.remove_old(cutoff, options["detach_only"])
+
+    def execute_sql(self, sql):
+        if self.dry_run:
+            self.stdout.write(f"{sql};")
+        else:
+            with self.connection.cursor() as cursor:
+                cursor.execute(sql)
+
+    def convert(self, boundary):
+        for model in PARTITIONED_MODELS:
+            table = model._meta.db_table
+            search_indexes = False
+            if not self.dry_run:
+                with self.connection.cursor() as cursor:
+                    if is_partitioned(cursor, table):
+                        self.stdout.write(f"{table} is already partitioned.")
+                        continue
+                    search_indexes = has_trigram_indexes(cursor, table)
+            # The table is only locked once its rows are known to fit before
+            # the boundary and its indexes are built, which take scans of the
+            # whole table.
+            for sql in check_boundary_sql(self.quote, model, boundary):
+                with transaction.atomic(using=self.connection.alias):
+                    self.execute_sql(sql)
+            # Indexes are built concurrently, which can't be in a transaction
+            for sql in prepare_indexes_sql(self.quote, model):
+                self.execute_sql(sql)
+            with transaction.atomic(using=self.connection.alias):
+                for sql in convert_table_sql(
+                    self.quote, model, boundary, search_indexes
+                ):
+                    self.execute_sql(sql)
+            self.legacy_bounds[model] = boundary
+
+    def get_legacy_bound(self, model):
+        """Return the upper bound of the partition made from the old table."""
+        if model not in self.legacy_bounds and not self.dry_run:
+            table = model._meta.db_table
+            with self.connection.cursor() as cursor:
+                bounds = dict(get_partitions(cursor, table))
+            self.legacy_bounds[model] = bounds.get(f"{table}_legacy")
+        return self.legacy_bounds.get(model)
+
+    def premake(self, current_month, months):
+        for model in PARTITIONED_MODELS:
+            legacy_bound = self.get_legacy_bound(model)
+            for offset in range(months + 1):
+                start = add_months(current_month, offset)
+                if legacy_bound and start < legacy_bound:
+                    continue
+                self.execute_sql(
+                    create_partition_sql(self.quote, model._meta.db_table, start)
+                )
+
+    def remove_old(self, cutoff, detach_only):
+        """Detach, and unless ``detach_only`` drop, partitions ending by cutoff.
+
+        Detaching locks the partitioned table until the transaction ends, so
+        each partition is detached in its own transaction, after the rows
+        that refer to its emails are deleted in chunks.
+
+        """
+        for model in PARTITIONED_MODELS:
+            table = model._meta.db_table
+            with self.connection.cursor() as cursor:
+                partitions = get_partitions(cursor, table)
+            for name, upper_bound in partitions:
+                if upper_bound is None or upper_bound > cutoff:
+                    continue
+                delete = model is Email and not (detach_only or self.dry_run)
+                if delete:
+                    for email_ids in self.email_id_chunks(name):
+                        with transaction.atomic(using=self.connection.alias):
+                            self.delete_attachments(email_ids)
+                            self.delete_recipients(email_ids)
+                            self.delete_logs(email_ids)
+                with transaction.atomic(using=self.connection.alias):
+                    if delete:
+                        # Tracking events logged since their chunk was deleted
+                        self.delete_logs(self.email_ids(name))
+                    self.execute_sql(detach_partition_sql(self.quote, table, name))
+                    if not detach_only:
+                        self.execute_sql(drop_partition_sql(self.quote, name))
+
+    def email_ids(self, partition):
+        return RawSQL(f"SELECT {self.quote('id')} FROM {self.quote(partition)}", [])
+
+    def email_id_chunks(self, partition):
+        """Yield the ids of the emails in a partition, ``chunk_size`` at a time."""
+        last_id = 0
+        while True:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT {self.quote('id')} FROM {self.quote(partition)} "
+                    f"WHERE {self.quote('id')} > %s "
+                    f"ORDER BY {self.quote('id')} LIMIT %s",
+                    [last_id, self.chunk_size],
+                )
+                email_ids = [row[0] for row in cursor.fetchall()]
+            if not email_ids:
+                return
+            yield email_ids
+            last_id = email_ids[-1]
+
+    def delete_recipients(self, email_ids):
+        """Delete the recipients of the given emails."""
+        Recipient.objects.filter(email_id__in=email_ids).delete()
+
+    def delete_logs(self, email_ids):
+        """Delete the logs of the given emails.
+
+        Logs are partitioned by their own timestamp, so events that arrived
+        after the emails' month would otherwise outlive them.
+
+        """
+        Log.objects.filter(email_id__in=email_ids).delete()
+
+    def delete_attachments(self, email_ids):
+        """Delete the attachments of the given emails.
+
+        Attachments aren't partitioned and no longer cascade once the email
+        table is converted, so they are deleted before the partition is
+        dropped.  Detached partitions keep their attachments.
+
+        """
+        attachments = Attachment.objects.filter(email_id__in=email_ids)
+        # Deduplicated files are deleted by a signal handler once they are no
+        # longer referenced; other files belong to one attachment.
+        files = list(attachments.filter(digest="").values_list("file", flat=True))
+        attachments.delete()
+        storage = Attachment._meta.get_field("file").storage
+
+        def delete_files():
+            for name in files:
+                storage.delete(name)
+
+        transaction.on_commit(delete_files, using=self.connection.alias)
@@ -0,0 +1,162 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Exists, Max, Min, OuterRef
+from django.utils import timezone
+
+from email_log.models import Attachment, Content, Email, Log
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete old emails with their attachments and logs, in chunks of "
+        "consecutive primary keys."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="Delete emails sent more than this many days ago.",
+        )
+        parser.add_argument(
+            "--keep",
+            type=int,
+            help="Delete all but this many of the most recently sent emails.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help=(
+                "Number of consecutive primary keys, or of unused contents, "
+                "deleted per transaction."
+            ),
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Seconds to wait between chunks.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many rows would be deleted.",
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        self.check_options(options)
+        cutoff = self.get_cutoff(options["days"], options["keep"])
+        emails = Email.objects.filter(date_sent__lt=cutoff) if cutoff else None
+        if emails is None or not emails.exists():
+            self.stdout.write("No emails to delete.")
+        elif options["dry_run"]:
+            self.report_counts(emails)
+        else:
+            self.delete_emails(emails, options["chunk_size"], options["sleep"])
+        if not options["dry_run"]:
+            self.delete_unused_contents(options["chunk_size"])
+
+    def delete_emails(self, emails, chunk_size, sleep):
+        totals = {Email: 0, Attachment: 0, Log: 0}
+        for chunk in self.get_chunks(emails, chunk_size):
+            counts = self.delete_chunk(chunk)
+            for model, count in counts.items():
+                totals[model] += count
+            if counts[Email] and sleep:
+                time.sleep(sleep)
+        self.stdout.write(
+            f"Deleted {totals[Email]} emails, {totals[Attachment]} attachments "
+            f"and {totals[Log]} logs."
+        )
+
+    def check_options(self, options):
+        if options["days"] is None and options["keep"] is None:
+            raise CommandError("Specify --days, --keep or both.")
+        if options["keep"] is not None and options["keep"] < 1:
+            raise CommandError("--keep must be at least 1.")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+    def get_cutoff(self, days, keep):
+        """Return the send date before which emails are deleted."""
+        cutoffs = []
+        if days is not None:
+            cutoffs.append(timezone.now() - timedelta(days=days))
+        if keep is not None:
+            # The send date of the oldest email that is kept
+            oldest_kept = keep - 1
+            kept = Email.objects.order_by("-date_sent", "-pk")[oldest_kept:]
+            cutoffs.extend(kept.values_list("date_sent", flat=True)[:1])
+        return max(cutoffs, default=None)
+
+    def get_chunks(self, emails, chunk_size):
+        """Yield querysets of the emails in consecutive primary key ranges."""
+        bounds = emails.aggregate(low=Min("pk"), high=Max("pk"))
+        for start in range(bounds["low"], bounds["high"] + 1, chunk_size):
+            yield emails.filter(pk__gte=start, pk__lt=start + chunk_size)
+
+    def delete_chunk(self, emails):
+        """Delete a chunk of emails and the files of their attachments."""
+        with transaction.atomic():
+            # Deduplicated files are deleted by a signal handler once they
+            # are no longer referenced; other files belong to one attachment.
+            files = list(
+                Attachment.objects.filter(email__in=emails, digest="").values_list(
+                    "file", flat=True
+                )
+            )
+            deleted, counts = emails.only("pk").delete()
+        storage = Attachment._meta.get_field("file").storage
+        for name in files:
+            storage.delete(name)
+        counts = {
+            model: counts.get(model._meta.label, 0)
+            for model in (Email, Attachment, Log)
+        }
+        if deleted and self.verbosity > 1:
+            self.stdout.write(f"Deleted {counts[Email]} emails.")
+        return counts
+
+    def delete_unused_contents(self, chunk_size):
+        """Delete the shared bodies and HTML messages no email refers to.
+
+        Contents are deleted in chunks of digests.  Each chunk is locked
+        first, skipping the contents locked by an email being logged (see
+        ``save_contents``), and checked again once locked.
+
+        """
+        unused = Content.objects.filter(
+            ~Exists(Email.objects.filter(body_content=OuterRef("pk"))),
+            ~Exists(Email.objects.filter(html_message_content=OuterRef("pk"))),
+        )
+        total = 0
+        last_digest = ""
+        while digests := list(
+            unused.filter(pk__gt=last_digest)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:chunk_size]
+        ):
+            last_digest = digests[-1]
+            with transaction.atomic():
+                locked = (
+                    Content.objects.select_for_update(skip_locked=True)
+                    .filter(pk__in=digests)
+                    .values_list("pk", flat=True)
+                )
+                deleted, counts = unused.filter(pk__in=list(locked)).delete()
+            total += deleted
+        if total:
+            self.stdout.write(f"Deleted {total} unused contents.")
+
+    def report_counts(self, emails):
+        attachments = Attachment.objects.filter(email__in=emails).count()
+        logs = Log.objects.filter(email__in=emails).count()
+        self.stdout.write(
+            f"Would delete {emails.count()} emails, {attachments} attachments "
+            f"and {logs} logs."
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from email_log.signal_handlers import reconcile_pending_events
+
+
+class Command(BaseCommand):
+    help = (
+        "Log pending tracking events whose emails have been logged and delete "
+        "expired ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of pending events processed per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        reconciled = reconcile_pending_events(batch_size=options["batch_size"])
+        self.stdout.write(f"Logged {reconciled} pending events.")
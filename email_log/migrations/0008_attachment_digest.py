@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0007_log"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="attachment",
+            name="digest",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                default="",
+                help_text="SHA-256 of the content",
+                max_length=64,
+                verbose_name="digest",
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0008_attachment_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="email",
+            name="esp_message_id",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                default="",
+                help_text="message id assigned by the ESP",
+                max_length=255,
+                verbose_name="ESP message id",
+            ),
+        ),
+    ]
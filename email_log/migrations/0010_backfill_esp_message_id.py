@@ -0,0 +1,38 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_esp_message_id(apps, schema_editor):
+    """Copy the anymail_id header of logged emails into esp_message_id"""
+    Email = apps.get_model("email_log", "Email")
+    emails = Email.objects.using(schema_editor.connection.alias).filter(
+        extra_headers__has_key="anymail_id", esp_message_id=""
+    )
+    last_pk = 0
+    while batch := list(
+        emails.filter(pk__gt=last_pk)
+        .order_by("pk")
+        .only("pk", "extra_headers")[:BATCH_SIZE]
+    ):
+        last_pk = batch[-1].pk
+        updated = []
+        for email in batch:
+            message_id = email.extra_headers["anymail_id"]
+            if message_id:
+                email.esp_message_id = str(message_id)[:255]
+                updated.append(email)
+        Email.objects.using(schema_editor.connection.alias).bulk_update(
+            updated, ["esp_message_id"]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0009_email_esp_message_id"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_esp_message_id, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def delete_duplicate_logs(apps, schema_editor):
+    """Keep only the first log of each event before event ids become unique"""
+    Log = apps.get_model("email_log", "Log")
+    logs = Log.objects.using(schema_editor.connection.alias).exclude(event_id="")
+    duplicates = (
+        logs.values("esp", "event_id")
+        .annotate(count=Count("pk"), first_pk=Min("pk"))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates:
+        logs.filter(
+            esp=duplicate["esp"],
+            event_id=duplicate["event_id"],
+            pk__gt=duplicate["first_pk"],
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0010_backfill_esp_message_id"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_logs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+from email_log.partitions import UNIQUE_EVENT_INDEX, unique_event_index_sql
+
+UNIQUE_EVENT = models.UniqueConstraint(
+    condition=models.Q(("event_id", ""), _negated=True),
+    fields=("esp", "event_id"),
+    name="email_log_log_unique_event",
+)
+
+
+def is_partitioned(schema_editor, table):
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [table])
+        return cursor.fetchone()[0] == "p"
+
+
+def add_unique_event(apps, schema_editor):
+    Log = apps.get_model("email_log", "Log")
+    table = Log._meta.db_table
+    # Logs partitioned by partition_email_log can only have unique indexes
+    # that include the timestamp.
+    if is_partitioned(schema_editor, table):
+        schema_editor.execute(unique_event_index_sql(schema_editor.quote_name, table))
+    else:
+        schema_editor.add_constraint(Log, UNIQUE_EVENT)
+
+
+def remove_unique_event(apps, schema_editor):
+    Log = apps.get_model("email_log", "Log")
+    if is_partitioned(schema_editor, Log._meta.db_table):
+        schema_editor.execute(
+            f"DROP INDEX IF EXISTS {schema_editor.quote_name(UNIQUE_EVENT_INDEX)}"
+        )
+    else:
+        schema_editor.remove_constraint(Log, UNIQUE_EVENT)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0011_delete_duplicate_logs"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_unique_event, remove_unique_event),
+            ],
+            state_operations=[
+                migrations.AddConstraint(model_name="log", constraint=UNIQUE_EVENT),
+            ],
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0012_log_unique_event"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingEvent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("esp", models.CharField(max_length=255, verbose_name="ESP")),
+                ("message_id", models.CharField(db_index=True, max_length=255)),
+                ("event_type", models.CharField(max_length=255)),
+                ("metadata", models.JSONField()),
+                ("timestamp", models.DateTimeField()),
+                ("event_id", models.TextField(blank=True, default="")),
+                (
+                    "mta_response",
+                    models.TextField(null=True, verbose_name="MTA Response"),
+                ),
+                ("reject_reason", models.TextField(null=True)),
+                ("tags", models.JSONField()),
+                ("user_agent", models.TextField(null=True)),
+                (
+                    "click_url",
+                    models.URLField(
+                        max_length=4192, null=True, verbose_name="Click URL"
+                    ),
+                ),
+                ("esp_event", models.JSONField()),
+                ("received", models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                "verbose_name": "pending event",
+                "verbose_name_plural": "pending events",
+            },
+        ),
+    ]
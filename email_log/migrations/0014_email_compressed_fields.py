@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0013_pendingevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="email",
+            name="body_compressed",
+            field=models.BinaryField(null=True, verbose_name="compressed body"),
+        ),
+        migrations.AddField(
+            model_name="email",
+            name="html_message_compressed",
+            field=models.BinaryField(null=True, verbose_name="compressed HTML message"),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0014_email_compressed_fields"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Content",
+            fields=[
+                (
+                    "digest",
+                    models.CharField(
+                        help_text="SHA-256 of the text",
+                        max_length=64,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="digest",
+                    ),
+                ),
+                ("text", models.TextField(blank=True, verbose_name="text")),
+                (
+                    "compressed",
+                    models.BinaryField(null=True, verbose_name="compressed text"),
+                ),
+            ],
+            options={
+                "verbose_name": "content",
+                "verbose_name_plural": "contents",
+            },
+        ),
+        migrations.AddField(
+            model_name="email",
+            name="body_content",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="email_log.content",
+                verbose_name="body content",
+            ),
+        ),
+        migrations.AddField(
+            model_name="email",
+            name="html_message_content",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="email_log.content",
+                verbose_name="HTML message content",
+            ),
+        ),
+    ]
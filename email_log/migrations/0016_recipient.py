@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_log", "0015_content"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Recipient",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("address", models.CharField(max_length=254, verbose_name="address")),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("to", "to"), ("cc", "cc"), ("bcc", "bcc")],
+                        max_length=3,
+                        verbose_name="kind",
+                    ),
+                ),
+                (
+                    "email",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="email_log.email",
+                        verbose_name="email",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "recipient",
+                "verbose_name_plural": "recipients",
+                "indexes": [
+                    models.Index(
+                        fields=["address", "email"], name="email_log_recipient_address"
+                    )
+                ],
+            },
+        ),
+    ]
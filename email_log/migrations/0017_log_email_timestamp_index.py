@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:37
+
+from django.db import migrations, models
+
+from email_log.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # Logs can be a very large table, so the index is built without locking
+    # out writes on PostgreSQL, which can't happen in a transaction.
+    atomic = False
+
+    dependencies = [
+        ("email_log", "0016_recipient"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="log",
+            index=models.Index(
+                fields=["email", "timestamp"], name="email_log_log_email_time"
+            ),
+        ),
+    ]
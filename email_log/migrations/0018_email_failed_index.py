@@ -0,0 +1,101 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from email_log.operations import AddIndexConcurrently
+
+# Single-column indexes that the new indexes make redundant
+REDUNDANT_INDEXES = [("email", "ok"), ("log", "email")]
+
+
+def index_options(schema_editor, model) -> dict:
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relkind FROM pg_class WHERE oid = %s::regclass",
+            [model._meta.db_table],
+        )
+        # Indexes of partitioned tables can't be dropped or created
+        # concurrently
+        if cursor.fetchone()[0] == "p":
+            return {}
+    return {"concurrently": True}
+
+
+def drop_redundant_indexes(apps, schema_editor):
+    # Like AlterField, without the table rebuild AlterField does on SQLite,
+    # which would drop the triggers of the search table.
+    for model_name, field_name in REDUNDANT_INDEXES:
+        model = apps.get_model("email_log", model_name)
+        column = model._meta.get_field(field_name).column
+        for name in schema_editor._constraint_names(
+            model, [column], index=True, type_=models.Index.suffix
+        ):
+            schema_editor.execute(
+                schema_editor._delete_index_sql(
+                    model, name, **index_options(schema_editor, model)
+                )
+            )
+
+
+def create_redundant_indexes(apps, schema_editor):
+    for model_name, field_name in REDUNDANT_INDEXES:
+        model = apps.get_model("email_log", model_name)
+        field = model._meta.get_field(field_name)
+        schema_editor.execute(
+            schema_editor._create_index_sql(
+                model, fields=[field], **index_options(schema_editor, model)
+            )
+        )
+
+
+class Migration(migrations.Migration):
+    # The index of failed emails is built without locking out writes on
+    # PostgreSQL, which can't happen in a transaction.  The indexes it leaves
+    # redundant are only dropped once it exists.
+    atomic = False
+
+    dependencies = [
+        ("email_log", "0017_log_email_timestamp_index"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="log",
+            options={"ordering": ["email_id", "timestamp"]},
+        ),
+        AddIndexConcurrently(
+            model_name="email",
+            index=models.Index(
+                condition=models.Q(("ok", False)),
+                fields=["date_sent"],
+                name="email_log_email_failed",
+            ),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(drop_redundant_indexes, create_redundant_indexes),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name="email",
+                    name="ok",
+                    field=models.BooleanField(default=False, verbose_name="ok"),
+                ),
+                migrations.AlterField(
+                    model_name="log",
+                    name="email",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="logs",
+                        to="email_log.email",
+                        verbose_name="email",
+                    ),
+                ),
+            ],
+        ),
+    ]
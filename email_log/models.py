@@ -1,13 +1,62 @@
 import pathlib
+from email.utils import parseaddr
 
 from django.contrib.postgres.indexes import GinIndex
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
+from .compression import decompress
 from .conf import settings
 
 
+class Content(models.Model):
+    """Body or HTML message stored once for all emails with the same content"""
+
+    digest = models.CharField(
+        _("digest"),
+        max_length=64,
+        primary_key=True,
+        help_text=_("SHA-256 of the text"),
+    )
+    text = models.TextField(_("text"), blank=True)
+    compressed = models.BinaryField(_("compressed text"), null=True)
+
+    class Meta:
+        verbose_name = _("content")
+        verbose_name_plural = _("contents")
+
+    def __str__(self):
+        return self.digest
+
+    def get_text(self) -> str:
+        """Return the text, decompressing it if it was stored compressed"""
+        if self.compressed is not None:
+            return decompress(self.compressed)
+        return self.text
+
+
+def normalize_address(address: str) -> str:
+    """Return the lowercased email address of a possibly named address"""
+    name, email = parseaddr(address)
+    return (email or address).strip().lower()
+
+
+class EmailQuerySet(models.QuerySet):
+    def sent_to(self, address: str, kind: str = None):
+        """Return the emails sent to an address, found through its recipients
+
+        Only emails logged with ``EMAIL_LOG_RECIPIENTS`` set (or backfilled by
+        the ``backfill_email_recipients`` command) are found.  ``kind``
+        limits the search to ``to``, ``cc`` or ``bcc`` recipients.
+
+        """
+        recipients = Recipient.objects.filter(address=normalize_address(address))
+        if kind is not None:
+            recipients = recipients.filter(kind=kind)
+        return self.filter(pk__in=recipients.values("email_id"))
+
+
 class Email(models.Model):
     """Model to store outgoing email information"""
 
@@ -19,19 +68,72 @@ class Email(models.Model):
     extra_headers = models.JSONField(encoder=DjangoJSONEncoder, default=dict)
     subject = models.TextField(_("subject"))
     body = models.TextField(_("body"))
-    ok = models.BooleanField(_("ok"), default=False, db_index=True)
+    ok = models.BooleanField(_("ok"), default=False)
     date_sent = models.DateTimeField(_("date sent"), auto_now_add=True, db_index=True)
     html_message = models.TextField(_("HTML message"), blank=True)
+    body_compressed = models.BinaryField(_("compressed body"), null=True)
+    html_message_compressed = models.BinaryField(
+        _("compressed HTML message"), null=True
+    )
+    body_content = models.ForeignKey(
+        Content,
+        null=True,
+        blank=True,
+        related_name="+",
+        verbose_name=_("body content"),
+        on_delete=models.PROTECT,
+    )
+    html_message_content = models.ForeignKey(
+        Content,
+        null=True,
+        blank=True,
+        related_name="+",
+        verbose_name=_("HTML message content"),
+        on_delete=models.PROTECT,
+    )
+    esp_message_id = models.CharField(
+        _("ESP message id"),
+        max_length=255,
+        default="",
+        blank=True,
+        db_index=True,
+        help_text=_("message id assigned by the ESP"),
+    )
+
+    objects = EmailQuerySet.as_manager()
 
     def __str__(self):
         return "{s.recipients}: {s.subject}".format(s=self)
 
+    def get_body(self) -> str:
+        """Return the body, wherever and however it was stored"""
+        if self.body_content_id is not None:
+            return self.body_content.get_text()
+        if self.body_compressed is not None:
+            return decompress(self.body_compressed)
+        return self.body
+
+    def get_html_message(self) -> str:
+        """Return the HTML message, wherever and however it was stored"""
+        if self.html_message_content_id is not None:
+            return self.html_message_content.get_text()
+        if self.html_message_compressed is not None:
+            return decompress(self.html_message_compressed)
+        return self.html_message
+
     class Meta:
         verbose_name = _("email")
         verbose_name_plural = _("emails")
         ordering = ("-date_sent",)
         indexes = [
             GinIndex(fields=["extra_headers"]),
+            # The admin lists failed emails newest first.  Sent emails are
+            # most of the table, so listing them reads the date_sent index.
+            models.Index(
+                fields=["date_sent"],
+                condition=models.Q(ok=False),
+                name="email_log_email_failed",
+            ),
         ]
 
 
@@ -63,6 +165,14 @@ class Attachment(models.Model):
         on_delete=models.CASCADE,
     )
     mimetype = models.CharField(max_length=255, default="", blank=True)
+    digest = models.CharField(
+        _("digest"),
+        max_length=64,
+        default="",
+        blank=True,
+        db_index=True,
+        help_text=_("SHA-256 of the content"),
+    )
 
     class Meta:
         verbose_name = _("attachment")
@@ -72,9 +182,39 @@ class Attachment(models.Model):
         return self.name
 
 
+class Recipient(models.Model):
+    """Address an email was sent to, indexed to find the emails of an address"""
+
+    TO = "to"
+    CC = "cc"
+    BCC = "bcc"
+    KIND_CHOICES = [(TO, _("to")), (CC, _("cc")), (BCC, _("bcc"))]
+
+    email = models.ForeignKey(Email, verbose_name=_("email"), on_delete=models.CASCADE)
+    address = models.CharField(_("address"), max_length=254)
+    kind = models.CharField(_("kind"), max_length=3, choices=KIND_CHOICES)
+
+    class Meta:
+        verbose_name = _("recipient")
+        verbose_name_plural = _("recipients")
+        indexes = [
+            models.Index(
+                fields=["address", "email"], name="email_log_recipient_address"
+            ),
+        ]
+
+    def __str__(self):
+        return self.address
+
+
 class Log(models.Model):
     email = models.ForeignKey(
-        Email, related_name="logs", verbose_name=_("email"), on_delete=models.CASCADE
+        Email,
+        related_name="logs",
+        verbose_name=_("email"),
+        on_delete=models.CASCADE,
+        # The (email, timestamp) index also serves lookups by email
+        db_index=False,
     )
     esp = models.CharField(verbose_name=_("ESP"), max_length=255)
     metadata = models.JSONField()
@@ -89,7 +229,47 @@ class Log(models.Model):
     raw = models.JSONField()
 
     class Meta:
-        ordering = ["email", "timestamp"]
+        # Ordering by "email" would join Email to sort by its date_sent
+        ordering = ["email_id", "timestamp"]
+        indexes = [
+            # Matches the ordering, so an email's logs are read in index order
+            models.Index(
+                fields=["email", "timestamp"], name="email_log_log_email_time"
+            ),
+        ]
+        constraints = [
+            # ESPs retry webhooks, so the same event can be reported twice
+            models.UniqueConstraint(
+                fields=["esp", "event_id"],
+                condition=~models.Q(event_id=""),
+                name="email_log_log_unique_event",
+            ),
+        ]
 
     def __str__(self):
         return self.type
+
+
+class PendingEvent(models.Model):
+    """Tracking event received before the email it belongs to was logged"""
+
+    esp = models.CharField(verbose_name=_("ESP"), max_length=255)
+    message_id = models.CharField(max_length=255, db_index=True)
+    event_type = models.CharField(max_length=255)
+    metadata = models.JSONField()
+    timestamp = models.DateTimeField()
+    event_id = models.TextField(blank=True, default="")
+    mta_response = models.TextField(verbose_name=_("MTA Response"), null=True)
+    reject_reason = models.TextField(null=True)
+    tags = models.JSONField()
+    user_agent = models.TextField(null=True)
+    click_url = models.URLField(verbose_name="Click URL", null=True, max_length=4192)
+    esp_event = models.JSONField()
+    received = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("pending event")
+        verbose_name_plural = _("pending events")
+
+    def __str__(self):
+        return self.event_type
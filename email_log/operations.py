@@ -0,0 +1,46 @@
+"""Migration operations that adapt to the database they run on"""
+
+from django.db import NotSupportedError
+from django.db.migrations.operations import AddIndex
+
+
+class AddIndexConcurrently(AddIndex):
+    """Add an index without blocking writes to the table on PostgreSQL
+
+    PostgreSQL builds the index with ``CREATE INDEX CONCURRENTLY``, which
+    can't run in a transaction, so migrations using this operation must set
+    ``atomic = False``.  Tables converted by ``partition_email_log`` can't be
+    indexed concurrently and are indexed like other databases, with
+    ``AddIndex``.
+
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            options = self.options(schema_editor, model)
+            schema_editor.add_index(model, self.index, **options)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            options = self.options(schema_editor, model)
+            schema_editor.remove_index(model, self.index, **options)
+
+    def options(self, schema_editor, model) -> dict:
+        connection = schema_editor.connection
+        if connection.vendor != "postgresql":
+            return {}
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relkind FROM pg_class WHERE oid = %s::regclass",
+                [model._meta.db_table],
+            )
+            if cursor.fetchone()[0] == "p":
+                return {}
+        if connection.in_atomic_block:
+            raise NotSupportedError(
+                f"{self.__class__.__name__} can't run in a transaction on "
+                "PostgreSQL (set atomic = False on the migration)."
+            )
+        return {"concurrently": True}
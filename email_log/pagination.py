@@ -0,0 +1,47 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .conf import settings
+
+
+def estimate_count(queryset):
+    """Return the planner's row estimate of an unfiltered queryset.
+
+    Only PostgreSQL keeps an estimate (in ``pg_class.reltuples``, summed over
+    the partitions of a partitioned table); ``None`` is returned for other
+    databases and for filtered querysets.
+
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql" or queryset.query.where:
+        return None
+    table = connection.ops.quote_name(queryset.model._meta.db_table)
+    with connection.cursor() as cursor:
+        # reltuples is -1 for tables that were never analyzed
+        cursor.execute(
+            "SELECT SUM(GREATEST(reltuples, 0)) FROM pg_class "
+            "WHERE oid = %s::regclass OR oid IN ("
+            "SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)",
+            [table, table],
+        )
+        return int(cursor.fetchone()[0] or 0)
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that doesn't count every row of a large table
+
+    Counting stops at ``EMAIL_LOG_ADMIN_COUNT_LIMIT`` rows.  Unfiltered lists
+    larger than that use PostgreSQL's estimate of the number of rows instead.
+
+    """
+
+    @cached_property
+    def count(self):
+        limit = settings.EMAIL_LOG_ADMIN_COUNT_LIMIT
+        if limit is None:
+            return super().count
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate > limit:
+            return estimate
+        return self.object_list.order_by()[:limit].count()
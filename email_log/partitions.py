@@ -0,0 +1,262 @@
+"""Range partitioning of the email log tables on PostgreSQL
+
+Emails are partitioned by ``date_sent`` and logs by ``timestamp``, with one
+partition per calendar month (in UTC).  Partitions are named after the month
+they start in, for example ``email_log_email_p202601``.
+
+"""
+
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.utils.dateparse import parse_datetime
+
+from .models import Email, Log
+from .search import SEARCH_FIELDS, trigram_index_sql
+
+PARTITIONED_MODELS = {
+    Email: "date_sent",
+    Log: "timestamp",
+}
+
+# Indexes created on the partitioned tables, which every partition inherits,
+# as (name, method, columns, condition of a partial index)
+PARTITIONED_INDEXES = {
+    Email: [
+        ("date_sent", "btree", ["date_sent"], None),
+        ("failed", "btree", ["date_sent"], "NOT ok"),
+        ("extra_headers", "gin", ["extra_headers"], None),
+        ("esp_message_id", "btree", ["esp_message_id"], None),
+    ],
+    Log: [
+        ("email_id_timestamp", "btree", ["email_id", "timestamp"], None),
+        ("timestamp", "btree", ["timestamp"], None),
+    ],
+}
+
+# PostgreSQL only allows unique indexes on a partitioned table that include
+# the partition key, so partitioned logs get this index instead of the unique
+# constraint on esp and event_id.  Retried tracking events keep their
+# timestamp, so they are still deduplicated.
+UNIQUE_EVENT_INDEX = "email_log_log_unique_event_part_idx"
+
+UPPER_BOUND_RE = re.compile(r"\bTO \('([^']+)'\)")
+
+
+def month_start(value: datetime) -> datetime:
+    """Return the start of the UTC month that ``value`` falls in."""
+    value = value.astimezone(dt_timezone.utc)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    """Return the start of the month ``months`` after the month of ``value``."""
+    index = value.year * 12 + value.month - 1 + months
+    return month_start(value).replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(table: str, start: datetime) -> str:
+    return f"{table}_p{start:%Y%m}"
+
+
+def create_partition_sql(quote, table: str, start: datetime) -> str:
+    """Return SQL creating the partition for the month starting at ``start``."""
+    end = add_months(start, 1)
+    return (
+        f"CREATE TABLE IF NOT EXISTS {quote(partition_name(table, start))} "
+        f"PARTITION OF {quote(table)} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+
+
+def legacy_check_name(model) -> str:
+    column = model._meta.get_field(PARTITIONED_MODELS[model]).column
+    return f"{model._meta.db_table}_legacy_{column}_check"
+
+
+def legacy_pkey_name(model) -> str:
+    return f"{model._meta.db_table}_legacy_pkey"
+
+
+def unique_event_index_sql(
+    quote, table: str, name=UNIQUE_EVENT_INDEX, concurrently=False
+) -> str:
+    columns = ", ".join(quote(column) for column in ("esp", "event_id", "timestamp"))
+    return (
+        f"CREATE UNIQUE INDEX {'CONCURRENTLY ' if concurrently else ''}"
+        f"IF NOT EXISTS {quote(name)} "
+        f"ON {quote(table)} ({columns}) WHERE {quote('event_id')} <> ''"
+    )
+
+
+def partitioned_index_sql(
+    quote, table: str, index: str, definition, concurrently=False
+) -> str:
+    """Return SQL creating an index of ``PARTITIONED_INDEXES`` on ``table``."""
+    name, method, columns, condition = definition
+    columns = ", ".join(quote(column) for column in columns)
+    where = f" WHERE {condition}" if condition else ""
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+        f"{quote(index)} ON {quote(table)} USING {method} ({columns}){where}"
+    )
+
+
+def prepare_indexes_sql(quote, model) -> list:
+    """Return SQL building the partitioned table's indexes on a model's table.
+
+    The statements are meant to run outside a transaction before
+    ``convert_table_sql``.  The indexes are built concurrently, so writes go
+    on meanwhile, and the indexes of the partitioned table take them over
+    when the table is attached instead of being built while it is locked.
+    Indexes left invalid by an interrupted run are dropped first.
+
+    """
+    table = model._meta.db_table
+    column = model._meta.get_field(PARTITIONED_MODELS[model]).column
+    pk = model._meta.pk.column
+    t = quote(table)
+    pkey = legacy_pkey_name(model)
+    indexes = {
+        # Becomes the primary key, which the partitioned table's primary key
+        # can only take over if it is one
+        pkey: (
+            f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {quote(pkey)} "
+            f"ON {t} ({quote(pk)}, {quote(column)})"
+        ),
+    }
+    for definition in PARTITIONED_INDEXES[model]:
+        index = f"{table}_legacy_{definition[0]}_idx"
+        indexes[index] = partitioned_index_sql(
+            quote, table, index, definition, concurrently=True
+        )
+    if model is Log:
+        index = f"{table}_legacy_unique_event_idx"
+        indexes[index] = unique_event_index_sql(quote, table, index, concurrently=True)
+    statements = []
+    for index, sql in indexes.items():
+        statements.append(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(index)}")
+        statements.append(sql)
+    return statements
+
+
+def check_boundary_sql(quote, model, boundary: datetime) -> list:
+    """Return SQL checking that a model's table only has rows before boundary.
+
+    Each statement is meant to run in its own transaction before
+    ``convert_table_sql``.  Validating the CHECK constraint scans the whole
+    table, but only blocks other schema changes, and it lets ATTACH
+    PARTITION skip that scan once the table is locked.
+
+    """
+    table = model._meta.db_table
+    column = model._meta.get_field(PARTITIONED_MODELS[model]).column
+    t, c, check = quote(table), quote(column), quote(legacy_check_name(model))
+    return [
+        # Left behind by a conversion that failed after this step
+        f"ALTER TABLE {t} DROP CONSTRAINT IF EXISTS {check}",
+        (
+            f"ALTER TABLE {t} ADD CONSTRAINT {check} "
+            f"CHECK ({c} IS NOT NULL AND {c} < '{boundary.isoformat()}') NOT VALID"
+        ),
+        f"ALTER TABLE {t} VALIDATE CONSTRAINT {check}",
+    ]
+
+
+def convert_table_sql(quote, model, boundary: datetime, search_indexes=False) -> list:
+    """Return SQL turning a model's table into a partitioned table.
+
+    The existing table becomes the partition for all rows before
+    ``boundary``, which ``check_boundary_sql`` must have checked first, and
+    foreign keys pointing at it are dropped because PostgreSQL can only
+    reference a partitioned table through a unique constraint that includes
+    the partition key.  Its primary key is replaced by the one
+    ``prepare_indexes_sql`` built on the id and the partition key.  The
+    partitioned table gets the trigram indexes of ``index_email_log`` if
+    ``search_indexes`` is true.
+
+    """
+    table = model._meta.db_table
+    column = model._meta.get_field(PARTITIONED_MODELS[model]).column
+    pk = model._meta.pk.column
+    legacy = f"{table}_legacy"
+    sequence = f"{table}_{pk}_partitioned_seq"
+    check = legacy_check_name(model)
+    t, c, p, old = quote(table), quote(column), quote(pk), quote(legacy)
+    pkey = quote(legacy_pkey_name(model))
+    bound = boundary.isoformat()
+    statements = [
+        f"LOCK TABLE {t} IN ACCESS EXCLUSIVE MODE",
+        f"ALTER TABLE {t} RENAME TO {old}",
+        (
+            "DO $$ DECLARE fk record; BEGIN "
+            "FOR fk IN SELECT conrelid::regclass AS tbl, conname FROM pg_constraint "
+            f"WHERE contype = 'f' AND confrelid = '{old}'::regclass LOOP "
+            "EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', fk.tbl, fk.conname); "
+            "END LOOP; END $$"
+        ),
+        (
+            "DO $$ DECLARE pk name; BEGIN "
+            "SELECT conname INTO pk FROM pg_constraint "
+            f"WHERE contype = 'p' AND conrelid = '{old}'::regclass; "
+            f"EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', '{old}', pk); "
+            "END $$"
+        ),
+        f"ALTER TABLE {old} ADD CONSTRAINT {pkey} PRIMARY KEY USING INDEX {pkey}",
+        f"CREATE TABLE {t} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE ({c})",
+        f"ALTER TABLE {t} ADD PRIMARY KEY ({p}, {c})",
+        f"CREATE SEQUENCE {quote(sequence)} OWNED BY {t}.{p}",
+        (
+            f"SELECT setval('{quote(sequence)}', "
+            f"(SELECT COALESCE(MAX({p}), 0) + 1 FROM {old}), false)"
+        ),
+        f"ALTER TABLE {t} ALTER COLUMN {p} SET DEFAULT nextval('{quote(sequence)}')",
+        f"ALTER TABLE {old} ALTER COLUMN {p} DROP IDENTITY IF EXISTS",
+        f"ALTER TABLE {old} ALTER COLUMN {p} DROP DEFAULT",
+        (
+            f"ALTER TABLE {t} ATTACH PARTITION {old} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{bound}')"
+        ),
+        f"ALTER TABLE {old} DROP CONSTRAINT {quote(check)}",
+    ]
+    for definition in PARTITIONED_INDEXES[model]:
+        index = f"{table}_{definition[0]}_part_idx"
+        statements.append(partitioned_index_sql(quote, table, index, definition))
+    if model is Log:
+        statements.append(unique_event_index_sql(quote, table))
+    if search_indexes:
+        statements.extend(
+            trigram_index_sql(quote, table, field, partitioned=True)
+            for field in SEARCH_FIELDS
+        )
+    return statements
+
+
+def detach_partition_sql(quote, table: str, partition: str) -> str:
+    return f"ALTER TABLE {quote(table)} DETACH PARTITION {quote(partition)}"
+
+
+def drop_partition_sql(quote, partition: str) -> str:
+    return f"DROP TABLE {quote(partition)}"
+
+
+def upper_bound(expression: str):
+    """Return the upper bound of a partition bound expression, if it has one."""
+    match = UPPER_BOUND_RE.search(expression)
+    return parse_datetime(match.group(1)) if match else None
+
+
+def is_partitioned(cursor, table: str) -> bool:
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [table])
+    return cursor.fetchone()[0] == "p"
+
+
+def get_partitions(cursor, table: str) -> list:
+    """Return ``(name, upper bound)`` for every partition of a table."""
+    cursor.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = %s::regclass ORDER BY c.relname",
+        [table],
+    )
+    return [(name, upper_bound(bound)) for name, bound in cursor.fetchall()]
@@ -0,0 +1,87 @@
+"""Policies deciding which email messages are logged
+
+A policy is a callable that takes an email message and returns one of the
+decisions below, or another policy to ask instead.  Set the
+``EMAIL_LOG_POLICY`` setting to a policy, or to its dotted path, to use it.
+
+"""
+
+import random
+from functools import lru_cache
+
+from django.utils.module_loading import import_string
+
+from .conf import settings
+
+#: Log the message, with its attachments if ``EMAIL_LOG_SAVE_ATTACHMENTS``
+LOG = "log"
+#: Log the message without its attachments
+LOG_WITHOUT_ATTACHMENTS = "log_without_attachments"
+#: Log the message only if sending it fails
+LOG_IF_FAILED = "log_if_failed"
+#: Don't log the message
+SKIP = "skip"
+
+DECISIONS = (LOG, LOG_WITHOUT_ATTACHMENTS, LOG_IF_FAILED, SKIP)
+#: Decisions logging the message before it is sent
+LOGGED = (LOG, LOG_WITHOUT_ATTACHMENTS)
+
+
+def get_decision(message) -> str:
+    """Return what the ``EMAIL_LOG_POLICY`` setting decides for a message."""
+    policy = settings.EMAIL_LOG_POLICY
+    if policy is None:
+        return LOG
+    if isinstance(policy, str):
+        policy = _import_policy(policy)
+    decision = policy
+    while callable(decision):
+        decision = decision(message)
+    if decision not in DECISIONS:
+        raise ValueError(f"Unknown email log decision: {decision!r}")
+    return decision
+
+
+@lru_cache(maxsize=None)
+def _import_policy(path: str):
+    return import_string(path)
+
+
+def log_all(message) -> str:
+    return LOG
+
+
+def log_failures(message) -> str:
+    return LOG_IF_FAILED
+
+
+def sample(rate: float, otherwise=SKIP):
+    """Return a policy logging a ``rate`` fraction of messages at random."""
+
+    def policy(message):
+        return LOG if random.random() < rate else otherwise
+
+    return policy
+
+
+def by_header(name: str, decisions: dict, default=LOG):
+    """Return a policy deciding by the value of a message's ``name`` header."""
+
+    def policy(message):
+        values = [
+            value
+            for header, value in message.extra_headers.items()
+            if header.lower() == name.lower()
+        ]
+        return decisions.get(values[0] if values else None, default)
+
+    return policy
+
+
+def by_sender(decisions: dict, default=LOG):
+    """Return a policy deciding by the message's sender."""
+
+    def policy(message):
+        return decisions.get(message.from_email, default)
+
+    return policy
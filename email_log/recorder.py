@@ -0,0 +1,351 @@
+"""Turn outgoing email messages into Email and Attachment records
+
+These functions keep no state, so the email backends and the Anymail signal
+handlers share them without creating a backend (and its wrapped connection).
+
+"""
+
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.mime.base import MIMEBase
+from typing import Dict
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage
+from django.db import router, transaction
+
+from .attachments import content_file, file_digest, mime_file
+from .compression import COMPRESSED_FIELDS, compress, compress_email
+from .conf import settings
+from .models import Attachment, Content, Email, Recipient, normalize_address
+
+TRUNCATION_MARKER = "... [truncated]"
+
+RECIPIENT_FIELDS = {
+    "recipients": Recipient.TO,
+    "cc_recipients": Recipient.CC,
+    "bcc_recipients": Recipient.BCC,
+}
+
+
+def build_email(message: EmailMessage, extra_headers: dict = None) -> Email:
+    """Return an unsaved Email record for the email message.
+
+    The logged headers default to the message's ``extra_headers``.  Fields
+    are stored as the ``EMAIL_LOG_CAPTURE`` setting says, in shared contents
+    if ``EMAIL_LOG_DEDUPLICATE_BODIES`` is set, and compressed if
+    ``EMAIL_LOG_COMPRESS`` is set.  Save the email's contents with
+    ``save_contents`` before saving the email.
+
+    """
+    if extra_headers is None:
+        extra_headers = message.extra_headers
+    fields = {
+        "recipients": "; ".join(message.to),
+        "cc_recipients": "; ".join(message.cc) if message.cc else "",
+        "bcc_recipients": "; ".join(message.bcc) if message.bcc else "",
+        "reply_to": "; ".join(message.reply_to) if message.reply_to else "",
+        "extra_headers": extra_headers,
+        "subject": message.subject,
+        "body": message.body,
+        "html_message": get_html_message(message),
+    }
+    email = Email(from_email=message.from_email, **capture_fields(fields, message))
+    if settings.EMAIL_LOG_DEDUPLICATE_BODIES:
+        deduplicate_email(email)
+    if settings.EMAIL_LOG_COMPRESS:
+        compress_email(email)
+    return email
+
+
+def capture_fields(fields: dict, message: EmailMessage) -> dict:
+    """Apply the ``EMAIL_LOG_CAPTURE`` policy of every field to its value.
+
+    A policy of ``False`` stores an empty value, an integer truncates the
+    value to that many characters (every header's value for
+    ``extra_headers``) ending in ``TRUNCATION_MARKER``, and a callable is
+    called with the value and the message and returns the value to store.
+
+    """
+    policies = settings.EMAIL_LOG_CAPTURE
+    unknown = set(policies) - set(fields)
+    if unknown:
+        raise ImproperlyConfigured(
+            f"EMAIL_LOG_CAPTURE has unknown fields: {', '.join(sorted(unknown))}"
+        )
+    for name, policy in policies.items():
+        value = fields[name]
+        if policy is True:
+            continue
+        if policy is False:
+            fields[name] = {} if isinstance(value, dict) else ""
+        elif callable(policy):
+            fields[name] = policy(value, message)
+        elif isinstance(value, dict):
+            fields[name] = {key: truncate(item, policy) for key, item in value.items()}
+        else:
+            fields[name] = truncate(value, policy)
+    return fields
+
+
+def truncate(value, length: int):
+    """Shorten a string to ``length`` characters, ending it with a marker."""
+    if not isinstance(value, str) or len(value) <= length:
+        return value
+    end = max(length - len(TRUNCATION_MARKER), 0)
+    return value[:end] + TRUNCATION_MARKER
+
+
+def deduplicate_email(email: Email):
+    """Move the non-empty body and HTML message of an email to contents.
+
+    The contents are unsaved, keyed by the digest of their text, so that
+    emails with the same text share one content.
+
+    """
+    for name in COMPRESSED_FIELDS:
+        text = getattr(email, name)
+        if text:
+            content = Content(digest=hashlib.sha256(text.encode()).hexdigest())
+            if settings.EMAIL_LOG_COMPRESS:
+                content.compressed = compress(text)
+            else:
+                content.text = text
+            setattr(email, f"{name}_content", content)
+            setattr(email, name, "")
+
+
+def get_contents(emails: list) -> list:
+    """Return the distinct contents that built emails refer to."""
+    contents = {}
+    for email in emails:
+        for name in COMPRESSED_FIELDS:
+            if getattr(email, f"{name}_content_id") is not None:
+                content = getattr(email, f"{name}_content")
+                contents[content.digest] = content
+    return list(contents.values())
+
+
+def save_contents(emails: list):
+    """Save the contents of built emails, skipping the ones already saved.
+
+    The contents are locked until the end of the transaction, which must also
+    save the emails, so that ``prune_email_log`` can't delete one that was
+    already saved before an email refers to it.  Contents it deleted before
+    they were locked are saved again.
+
+    """
+    contents = get_contents(emails)
+    if not contents:
+        return
+    Content.objects.bulk_create(contents, ignore_conflicts=True)
+    locked = set(
+        Content.objects.select_for_update()
+        .filter(pk__in=[content.pk for content in contents])
+        .values_list("pk", flat=True)
+    )
+    deleted = [content for content in contents if content.pk not in locked]
+    if deleted:
+        Content.objects.bulk_create(deleted, ignore_conflicts=True)
+
+
+@contextmanager
+def saving_contents(emails: list):
+    """Save the contents of built emails for the block that saves the emails.
+
+    Emails with contents are saved in a transaction, see ``save_contents``.
+
+    """
+    if not get_contents(emails):
+        yield
+        return
+    with transaction.atomic(using=router.db_for_write(Content)):
+        save_contents(emails)
+        yield
+
+
+def get_recipients(emails: list) -> list:
+    """Return the unsaved recipients of saved emails.
+
+    Addresses are read from the emails' fields, so recipients follow the
+    ``EMAIL_LOG_CAPTURE`` policy of those fields; truncated addresses are
+    left out.
+
+    """
+    recipients = []
+    max_length = Recipient._meta.get_field("address").max_length
+    for email in emails:
+        for name, kind in RECIPIENT_FIELDS.items():
+            addresses = {
+                normalize_address(address)[:max_length]
+                for address in getattr(email, name).split("; ")
+                if not address.endswith(TRUNCATION_MARKER)
+            }
+            recipients.extend(
+                Recipient(email=email, address=address, kind=kind)
+                for address in sorted(addresses)
+                if address
+            )
+    return recipients
+
+
+def save_recipients(emails: list):
+    """Save the recipients of saved emails if ``EMAIL_LOG_RECIPIENTS`` is set."""
+    if settings.EMAIL_LOG_RECIPIENTS:
+        Recipient.objects.bulk_create(get_recipients(emails))
+
+
+def get_html_message(message: EmailMessage) -> str:
+    """Retrieve html message from the email message."""
+    if hasattr(message, "alternatives") and len(message.alternatives) > 0:
+        for alternative in message.alternatives:
+            if alternative[1] == "text/html":
+                return alternative[0]
+    return ""
+
+
+def get_message_headers(message: EmailMessage) -> Dict[str, str]:
+    """Return the headers of a message that aren't saved in other fields
+
+    The headers are taken from the message's attributes, as
+    ``EmailMessage.message()`` does, because rendering the MIME message would
+    encode the body and every attachment.  The ``Message-ID`` a rendered
+    message gets isn't the one the ESP sent, so it isn't included.
+
+    """
+    headers = {}
+    for name, values in (("Cc", message.cc), ("Reply-To", message.reply_to)):
+        if values:
+            headers[name] = ", ".join(str(value) for value in values)
+    return headers | message.extra_headers
+
+
+def log_attachments(email: Email, message: EmailMessage):
+    """Retrieve all attachments from email and create them."""
+    attachment_files = {}
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            attachment_files[attachment.get_filename()] = {
+                "file": mime_file(attachment),
+            }
+        else:
+            name, content, type = attachment
+            attachment_files[name] = {
+                "file": content_file(content),
+            }
+            if type != "application/octet-stream":
+                attachment_files[name].update({"mimetype": type})
+
+    if attachment_files:
+        _create_attachments(email, attachment_files)
+
+
+def _create_attachments(email: Email, files: dict):
+    """Write attachments to storage, then save them with one query.
+
+    If saving to the database fails, the files that were written are
+    deleted again.
+
+    """
+    pending = []
+    for filename, filedata in files.items():
+        attachment = Attachment(name=filename, email=email)
+        if filedata.get("mimetype"):
+            attachment.mimetype = filedata["mimetype"]
+        pending.append((attachment, filedata.get("file")))
+    attachments = [attachment for attachment, content in pending]
+
+    if not settings.EMAIL_LOG_ATTACHMENTS_DEDUPLICATE:
+        _save_attachments(attachments, pending, [])
+        return
+    using = router.db_for_write(Attachment)
+    with transaction.atomic(using=using, savepoint=False):
+        pending, copies = _reuse_stored_files(pending)
+        _save_attachments(attachments, pending, copies)
+
+
+def _save_attachments(attachments: list, pending: list, copies: list):
+    written = _write_files(pending)
+    for attachment, original in copies:
+        attachment.file.name = original.file.name
+
+    try:
+        Attachment.objects.bulk_create(attachments)
+    except Exception:
+        _delete_files(written)
+        raise
+
+
+def _reuse_stored_files(pending: list):
+    """Point attachments at already stored files with the same content.
+
+    Return the attachments whose content still has to be written, and
+    pairs of attachments that share content with one of those.  The
+    attachments of the reused files are locked until the end of the
+    transaction, which must also save the new attachments, so that the file
+    of one deleted meanwhile isn't deleted while it is being reused.
+
+    """
+    for attachment, content in pending:
+        attachment.digest = file_digest(content)
+    stored = dict(
+        Attachment.objects.select_for_update()
+        .filter(digest__in={attachment.digest for attachment, _ in pending})
+        .order_by("pk")
+        .values_list("digest", "file")
+    )
+    to_write, copies, first_by_digest = [], [], {}
+    for attachment, content in pending:
+        if attachment.digest in stored:
+            attachment.file.name = stored[attachment.digest]
+        elif attachment.digest in first_by_digest:
+            copies.append((attachment, first_by_digest[attachment.digest]))
+        else:
+            first_by_digest[attachment.digest] = attachment
+            to_write.append((attachment, content))
+    return to_write, copies
+
+
+def _write_files(pending: list) -> list:
+    """Write attachment contents to storage and return the written files.
+
+    Files are written by a thread pool when EMAIL_LOG_ATTACHMENTS_WORKERS
+    is more than one.  If any write fails, the files that were written are
+    deleted and the error is raised.
+
+    """
+    workers = min(settings.EMAIL_LOG_ATTACHMENTS_WORKERS, len(pending))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            outcomes = list(pool.map(_write_attachment_file, pending))
+    else:
+        outcomes = [_write_attachment_file(item) for item in pending]
+
+    written = [file for file, error in outcomes if error is None]
+    errors = [error for file, error in outcomes if error is not None]
+    if errors:
+        _delete_files(written)
+        raise errors[0]
+    return written
+
+
+def _write_attachment_file(item: tuple):
+    """Write one attachment's content, returning its file or the error."""
+    attachment, content = item
+    try:
+        attachment.file.save(attachment.name, content=content, save=False)
+    except Exception as error:
+        return None, error
+    return attachment.file, None
+
+
+def _delete_files(files: list):
+    for file in files:
+        try:
+            file.storage.delete(file.name)
+        except Exception:
+            logging.error(
+                "Failed to delete attachment file %s", file.name, exc_info=True
+            )
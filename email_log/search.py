@@ -0,0 +1,161 @@
+"""Indexed search of logged emails
+
+Search indexes are created by the ``index_email_log`` command.  On
+PostgreSQL the searched columns get trigram GIN indexes on their upper-cased
+text, which the ``icontains`` lookups of the admin search use as they are.
+On SQLite they are copied into an FTS5 table with the trigram tokenizer,
+kept up to date by triggers, which ``search_emails`` queries.
+
+"""
+
+from django.db import connections
+from django.db.models.expressions import RawSQL
+from django.utils.text import smart_split, unescape_string_literal
+
+SEARCH_FIELDS = (
+    "subject",
+    "body",
+    "recipients",
+    "cc_recipients",
+    "bcc_recipients",
+    "extra_headers",
+)
+
+FTS_TABLE = "email_log_email_fts"
+
+FTS_TRIGGERS = tuple(
+    f"{FTS_TABLE}_{suffix}" for suffix in ("insert", "delete", "update")
+)
+
+# The trigram tokenizer can't match anything shorter
+MIN_TERM_LENGTH = 3
+
+
+def trigram_index_name(table: str, field: str, partitioned=False) -> str:
+    # Indexes of partitioned tables are named like the ones partition_email_log
+    # creates, so they don't clash with those of the partition made from the
+    # old table.
+    return f"{table}_{field}_trgm{'_part_idx' if partitioned else ''}"
+
+
+def trigram_index_sql(quote, table: str, field: str, partitioned=False):
+    """Return SQL creating a trigram index matching ``field__icontains``.
+
+    Indexes of tables that aren't partitioned are built concurrently.
+
+    """
+    index = quote(trigram_index_name(table, field, partitioned))
+    return (
+        f"CREATE INDEX {'' if partitioned else 'CONCURRENTLY '}IF NOT EXISTS "
+        f"{index} ON {quote(table)} USING gin "
+        f"((UPPER({quote(field)}::text)) gin_trgm_ops)"
+    )
+
+
+def drop_trigram_indexes_sql(quote, table: str) -> list:
+    # Dropping the index of a partitioned table drops the indexes of its
+    # partitions, so those are dropped first.
+    return [
+        f"DROP INDEX IF EXISTS {quote(trigram_index_name(table, field, partitioned))}"
+        for partitioned in (True, False)
+        for field in SEARCH_FIELDS
+    ]
+
+
+def has_trigram_indexes(cursor, table: str) -> bool:
+    """Return whether ``table`` has the search indexes, on PostgreSQL."""
+    names = [
+        trigram_index_name(table, "subject", partitioned)
+        for partitioned in (True, False)
+    ]
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_class WHERE relname = ANY(%s))", [names]
+    )
+    return cursor.fetchone()[0]
+
+
+def fts_table_sql(quote, table: str) -> list:
+    """Return SQL creating the FTS5 table of ``table`` and its triggers."""
+    fts = quote(FTS_TABLE)
+    columns = ", ".join(quote(field) for field in SEARCH_FIELDS)
+
+    def values(row):
+        return ", ".join(f"{row}.{quote(field)}" for field in SEARCH_FIELDS)
+
+    on_insert, on_delete, on_update = FTS_TRIGGERS
+    changed = " OR ".join(
+        f"old.{quote(field)} IS NOT new.{quote(field)}" for field in SEARCH_FIELDS
+    )
+    insert = f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {values('new')});"
+    delete = (
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) "
+        f"VALUES ('delete', old.id, {values('old')});"
+    )
+    return [
+        (
+            f"CREATE VIRTUAL TABLE {fts} USING fts5({columns}, "
+            f"content={quote(table)}, content_rowid='id', tokenize='trigram')"
+        ),
+        f"CREATE TRIGGER {quote(on_insert)} AFTER INSERT "
+        f"ON {quote(table)} BEGIN {insert} END",
+        f"CREATE TRIGGER {quote(on_delete)} AFTER DELETE "
+        f"ON {quote(table)} BEGIN {delete} END",
+        # Marking an email as sent doesn't reindex it
+        f"CREATE TRIGGER {quote(on_update)} AFTER UPDATE "
+        f"ON {quote(table)} WHEN {changed} BEGIN {delete} {insert} END",
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+
+def drop_fts_table_sql(quote) -> list:
+    return [f"DROP TRIGGER IF EXISTS {quote(name)}" for name in FTS_TRIGGERS] + [
+        f"DROP TABLE IF EXISTS {quote(FTS_TABLE)}"
+    ]
+
+
+def get_search_terms(search_term: str) -> list:
+    """Split a search like the admin does, keeping quoted phrases together."""
+    terms = []
+    for bit in smart_split(search_term):
+        if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+            bit = unescape_string_literal(bit)
+        terms.append(bit)
+    return terms
+
+
+def has_fts_table(connection) -> bool:
+    """Return whether the FTS5 table exists and is kept up to date.
+
+    SQLite drops the triggers when a migration rebuilds the email table, after
+    which the table misses new emails until ``index_email_log`` is run again.
+
+    """
+    names = (FTS_TABLE,) + FTS_TRIGGERS
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name IN (%s, %s, %s, %s)",
+            names,
+        )
+        return cursor.fetchone()[0] == len(names)
+
+
+def search_emails(queryset, search_term: str):
+    """Return the emails containing every term of a search.
+
+    The FTS5 table is used on SQLite; ``None`` is returned if it can't be,
+    in which case the search falls back to ``icontains`` lookups.
+
+    """
+    connection = connections[queryset.db]
+    terms = get_search_terms(search_term)
+    if connection.vendor != "sqlite" or not terms:
+        return None
+    if min(len(term) for term in terms) < MIN_TERM_LENGTH:
+        return None
+    if not has_fts_table(connection):
+        return None
+    fts = connection.ops.quote_name(FTS_TABLE)
+    match = " AND ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    return queryset.filter(
+        pk__in=RawSQL(f"SELECT rowid FROM {fts} WHERE {fts} MATCH %s", [match])
+    )
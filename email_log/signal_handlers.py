@@ -1,18 +1,32 @@
-from typing import TYPE_CHECKING, Any, Type
+from datetime import timedelta
+from functools import partial
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set, Type
 
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.core.mail.backends.base import BaseEmailBackend
 from django.db import transaction
+from django.utils.timezone import now
 
-from email_log.backends import EmailBackend as EmailLogBackend
-from email_log.models import Email, Log as EmailLog
+from email_log.conf import settings as app_settings
+from email_log.models import Attachment, Email, Log as EmailLog, PendingEvent
+from email_log.policies import LOG, LOG_IF_FAILED, SKIP, get_decision
+from email_log.recorder import (
+    build_email,
+    get_message_headers,
+    log_attachments,
+    save_contents,
+    save_recipients,
+)
 
 if TYPE_CHECKING:  # pragma: no cover
     from anymail.webhooks.base import AnymailCoreWebhookView
     from anymail.message import AnymailStatus
     from anymail.signals import AnymailTrackingEvent
 
+# Anymail send statuses of recipients the message wasn't sent to
+FAILED_STATUSES = {"failed", "invalid", "rejected"}
+
 
 def handle_tracking_event(
     sender: "Type[AnymailCoreWebhookView]",
@@ -20,25 +34,123 @@ def handle_tracking_event(
     esp_name: str,
     **kwargs: Any,
 ) -> None:
-    if (
-        email := Email.objects.filter(extra_headers__anymail_id=event.message_id)
-        .only("pk")
-        .first()
-    ):
-        EmailLog.objects.create(
-            email=email,
-            type=event.event_type,
-            esp=esp_name,
-            metadata=event.metadata,
-            timestamp=event.timestamp,
-            event_id=event.event_id,
-            reject_reason=event.reject_reason,
-            mta_response=event.mta_response,
-            tags=event.tags,
-            user_agent=event.user_agent,
-            click_url=event.click_url,
-            raw=event.esp_event,
+    handle_tracking_events([event], esp_name)
+
+
+def handle_tracking_events(
+    events: "Iterable[AnymailTrackingEvent]", esp_name: str
+) -> List[EmailLog]:
+    """Log a batch of tracking events with one query per batch
+
+    The emails of all events are looked up with a single query and the logs
+    are saved with a single ``bulk_create``.  Events already logged for the
+    ESP are skipped, so retried webhooks don't log an event twice.  Events
+    without a matching email are ignored, or kept as pending events if
+    ``EMAIL_LOG_PENDING_EVENTS_TTL`` is set.  Returns the logs passed to
+    ``bulk_create``, which have no primary keys.
+
+    """
+    events = [event for event in events if event.message_id]
+    if not events:
+        return []
+    email_ids = _get_email_ids({event.message_id for event in events})
+    logs = [
+        _build_log(email_ids[event.message_id], event, esp_name)
+        for event in events
+        if event.message_id in email_ids
+    ]
+    if app_settings.EMAIL_LOG_PENDING_EVENTS_TTL is not None:
+        PendingEvent.objects.bulk_create(
+            _build_pending_event(event, esp_name)
+            for event in events
+            if event.message_id not in email_ids
         )
+    return EmailLog.objects.bulk_create(logs, ignore_conflicts=True)
+
+
+def reconcile_pending_events(
+    message_ids: Optional[Iterable[str]] = None, batch_size: int = 1000
+) -> int:
+    """Log the pending events whose emails have been logged since
+
+    Only the events of ``message_ids`` are reconciled if given.  Otherwise
+    every pending event is, and events older than
+    ``EMAIL_LOG_PENDING_EVENTS_TTL`` seconds are deleted first.  Events are
+    processed ``batch_size`` at a time.  Returns the number of events logged.
+
+    """
+    pending = PendingEvent.objects.order_by("pk")
+    if message_ids is not None:
+        pending = pending.filter(message_id__in=message_ids)
+    elif app_settings.EMAIL_LOG_PENDING_EVENTS_TTL is not None:
+        expired = now() - timedelta(seconds=app_settings.EMAIL_LOG_PENDING_EVENTS_TTL)
+        PendingEvent.objects.filter(received__lt=expired).delete()
+    reconciled = 0
+    last_pk = 0
+    while batch := list(pending.filter(pk__gt=last_pk)[:batch_size]):
+        last_pk = batch[-1].pk
+        email_ids = _get_email_ids({event.message_id for event in batch})
+        matched = [event for event in batch if event.message_id in email_ids]
+        if not matched:
+            continue
+        with transaction.atomic():
+            EmailLog.objects.bulk_create(
+                [
+                    _build_log(email_ids[event.message_id], event, event.esp)
+                    for event in matched
+                ],
+                ignore_conflicts=True,
+            )
+            PendingEvent.objects.filter(pk__in=[event.pk for event in matched]).delete()
+        reconciled += len(matched)
+    return reconciled
+
+
+def _get_email_ids(message_ids: Set[str]) -> Dict[str, int]:
+    """Return the primary keys of the emails with the given ESP message ids"""
+    email_ids = {}
+    # Emails are ordered newest first, so the newest email wins if several
+    # share a message id.
+    for message_id, pk in Email.objects.filter(
+        esp_message_id__in=message_ids
+    ).values_list("esp_message_id", "pk"):
+        email_ids.setdefault(message_id, pk)
+    return email_ids
+
+
+def _build_log(email_id: int, event: "AnymailTrackingEvent", esp_name: str):
+    """Return an unsaved log of a tracking event or pending event"""
+    return EmailLog(
+        email_id=email_id,
+        type=event.event_type,
+        esp=esp_name,
+        metadata=event.metadata,
+        timestamp=event.timestamp,
+        event_id=event.event_id or "",
+        reject_reason=event.reject_reason,
+        mta_response=event.mta_response,
+        tags=event.tags,
+        user_agent=event.user_agent,
+        click_url=event.click_url,
+        raw=event.esp_event,
+    )
+
+
+def _build_pending_event(event: "AnymailTrackingEvent", esp_name: str):
+    return PendingEvent(
+        esp=esp_name,
+        message_id=event.message_id,
+        event_type=event.event_type,
+        metadata=event.metadata,
+        timestamp=event.timestamp,
+        event_id=event.event_id or "",
+        reject_reason=event.reject_reason,
+        mta_response=event.mta_response,
+        tags=event.tags,
+        user_agent=event.user_agent,
+        click_url=event.click_url,
+        esp_event=event.esp_event,
+    )
 
 
 def log_successful_email(
@@ -48,34 +160,66 @@ def log_successful_email(
     esp_name: str,
     **kwargs: Any,
 ) -> None:
-    backend = EmailLogBackend()
-    message_headers = dict(message.message()._headers)
-    for key in list(message_headers.keys()):
-        if key.lower() in [
-            "content-type",
-            "date",
-            "from",
-            "mime-version",
-            "subject",
-            "to",
-        ]:
-            del message_headers[key]
+    decision = get_decision(message)
+    if decision == SKIP:
+        return
+    ok = True
+    if decision == LOG_IF_FAILED:
+        # Only failed messages are logged, as not sent
+        ok = not (status.status or set()) & FAILED_STATUSES
+        if ok:
+            return
+    message_id = status.message_id
+    # Messages to several recipients can get one id per recipient, which
+    # anymail reports as a set.  The ids are kept in the headers, but there is
+    # no single id to match the email's tracking events with.
+    if isinstance(message_id, set):
+        message_id = sorted(message_id, key=str)
+    email = build_email(
+        message,
+        extra_headers=get_message_headers(message) | {"anymail_id": message_id},
+    )
+    if isinstance(message_id, str):
+        email.esp_message_id = message_id
+    email.ok = ok
     with transaction.atomic():
-        email = Email.objects.create(
-            recipients="; ".join(message.to),
-            cc_recipients="; ".join(message.cc) if message.cc else "",
-            bcc_recipients="; ".join(message.bcc) if message.bcc else "",
-            reply_to="; ".join(message.reply_to) if message.reply_to else "",
-            extra_headers=(
-                message_headers
-                | message.extra_headers  # noqa: ignore W503
-                | {"anymail_id": status.message_id}  # noqa: ignore W503
-            ),
-            subject=message.subject,
-            body=message.body,
-            html_message=backend._get_html_message(message),
-            ok=True,
-        )
+        save_contents([email])
+        email.save()
+        save_recipients([email])
+
+        if decision == LOG and getattr(settings, "EMAIL_LOG_SAVE_ATTACHMENTS", True):
+            log_attachments(email=email, message=message)
+
+        if (
+            app_settings.EMAIL_LOG_PENDING_EVENTS_TTL is not None
+            and email.esp_message_id  # noqa: ignore W503
+        ):
+            # Tracking events can arrive before this transaction commits
+            transaction.on_commit(
+                partial(reconcile_pending_events, [email.esp_message_id])
+            )
+
+
+def delete_unreferenced_attachment_file(
+    sender: "Type[Attachment]",
+    instance: Attachment,
+    using: str,
+    **kwargs: Any,
+) -> None:
+    """Delete a deduplicated attachment's file once no attachment uses it
+
+    Sending a message that reuses the file locks the attachments using it
+    until its own attachment is saved, so once the deletion has committed,
+    the file is either referenced by a saved attachment or no longer reused.
+
+    """
+    if not instance.digest or not instance.file:
+        return
+    name = instance.file.name
+    storage = instance.file.storage
+
+    def delete_file():
+        if not Attachment.objects.using(using).filter(file=name).exists():
+            storage.delete(name)
 
-        if getattr(settings, "EMAIL_LOG_SAVE_ATTACHMENTS", True):
-            backend._log_attachments(email=email, message=message)
+    transaction.on_commit(delete_file, using=using)
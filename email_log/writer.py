@@ -0,0 +1,153 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.db import close_old_connections, connections
+
+BLOCK = "block"
+DROP = "drop"
+SYNC = "sync"
+
+
+class QueuedLogWriter:
+    """Write log records from a bounded in-process queue in a background thread
+
+    Records are handed to the ``write`` callable in batches of at most
+    ``flush_size`` records, at least every ``flush_interval`` seconds.  The
+    queue is full once it holds ``max_size`` records or, if ``max_bytes`` is
+    set, records whose ``sizeof`` adds up to more than ``max_bytes`` until
+    they are written.  When the queue is full, ``full_policy`` decides
+    whether ``put`` blocks until there is room, drops the record or writes it
+    in the calling thread.
+
+    """
+
+    def __init__(
+        self,
+        write,
+        max_size=0,
+        flush_size=100,
+        flush_interval=1.0,
+        full_policy=BLOCK,
+        max_bytes=0,
+        sizeof=len,
+    ):
+        if full_policy not in (BLOCK, DROP, SYNC):
+            raise ValueError(f"Unknown queue full policy: {full_policy!r}")
+        self.write = write
+        self.queue = queue.Queue(max_size)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.full_policy = full_policy
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._queued_bytes = 0
+        self._room = threading.Condition()
+
+    def put(self, record):
+        """Queue a record, starting the writer thread if needed."""
+        self.start()
+        block = self.full_policy == BLOCK
+        size = self._size([record])
+        if self._reserve(size, block):
+            try:
+                if block:
+                    self.queue.put(record)
+                else:
+                    self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self._release(size)
+        if self.full_policy == SYNC:
+            self._write([record])
+        else:
+            logging.warning("Email log queue is full, dropping log record")
+
+    def _size(self, records) -> int:
+        if not self.max_bytes:
+            return 0
+        return sum(self.sizeof(record) for record in records)
+
+    def _reserve(self, size, block) -> bool:
+        """Count ``size`` bytes as queued, waiting for room if ``block``."""
+        with self._room:
+            # A record larger than max_bytes is queued once the queue is empty
+            while self._queued_bytes and self._queued_bytes + size > self.max_bytes:
+                if not block:
+                    return False
+                self._room.wait()
+            self._queued_bytes += size
+            return True
+
+    def _release(self, size):
+        with self._room:
+            self._queued_bytes -= size
+            self._room.notify_all()
+
+    def start(self):
+        """Start the writer thread unless it is already running."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="email-log-writer", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        """Stop the writer thread and write any records still queued."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            atexit.unregister(self.stop)
+            self._stopping.set()
+            thread.join(timeout)
+            self._stopping.clear()
+        self.flush()
+
+    def flush(self):
+        """Write every queued record in the calling thread."""
+        while batch := self._get_batch(timeout=0):
+            self._write_queued(batch)
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                batch = self._get_batch(timeout=self.flush_interval)
+                if batch:
+                    self._write_queued(batch)
+                    close_old_connections()
+        finally:
+            connections.close_all()
+
+    def _get_batch(self, timeout):
+        """Collect up to ``flush_size`` records, waiting at most ``timeout``."""
+        batch = []
+        deadline = time.monotonic() + timeout
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_queued(self, batch):
+        # Records take up memory until they are written
+        self._write(batch)
+        self._release(self._size(batch))
+
+    def _write(self, batch):
+        try:
+            self.write(batch)
+        except Exception:
+            logging.error("Failed to save email to database (queue)", exc_info=True)
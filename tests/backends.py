@@ -1,3 +1,4 @@
+from django.core.mail.backends import locmem
 from django.core.mail.backends.base import BaseEmailBackend
 
 
@@ -11,3 +12,46 @@ class FailingEmailBackend(BaseEmailBackend):
             if not self.fail_silently:
                 raise
             return 0
+
+
+class ConnectionCountingEmailBackend(locmem.EmailBackend):
+    """Email backend which counts how often its connection is opened"""
+
+    opened = 0
+    closed = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_open = False
+
+    def open(self):
+        if self.is_open:
+            return False
+        self.is_open = True
+        ConnectionCountingEmailBackend.opened += 1
+        return True
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            ConnectionCountingEmailBackend.closed += 1
+
+    def send_messages(self, email_messages):
+        new_conn_created = self.open()
+        try:
+            return super().send_messages(email_messages)
+        finally:
+            if new_conn_created:
+                self.close()
+
+
+class UnreachableEmailBackend(BaseEmailBackend):
+    """Email backend which can never open its connection"""
+
+    def open(self):
+        if not self.fail_silently:
+            raise ConnectionRefusedError("Connection refused")
+
+    def send_messages(self, email_messages):
+        self.open()
+        return 0
@@ -0,0 +1,627 @@
+import os
+import shutil
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.timezone import now
+
+from email_log import partitions
+from email_log.management.commands.index_email_log import Command as IndexCommand
+from email_log.management.commands.partition_email_log import (
+    Command as PartitionCommand,
+)
+from email_log.models import (
+    Attachment,
+    Content,
+    Email,
+    Log,
+    PendingEvent,
+    Recipient,
+)
+from email_log.search import has_fts_table
+
+ATTACHMENTS_TEST_FOLDER = "testfiles"
+
+
+@override_settings(EMAIL_LOG_ATTACHMENTS_PATH=ATTACHMENTS_TEST_FOLDER)
+class PruneEmailLogTests(TestCase):
+    def setUp(self):
+        self.addCleanup(shutil.rmtree, ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+
+    def create_email(self, days_ago, attachment=None, logs=0):
+        email = Email.objects.create(subject=f"{days_ago} days ago")
+        Email.objects.filter(pk=email.pk).update(
+            date_sent=now() - timedelta(days=days_ago)
+        )
+        if attachment is not None:
+            name, content, digest = attachment
+            file = Attachment(email=email, name=name, digest=digest)
+            file.file.save(name, ContentFile(content))
+        for number in range(logs):
+            Log.objects.create(
+                email=email,
+                esp="test_esp",
+                metadata={},
+                type="delivered",
+                timestamp=now(),
+                event_id=f"{email.pk}-{number}",
+                tags=[],
+                raw={},
+            )
+        return email
+
+    def prune(self, *args):
+        out = StringIO()
+        call_command("prune_email_log", *args, stdout=out)
+        return out.getvalue()
+
+    def remaining_subjects(self):
+        return sorted(Email.objects.values_list("subject", flat=True))
+
+    def stored_files(self):
+        if not os.path.isdir(ATTACHMENTS_TEST_FOLDER):
+            return []
+        return sorted(os.listdir(ATTACHMENTS_TEST_FOLDER))
+
+    def test_requires_a_policy(self):
+        with self.assertRaisesMessage(CommandError, "Specify --days, --keep or both."):
+            self.prune()
+
+    def test_chunk_size_must_be_positive(self):
+        with self.assertRaisesMessage(CommandError, "--chunk-size must be at least"):
+            self.prune("--days=1", "--chunk-size=0")
+
+    def test_keep_must_be_positive(self):
+        with self.assertRaisesMessage(CommandError, "--keep must be at least 1."):
+            self.prune("--keep=0")
+
+    def test_nothing_to_delete(self):
+        self.create_email(days_ago=1)
+        self.assertEqual(self.prune("--days=30"), "No emails to delete.\n")
+        self.assertEqual(self.prune("--keep=5"), "No emails to delete.\n")
+
+    def test_delete_by_age(self):
+        for days_ago in (1, 40, 50):
+            self.create_email(days_ago, logs=2)
+        output = self.prune("--days=30")
+        self.assertEqual(output, "Deleted 2 emails, 0 attachments and 4 logs.\n")
+        self.assertEqual(self.remaining_subjects(), ["1 days ago"])
+        self.assertEqual(Log.objects.count(), 2)
+
+    def test_delete_by_count(self):
+        for days_ago in (1, 2, 3, 4):
+            self.create_email(days_ago)
+        self.prune("--keep=2")
+        self.assertEqual(self.remaining_subjects(), ["1 days ago", "2 days ago"])
+
+    def test_age_and_count_combined(self):
+        for days_ago in (1, 2, 40):
+            self.create_email(days_ago)
+        self.prune("--days=30", "--keep=1")
+        self.assertEqual(self.remaining_subjects(), ["1 days ago"])
+
+    def test_deletes_in_chunks(self):
+        for days_ago in range(40, 47):
+            self.create_email(days_ago)
+        with mock.patch("time.sleep") as sleep:
+            output = StringIO()
+            call_command(
+                "prune_email_log",
+                "--days=30",
+                "--chunk-size=3",
+                "--sleep=0.5",
+                verbosity=2,
+                stdout=output,
+            )
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            [
+                "Deleted 3 emails.",
+                "Deleted 3 emails.",
+                "Deleted 1 emails.",
+                "Deleted 7 emails, 0 attachments and 0 logs.",
+            ],
+        )
+        self.assertEqual(sleep.call_args_list, [mock.call(0.5)] * 3)
+        self.assertEqual(Email.objects.count(), 0)
+
+    def test_deletes_attachment_files(self):
+        self.create_email(40, attachment=("old.txt", b"old", ""))
+        self.create_email(1, attachment=("new.txt", b"new", ""))
+        output = self.prune("--days=30")
+        self.assertEqual(output, "Deleted 1 emails, 1 attachments and 0 logs.\n")
+        self.assertEqual(self.stored_files(), ["new.txt"])
+
+    def test_keeps_shared_deduplicated_files(self):
+        self.create_email(40, attachment=("terms.pdf", b"terms", "digest"))
+        email = self.create_email(1)
+        old = Attachment.objects.get()
+        Attachment.objects.create(
+            email=email, name="terms.pdf", file=old.file.name, digest="digest"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.prune("--days=30")
+        self.assertEqual(self.stored_files(), ["terms.pdf"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.prune("--days=0")
+        self.assertEqual(self.stored_files(), [])
+
+    def test_dry_run(self):
+        self.create_email(40, attachment=("old.txt", b"old", ""), logs=3)
+        self.create_email(1)
+        output = self.prune("--days=30", "--dry-run")
+        self.assertEqual(output, "Would delete 1 emails, 1 attachments and 3 logs.\n")
+        self.assertEqual(Email.objects.count(), 2)
+        self.assertEqual(self.stored_files(), ["old.txt"])
+
+    def test_deletes_unused_contents(self):
+        shared = Content.objects.create(digest="shared", text="Shared body")
+        only_old = Content.objects.create(digest="old", text="Old HTML")
+        Content.objects.create(digest="unused", text="Unused")
+        old = self.create_email(40)
+        new = self.create_email(1)
+        Email.objects.filter(pk=old.pk).update(
+            body_content=shared, html_message_content=only_old
+        )
+        Email.objects.filter(pk=new.pk).update(body_content=shared)
+
+        self.prune("--days=30", "--dry-run")
+        self.assertEqual(Content.objects.count(), 3)
+
+        output = self.prune("--days=30")
+        self.assertEqual(
+            output,
+            "Deleted 1 emails, 0 attachments and 0 logs.\n"
+            "Deleted 2 unused contents.\n",
+        )
+        self.assertEqual(list(Content.objects.values_list("pk", flat=True)), ["shared"])
+        self.assertEqual(Email.objects.get().get_body(), "Shared body")
+
+        Content.objects.create(digest="unused", text="Unused")
+        output = self.prune("--days=30")
+        self.assertEqual(output, "No emails to delete.\nDeleted 1 unused contents.\n")
+
+    def test_deletes_unused_contents_in_chunks(self):
+        for digest in ("a", "b", "c"):
+            Content.objects.create(digest=digest, text=digest)
+        with CaptureQueriesContext(connections["default"]) as queries:
+            output = self.prune("--days=30", "--chunk-size=2")
+        self.assertEqual(output, "No emails to delete.\nDeleted 3 unused contents.\n")
+        deletes = [
+            query["sql"]
+            for query in queries
+            if query["sql"].startswith('DELETE FROM "email_log_content"')
+        ]
+        self.assertEqual(len(deletes), 2)
+        self.assertFalse(Content.objects.exists())
+
+
+class PartitionEmailLogTests(TestCase):
+    def setUp(self):
+        self.now = datetime(2026, 1, 15, 12, tzinfo=dt_timezone.utc)
+        patcher = mock.patch(
+            "email_log.management.commands.partition_email_log.timezone.now",
+            return_value=self.now,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def partition(self, *args):
+        stdout = StringIO()
+        call_command("partition_email_log", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_requires_postgresql(self):
+        with self.assertRaisesMessage(CommandError, "requires PostgreSQL"):
+            self.partition("--premake=1")
+        with self.assertRaisesMessage(CommandError, "requires PostgreSQL"):
+            self.partition("--retain=12", "--dry-run")
+
+    def test_dry_run_premake(self):
+        output = self.partition("--premake=1", "--dry-run")
+        self.assertEqual(
+            output.splitlines(),
+            [
+                'CREATE TABLE IF NOT EXISTS "email_log_email_p202601" '
+                'PARTITION OF "email_log_email" FOR VALUES FROM '
+                "('2026-01-01T00:00:00+00:00') TO ('2026-02-01T00:00:00+00:00');",
+                'CREATE TABLE IF NOT EXISTS "email_log_email_p202602" '
+                'PARTITION OF "email_log_email" FOR VALUES FROM '
+                "('2026-02-01T00:00:00+00:00') TO ('2026-03-01T00:00:00+00:00');",
+                'CREATE TABLE IF NOT EXISTS "email_log_log_p202601" '
+                'PARTITION OF "email_log_log" FOR VALUES FROM '
+                "('2026-01-01T00:00:00+00:00') TO ('2026-02-01T00:00:00+00:00');",
+                'CREATE TABLE IF NOT EXISTS "email_log_log_p202602" '
+                'PARTITION OF "email_log_log" FOR VALUES FROM '
+                "('2026-02-01T00:00:00+00:00') TO ('2026-03-01T00:00:00+00:00');",
+            ],
+        )
+
+    def test_dry_run_convert(self):
+        output = self.partition("--convert", "--premake=1", "--dry-run")
+        self.assertIn(
+            'ALTER TABLE "email_log_email" ATTACH PARTITION '
+            '"email_log_email_legacy" FOR VALUES FROM (MINVALUE) '
+            "TO ('2026-02-01T00:00:00+00:00');",
+            output,
+        )
+        self.assertIn(
+            'ALTER TABLE "email_log_log" ADD PRIMARY KEY ("id", "timestamp");',
+            output,
+        )
+        self.assertNotIn("gin_trgm_ops", output)
+        self.assertIn(
+            'CREATE UNIQUE INDEX IF NOT EXISTS "email_log_log_unique_event_part_idx" '
+            'ON "email_log_log" ("esp", "event_id", "timestamp") '
+            "WHERE \"event_id\" <> '';",
+            output,
+        )
+        self.assertIn(
+            'CREATE INDEX IF NOT EXISTS "email_log_email_esp_message_id_part_idx" '
+            'ON "email_log_email" USING btree ("esp_message_id");',
+            output,
+        )
+        self.assertIn(
+            'CREATE INDEX IF NOT EXISTS "email_log_log_email_id_timestamp_part_idx" '
+            'ON "email_log_log" USING btree ("email_id", "timestamp");',
+            output,
+        )
+        # The legacy table holds the current month, so premade partitions
+        # start at the boundary.
+        self.assertNotIn('"email_log_email_p202601"', output)
+        self.assertIn('"email_log_email_p202602"', output)
+        self.assertEqual(Email.objects.count(), 0)
+
+    def test_convert_validates_boundary_before_locking(self):
+        connection = connections["default"]
+        outside = connection.savepoint_ids[-1]
+        statements = []
+
+        def execute_sql(command, sql):
+            # The innermost savepoint tells which transaction ran the statement
+            statements.append((sql, connection.savepoint_ids[-1]))
+
+        with mock.patch.object(PartitionCommand, "execute_sql", execute_sql):
+            self.partition("--convert", "--premake=0", "--dry-run")
+        sql = [statement for statement, savepoint in statements]
+        validate = sql.index(
+            'ALTER TABLE "email_log_email" VALIDATE CONSTRAINT '
+            '"email_log_email_legacy_date_sent_check"'
+        )
+        lock = sql.index('LOCK TABLE "email_log_email" IN ACCESS EXCLUSIVE MODE')
+        self.assertEqual(validate, 2)
+        savepoints = [savepoint for statement, savepoint in statements]
+        # Adding and validating the constraint each commit on their own
+        self.assertEqual(len(set(savepoints[: validate + 1])), validate + 1)
+        self.assertNotIn(outside, savepoints[: validate + 1])
+        # Indexes are then built concurrently, outside any transaction
+        first = validate + 1
+        prepare = sql[first:lock]
+        self.assertEqual(
+            prepare[:2],
+            [
+                'DROP INDEX CONCURRENTLY IF EXISTS "email_log_email_legacy_pkey"',
+                "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "
+                '"email_log_email_legacy_pkey" '
+                'ON "email_log_email" ("id", "date_sent")',
+            ],
+        )
+        self.assertIn(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            '"email_log_email_legacy_esp_message_id_idx" '
+            'ON "email_log_email" USING btree ("esp_message_id")',
+            prepare,
+        )
+        self.assertEqual(len(prepare), 10)
+        self.assertEqual(set(savepoints[first:lock]), {outside})
+        # The rest of the conversion runs in one transaction
+        attach = sql.index(
+            'ALTER TABLE "email_log_email" ATTACH PARTITION "email_log_email_legacy" '
+            "FOR VALUES FROM (MINVALUE) TO ('2026-02-01T00:00:00+00:00')"
+        )
+        self.assertEqual(set(savepoints[lock:attach]), {savepoints[attach]})
+        self.assertNotEqual(savepoints[attach], outside)
+        self.assertIn(
+            'ALTER TABLE "email_log_email_legacy" ADD CONSTRAINT '
+            '"email_log_email_legacy_pkey" PRIMARY KEY '
+            'USING INDEX "email_log_email_legacy_pkey"',
+            sql[lock:attach],
+        )
+        self.assertIn(
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "
+            '"email_log_log_legacy_unique_event_idx" ON "email_log_log" '
+            '("esp", "event_id", "timestamp") WHERE "event_id" <> \'\'',
+            sql,
+        )
+
+    def test_dry_run_retain(self):
+        old = datetime(2025, 2, 1, tzinfo=dt_timezone.utc)
+        kept = datetime(2025, 3, 1, tzinfo=dt_timezone.utc)
+        partition_list = [
+            ("email_log_log_p202501", old),
+            ("email_log_log_p202502", kept),
+        ]
+        with mock.patch.object(
+            type(connections["default"]), "vendor", "postgresql"
+        ), mock.patch(
+            "email_log.management.commands.partition_email_log.get_partitions",
+            side_effect=[[], partition_list],
+        ):
+            output = self.partition("--premake=0", "--retain=11", "--dry-run")
+        self.assertIn(
+            'ALTER TABLE "email_log_log" DETACH PARTITION "email_log_log_p202501";\n'
+            'DROP TABLE "email_log_log_p202501";\n',
+            output,
+        )
+        self.assertNotIn("p202502", output)
+
+    def test_retain_deletes_in_chunks_before_detaching(self):
+        for number in range(3):
+            email = Email.objects.create()
+            Recipient.objects.create(email=email, address="to@example.com", kind="to")
+            Log.objects.create(
+                email=email,
+                esp="esp",
+                metadata={},
+                type="delivered",
+                timestamp=now(),
+                event_id=str(number),
+                tags=[],
+                raw={},
+            )
+        connection = connections["default"]
+        statements = []
+
+        def execute_sql(command, sql):
+            statements.append((sql, connection.savepoint_ids[-1]))
+
+        old = datetime(2025, 2, 1, tzinfo=dt_timezone.utc)
+        # Any table with an id column can stand in for a partition here
+        partition_lists = [[], [], [("email_log_email", old)], []]
+        with mock.patch.object(
+            type(connection), "vendor", "postgresql"
+        ), mock.patch.object(PartitionCommand, "execute_sql", execute_sql), mock.patch(
+            "email_log.management.commands.partition_email_log.get_partitions",
+            side_effect=partition_lists,
+        ), CaptureQueriesContext(
+            connection
+        ) as queries:
+            self.partition("--premake=0", "--retain=11", "--chunk-size=2")
+        self.assertFalse(Recipient.objects.exists())
+        self.assertFalse(Log.objects.exists())
+        log_deletes = [
+            query["sql"]
+            for query in queries
+            if query["sql"].startswith('DELETE FROM "email_log_log"')
+        ]
+        # Two chunks, then the logs of events received since
+        self.assertEqual(len(log_deletes), 3)
+        savepoints = [
+            query["sql"] for query in queries if query["sql"].startswith("SAVEPOINT")
+        ]
+        # Premaking, each chunk, and detaching run in their own transactions
+        self.assertEqual(len(savepoints), 4)
+        self.assertEqual(
+            [sql for sql, savepoint in statements[-2:]],
+            [
+                'ALTER TABLE "email_log_email" DETACH PARTITION "email_log_email"',
+                'DROP TABLE "email_log_email"',
+            ],
+        )
+        self.assertEqual(statements[-2][1], statements[-1][1])
+        self.assertNotEqual(statements[0][1], statements[-1][1])
+
+    def test_chunk_size_must_be_positive(self):
+        with self.assertRaisesMessage(CommandError, "--chunk-size must be at least"):
+            self.partition("--premake=1", "--dry-run", "--chunk-size=0")
+
+
+class PartitionHelperTests(SimpleTestCase):
+    def quote(self, name):
+        return f'"{name}"'
+
+    def test_add_months(self):
+        value = datetime(2025, 11, 30, 23, tzinfo=dt_timezone.utc)
+        self.assertEqual(
+            partitions.add_months(value, 2),
+            datetime(2026, 1, 1, tzinfo=dt_timezone.utc),
+        )
+        self.assertEqual(
+            partitions.add_months(value, -11),
+            datetime(2024, 12, 1, tzinfo=dt_timezone.utc),
+        )
+
+    def test_month_start_uses_utc(self):
+        value = datetime(2026, 3, 1, 1, tzinfo=dt_timezone(timedelta(hours=2)))
+        self.assertEqual(
+            partitions.month_start(value),
+            datetime(2026, 2, 1, tzinfo=dt_timezone.utc),
+        )
+
+    def test_partition_sql(self):
+        start = datetime(2026, 12, 1, tzinfo=dt_timezone.utc)
+        self.assertEqual(
+            partitions.create_partition_sql(self.quote, "email_log_log", start),
+            'CREATE TABLE IF NOT EXISTS "email_log_log_p202612" '
+            'PARTITION OF "email_log_log" FOR VALUES FROM '
+            "('2026-12-01T00:00:00+00:00') TO ('2027-01-01T00:00:00+00:00')",
+        )
+        self.assertEqual(
+            partitions.detach_partition_sql(self.quote, "email_log_log", "old"),
+            'ALTER TABLE "email_log_log" DETACH PARTITION "old"',
+        )
+        self.assertEqual(
+            partitions.drop_partition_sql(self.quote, "old"), 'DROP TABLE "old"'
+        )
+
+    def test_convert_with_search_indexes(self):
+        boundary = datetime(2026, 2, 1, tzinfo=dt_timezone.utc)
+        statements = partitions.convert_table_sql(
+            self.quote, Email, boundary, search_indexes=True
+        )
+        self.assertIn(
+            'CREATE INDEX IF NOT EXISTS "email_log_email_body_trgm_part_idx" '
+            'ON "email_log_email" USING gin ((UPPER("body"::text)) gin_trgm_ops)',
+            statements,
+        )
+
+    def test_upper_bound(self):
+        self.assertEqual(
+            partitions.upper_bound(
+                "FOR VALUES FROM ('2026-01-01 00:00:00+00') "
+                "TO ('2026-02-01 00:00:00+00')"
+            ),
+            datetime(2026, 2, 1, tzinfo=dt_timezone.utc),
+        )
+        self.assertIsNone(partitions.upper_bound("DEFAULT"))
+
+
+class IndexEmailLogTests(TestCase):
+    def run_on_postgresql(self, *args, partitioned=False):
+        statements = []
+        with mock.patch.object(
+            type(connections["default"]), "vendor", "postgresql"
+        ), mock.patch.object(
+            IndexCommand,
+            "execute_sql",
+            lambda command, sql: statements.extend(sql),
+        ), mock.patch(
+            "email_log.management.commands.index_email_log.is_partitioned",
+            return_value=partitioned,
+        ):
+            call_command("index_email_log", *args)
+        return statements
+
+    def test_trigram_indexes_on_postgresql(self):
+        statements = self.run_on_postgresql()
+        self.assertEqual(statements[0], "CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        self.assertEqual(
+            statements[1],
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "email_log_email_subject_trgm" '
+            'ON "email_log_email" USING gin ((UPPER("subject"::text)) gin_trgm_ops)',
+        )
+        self.assertEqual(len(statements), 7)
+
+    def test_partitioned_table_on_postgresql(self):
+        statements = self.run_on_postgresql(partitioned=True)
+        self.assertEqual(
+            statements[1],
+            'CREATE INDEX IF NOT EXISTS "email_log_email_subject_trgm_part_idx" '
+            'ON "email_log_email" USING gin ((UPPER("subject"::text)) gin_trgm_ops)',
+        )
+
+    def test_drop_on_postgresql(self):
+        statements = self.run_on_postgresql("--drop")
+        self.assertEqual(
+            statements[0],
+            'DROP INDEX IF EXISTS "email_log_email_subject_trgm_part_idx"',
+        )
+        self.assertIn('DROP INDEX IF EXISTS "email_log_email_subject_trgm"', statements)
+        self.assertEqual(len(statements), 12)
+
+    def test_other_databases(self):
+        with mock.patch.object(type(connections["default"]), "vendor", "mysql"):
+            with self.assertRaisesMessage(CommandError, "PostgreSQL or SQLite"):
+                call_command("index_email_log")
+
+    def test_sqlite_without_fts5(self):
+        with mock.patch(
+            "email_log.management.commands.index_email_log.fts_table_sql",
+            return_value=[
+                'CREATE VIRTUAL TABLE "email_log_email_fts" USING missing_module()'
+            ],
+        ):
+            with self.assertRaisesMessage(CommandError, "FTS5"):
+                call_command("index_email_log")
+        self.assertFalse(has_fts_table(connections["default"]))
+
+
+@override_settings(EMAIL_LOG_PENDING_EVENTS_TTL=60)
+class ReconcilePendingEventsTests(TestCase):
+    def create_pending_event(self, message_id):
+        return PendingEvent.objects.create(
+            esp="esp",
+            message_id=message_id,
+            event_type="delivered",
+            metadata={},
+            timestamp=now(),
+            event_id=f"{message_id}-delivered",
+            tags=[],
+            esp_event={},
+        )
+
+    def test_logs_matched_events(self):
+        email = Email.objects.create(esp_message_id="sent")
+        self.create_pending_event("sent")
+        self.create_pending_event("unknown")
+        stdout = StringIO()
+        call_command("reconcile_pending_events", "--batch-size=1", stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Logged 1 pending events.\n")
+        self.assertEqual(email.logs.get().event_id, "sent-delivered")
+        self.assertEqual(PendingEvent.objects.get().message_id, "unknown")
+        self.assertEqual(str(PendingEvent.objects.get()), "delivered")
+
+
+class CompressEmailLogTests(TestCase):
+    def compress(self, *args):
+        stdout = StringIO()
+        call_command("compress_email_log", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_compress_and_decompress(self):
+        emails = [
+            Email.objects.create(body=f"Body {n}", html_message=f"<p>{n}</p>")
+            for n in range(5)
+        ]
+        emails.append(Email.objects.create(body="Text only"))
+        empty = Email.objects.create()
+
+        self.assertEqual(self.compress("--batch-size=2"), "Compressed 6 emails.\n")
+        self.assertEqual(self.compress(), "Compressed 0 emails.\n")
+        email = Email.objects.get(pk=emails[3].pk)
+        self.assertEqual((email.body, email.html_message), ("", ""))
+        self.assertEqual(email.get_body(), "Body 3")
+        self.assertEqual(email.get_html_message(), "<p>3</p>")
+        self.assertIsNone(Email.objects.get(pk=emails[5].pk).html_message_compressed)
+        self.assertIsNone(Email.objects.get(pk=empty.pk).body_compressed)
+
+        output = self.compress("--decompress", "--batch-size=4")
+        self.assertEqual(output, "Decompressed 6 emails.\n")
+        email = Email.objects.get(pk=emails[3].pk)
+        self.assertEqual((email.body, email.html_message), ("Body 3", "<p>3</p>"))
+        self.assertIsNone(email.body_compressed)
+
+    def test_batch_size(self):
+        with self.assertRaisesMessage(CommandError, "--batch-size must be at least 1."):
+            self.compress("--batch-size=0")
+
+
+class BackfillEmailRecipientsTests(TestCase):
+    def backfill(self, *args):
+        out = StringIO()
+        call_command("backfill_email_recipients", *args, stdout=out)
+        return out.getvalue()
+
+    def test_backfill(self):
+        emails = [
+            Email.objects.create(recipients=f"to{number}@example.com", cc_recipients="")
+            for number in range(3)
+        ]
+        Recipient.objects.create(email=emails[0], address="kept@example.com", kind="to")
+        self.assertEqual(self.backfill("--batch-size=1"), "Saved 2 recipients.\n")
+        self.assertEqual(
+            sorted(Recipient.objects.values_list("address", flat=True)),
+            ["kept@example.com", "to1@example.com", "to2@example.com"],
+        )
+        self.assertEqual(self.backfill(), "Saved 0 recipients.\n")
+
+    def test_batch_size_must_be_positive(self):
+        with self.assertRaisesMessage(CommandError, "--batch-size must be at least"):
+            self.backfill("--batch-size=0")
@@ -1,27 +1,94 @@
 from contextlib import contextmanager
+from datetime import timedelta
+from importlib import import_module
+from urllib.parse import urlencode
+from asgiref.sync import async_to_sync
+from unittest import mock
 
 from django.apps import apps
 from django.core import checks
+from django.core.management import call_command
+from django.db import NotSupportedError, connections
+from django.db.models import Count, QuerySet
+from django.db.migrations.executor import MigrationExecutor
 from django.db.models.signals import post_save
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
-from django.core.mail import EmailMessage, EmailMultiAlternatives, send_mail
+from django.core.mail import (
+    EmailMessage,
+    EmailMultiAlternatives,
+    get_connection,
+    send_mail,
+)
 from django.core import mail
 from django.utils.timezone import now
+from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from email_log.models import Attachment, Email, Log
+from email_log.attachments import (
+    base64_size,
+    content_file,
+    decode_base64,
+    file_digest,
+    mime_file,
+)
+from email_log.backends import (
+    get_log_writer,
+    queued_record_size,
+    write_queued_records,
+)
+from email_log.compression import compress, decompress
+from email_log.admin import EmailAdmin, LogInline
+from email_log.models import Attachment, Content, Email, Log, Recipient
+from email_log.pagination import EstimatedCountPaginator, estimate_count
+from email_log.search import search_emails
+from email_log import policies
+from email_log.recorder import (
+    TRUNCATION_MARKER,
+    build_email,
+    log_attachments,
+    truncate,
+)
+from email_log.writer import QueuedLogWriter
+from tests.backends import ConnectionCountingEmailBackend
 from email_log.conf import Settings
 
+import base64
+import hashlib
+import io
+import quopri
 import shutil
 import os
+import threading
+import tracemalloc
+import zlib
 
 FAILING_BACKEND = "tests.backends.FailingEmailBackend"
+COUNTING_BACKEND = "tests.backends.ConnectionCountingEmailBackend"
+UNREACHABLE_BACKEND = "tests.backends.UnreachableEmailBackend"
 ATTACHMENTS_TEST_FOLDER = "testfiles"
 
 
+def build_messages(count, body="Message body"):
+    """Return messages to a different recipient each."""
+    return [
+        EmailMultiAlternatives(
+            "Subject line", body, "from@example.com", [f"to{number}@example.com"]
+        )
+        for number in range(count)
+    ]
+
+
+def asend_messages(messages, **kwargs):
+    """Send messages with the async API of a new connection."""
+    connection = mail.get_connection(**kwargs)
+    return async_to_sync(connection.asend_messages)(messages)
+
+
 @contextmanager
 def connect_signal(signal, receiver, *args, **kwargs):
     signal.connect(receiver, *args, **kwargs)
@@ -431,6 +498,1675 @@ class EmailBackendTests(TestCase):
             self.assertEqual(saved_attachment.mimetype, type)
 
 
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.EmailBackend",
+    EMAIL_LOG_BULK_WRITES=True,
+)
+class BulkWritesEmailBackendTests(TestCase):
+    def send_messages(self, messages, **kwargs):
+        with get_connection(**kwargs) as connection:
+            return connection.send_messages(messages)
+
+    def test_send_messages(self):
+        sent = self.send_messages(build_messages(3))
+        self.assertEqual(sent, 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 3)
+        self.assertEqual(
+            sorted(Email.objects.values_list("recipients", flat=True)),
+            ["to0@example.com", "to1@example.com", "to2@example.com"],
+        )
+
+    def test_query_count_is_constant(self):
+        # One INSERT for all Email rows and one UPDATE for the sent ones
+        for count in (1, 10, 50):
+            with self.subTest(count=count), self.assertNumQueries(2):
+                self.send_messages(build_messages(count))
+
+    @override_settings(EMAIL_LOG_BULK_WRITES=False)
+    def test_query_count_without_bulk_writes(self):
+        # One INSERT and one UPDATE per message
+        for count in (1, 10, 50):
+            with self.subTest(count=count), self.assertNumQueries(2 * count):
+                self.send_messages(build_messages(count))
+
+    def test_query_count_without_bulk_insert_returning_rows(self):
+        features = type(connections["default"].features)
+        with mock.patch.object(features, "can_return_rows_from_bulk_insert", False):
+            with self.assertNumQueries(20):
+                self.send_messages(build_messages(10))
+        self.assertEqual(Email.objects.filter(ok=True).count(), 10)
+
+    @override_settings(EMAIL_LOG_BULK_BATCH_SIZE=2)
+    def test_batch_size(self):
+        with self.assertNumQueries(6):
+            sent = self.send_messages(build_messages(5))
+        self.assertEqual(sent, 5)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 5)
+
+    @override_settings(EMAIL_LOG_BACKEND=FAILING_BACKEND)
+    def test_send_failure_silent(self):
+        with self.assertNumQueries(1):
+            sent = self.send_messages(build_messages(3), fail_silently=True)
+        self.assertEqual(sent, 0)
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 0)
+
+    @override_settings(EMAIL_LOG_SAVE_ATTACHMENTS=True)
+    def test_send_messages_with_attachments(self):
+        messages = build_messages(2)
+        for message in messages:
+            message.attach(f"{ATTACHMENTS_TEST_FOLDER}/bulk.txt", b"test", "text/plain")
+        try:
+            sent = self.send_messages(messages)
+            self.assertEqual(sent, 2)
+            self.assertEqual(Attachment.objects.count(), 2)
+            for email in Email.objects.all():
+                self.assertEqual(email.attachments.get().file.read(), b"test")
+        finally:
+            shutil.rmtree(ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+
+    def test_send_error_marks_earlier_messages_sent(self):
+        messages = build_messages(3)
+        with mock.patch.object(
+            messages[1], "send", side_effect=Exception("SMTP problem")
+        ), self.assertRaises(Exception):
+            self.send_messages(messages)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            list(Email.objects.order_by("pk").values_list("ok", flat=True)),
+            [True, False, False],
+        )
+
+    def test_send_db_problem_create(self):
+        with mock.patch.object(
+            Email.objects, "bulk_create", side_effect=Exception("DB problem")
+        ):
+            with self.assertLogs() as captured:
+                sent = self.send_messages(build_messages(2))
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(
+            [record.getMessage() for record in captured.records],
+            ["Failed to save email to database (create)"],
+        )
+
+    def test_send_db_problem_update(self):
+        with mock.patch.object(QuerySet, "update", side_effect=Exception("DB problem")):
+            with self.assertLogs() as captured:
+                sent = self.send_messages(build_messages(2))
+        self.assertEqual(sent, 2)
+        self.assertEqual(Email.objects.filter(ok=False).count(), 2)
+        self.assertEqual(
+            [record.getMessage() for record in captured.records],
+            ["Failed to save email to database (update)"],
+        )
+
+
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.EmailBackend",
+    EMAIL_LOG_BACKEND=COUNTING_BACKEND,
+)
+class ConnectionReuseEmailBackendTests(TestCase):
+    def setUp(self):
+        ConnectionCountingEmailBackend.opened = 0
+        ConnectionCountingEmailBackend.closed = 0
+
+    def assertConnections(self, opened, closed):
+        self.assertEqual(ConnectionCountingEmailBackend.opened, opened)
+        self.assertEqual(ConnectionCountingEmailBackend.closed, closed)
+
+    def test_one_connection_per_batch(self):
+        sent = get_connection().send_messages(build_messages(3))
+        self.assertEqual(sent, 3)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 3)
+        self.assertConnections(opened=1, closed=1)
+
+    @override_settings(EMAIL_LOG_BULK_WRITES=True)
+    def test_one_connection_per_batch_with_bulk_writes(self):
+        sent = get_connection().send_messages(build_messages(3))
+        self.assertEqual(sent, 3)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 3)
+        self.assertConnections(opened=1, closed=1)
+
+    def test_empty_batch_does_not_connect(self):
+        self.assertEqual(get_connection().send_messages([]), 0)
+        self.assertConnections(opened=0, closed=0)
+
+    def test_context_manager_reuses_connection(self):
+        with get_connection() as connection:
+            connection.send_messages(build_messages(2))
+            connection.send_messages(build_messages(2))
+            self.assertConnections(opened=1, closed=0)
+        self.assertConnections(opened=1, closed=1)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 4)
+
+    def test_open_and_close(self):
+        connection = get_connection()
+        self.assertTrue(connection.open())
+        self.assertFalse(connection.open())
+        connection.close()
+        self.assertConnections(opened=1, closed=1)
+
+    @override_settings(EMAIL_LOG_BACKEND=UNREACHABLE_BACKEND)
+    def test_open_failure_is_logged(self):
+        with self.assertRaises(ConnectionRefusedError):
+            get_connection().send_messages(build_messages(1))
+        self.assertFalse(Email.objects.get().ok)
+
+    @override_settings(EMAIL_LOG_BACKEND=UNREACHABLE_BACKEND)
+    def test_open_failure_silent(self):
+        connection = get_connection(fail_silently=True)
+        self.assertEqual(connection.send_messages(build_messages(2)), 0)
+        self.assertEqual(Email.objects.filter(ok=False).count(), 2)
+
+
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.EmailBackend",
+    EMAIL_LOG_QUEUE=True,
+)
+class QueuedEmailBackendTests(TestCase):
+    def setUp(self):
+        self.writer = QueuedLogWriter(write=write_queued_records)
+        patchers = [
+            mock.patch("email_log.backends._log_writer", self.writer),
+            # Records are written by calling flush() from the test thread
+            mock.patch.object(QueuedLogWriter, "start"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_send_messages_without_database_writes(self):
+        with self.assertNumQueries(0):
+            sent = get_connection().send_messages(build_messages(3))
+        self.assertEqual(sent, 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(self.writer.queue.qsize(), 3)
+
+    def test_flush_writes_one_batch(self):
+        get_connection().send_messages(build_messages(3))
+        with self.assertNumQueries(1):
+            self.writer.flush()
+        self.assertEqual(Email.objects.filter(ok=True).count(), 3)
+
+    @override_settings(EMAIL_LOG_BACKEND=FAILING_BACKEND)
+    def test_send_failure(self):
+        with self.assertRaises(NotImplementedError):
+            get_connection().send_messages(build_messages(1))
+        self.writer.flush()
+        self.assertFalse(Email.objects.get().ok)
+
+    @override_settings(EMAIL_LOG_BACKEND=FAILING_BACKEND)
+    def test_send_failure_silent(self):
+        connection = get_connection(fail_silently=True)
+        self.assertEqual(connection.send_messages(build_messages(2)), 0)
+        self.writer.flush()
+        self.assertEqual(Email.objects.filter(ok=False).count(), 2)
+
+    @override_settings(EMAIL_LOG_SAVE_ATTACHMENTS=True)
+    def test_send_messages_with_attachments(self):
+        messages = build_messages(2)
+        for message in messages:
+            message.attach(f"{ATTACHMENTS_TEST_FOLDER}/queue.txt", b"test")
+        try:
+            get_connection().send_messages(messages)
+            self.assertEqual(Attachment.objects.count(), 0)
+            self.writer.flush()
+            self.assertEqual(Attachment.objects.count(), 2)
+        finally:
+            shutil.rmtree(ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+
+    def test_write_without_bulk_insert_returning_rows(self):
+        get_connection().send_messages(build_messages(2))
+        features = type(connections["default"].features)
+        with mock.patch.object(features, "can_return_rows_from_bulk_insert", False):
+            with self.assertNumQueries(2):
+                self.writer.flush()
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_write_failure_is_logged(self):
+        get_connection().send_messages(build_messages(1))
+        with mock.patch.object(
+            Email.objects, "bulk_create", side_effect=Exception("DB problem")
+        ):
+            with self.assertLogs() as captured:
+                self.writer.flush()
+        self.assertEqual(
+            [record.getMessage() for record in captured.records],
+            ["Failed to save email to database (queue)"],
+        )
+
+    @override_settings(
+        EMAIL_LOG_SAVE_ATTACHMENTS=True,
+        EMAIL_LOG_ATTACHMENTS_PATH=ATTACHMENTS_TEST_FOLDER,
+    )
+    def test_attachments_count_toward_max_bytes(self):
+        messages = build_messages(3)
+        messages[0].attach("small.txt", b"12345")
+        messages[1].attach("large.txt", b"123456")
+        writer = QueuedLogWriter(
+            write=write_queued_records,
+            max_bytes=10,
+            full_policy="sync",
+            sizeof=queued_record_size,
+        )
+        with mock.patch("email_log.backends._log_writer", writer):
+            try:
+                get_connection().send_messages(messages)
+            finally:
+                shutil.rmtree(ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+        # The second attachment didn't fit and was written right away, and
+        # the message without attachments takes no room.
+        self.assertEqual(writer.queue.qsize(), 2)
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_queued_record_size(self):
+        message = build_messages(1)[0]
+        self.assertEqual(queued_record_size((Email(), None)), 0)
+        self.assertEqual(queued_record_size((Email(), message)), 0)
+        message.attach("text.txt", "caf\u00e9")
+        message.attach("data.bin", b"\x00" * 10)
+        message.attach(MIMEText("plain"))
+        self.assertEqual(queued_record_size((Email(), message)), 4 + 10 + 5)
+
+    @override_settings(
+        EMAIL_LOG_QUEUE_MAX_SIZE=5,
+        EMAIL_LOG_QUEUE_MAX_BYTES=1000,
+        EMAIL_LOG_QUEUE_FLUSH_SIZE=2,
+        EMAIL_LOG_QUEUE_FLUSH_INTERVAL=0.5,
+        EMAIL_LOG_QUEUE_FULL_POLICY="drop",
+    )
+    def test_get_log_writer_uses_settings(self):
+        with mock.patch("email_log.backends._log_writer", None):
+            writer = get_log_writer()
+            self.assertIs(get_log_writer(), writer)
+        self.assertEqual(writer.queue.maxsize, 5)
+        self.assertEqual(writer.max_bytes, 1000)
+        self.assertEqual(writer.flush_size, 2)
+        self.assertEqual(writer.flush_interval, 0.5)
+        self.assertEqual(writer.full_policy, "drop")
+
+
+class QueuedLogWriterTests(TestCase):
+    def setUp(self):
+        self.batches = []
+        patcher = mock.patch.object(QueuedLogWriter, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def build_writer(self, **kwargs):
+        return QueuedLogWriter(write=self.batches.append, **kwargs)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.build_writer(full_policy="explode")
+
+    def test_flush_size(self):
+        writer = self.build_writer(flush_size=2)
+        for record in range(5):
+            writer.put(record)
+        writer.flush()
+        self.assertEqual(self.batches, [[0, 1], [2, 3], [4]])
+
+    def test_drop_when_full(self):
+        writer = self.build_writer(max_size=1, full_policy="drop")
+        with self.assertLogs(level="WARNING") as captured:
+            writer.put("kept")
+            writer.put("dropped")
+        writer.flush()
+        self.assertEqual(self.batches, [["kept"]])
+        self.assertEqual(
+            captured.records[0].getMessage(),
+            "Email log queue is full, dropping log record",
+        )
+
+    def test_write_synchronously_when_full(self):
+        writer = self.build_writer(max_size=1, full_policy="sync")
+        writer.put("queued")
+        writer.put("written")
+        self.assertEqual(self.batches, [["written"]])
+        writer.flush()
+        self.assertEqual(self.batches, [["written"], ["queued"]])
+
+    def test_block_when_full(self):
+        writer = self.build_writer(max_size=1, full_policy="block")
+        writer.put("first")
+        with mock.patch.object(writer.queue, "put") as put:
+            writer.put("second")
+        put.assert_called_once_with("second")
+
+    def test_drop_when_bytes_are_full(self):
+        writer = self.build_writer(max_bytes=10, full_policy="drop")
+        with self.assertLogs(level="WARNING"):
+            writer.put("six...")
+            writer.put("dropped")
+        writer.put("four")
+        writer.flush()
+        self.assertEqual(self.batches, [["six...", "four"]])
+        # Written records no longer count
+        writer.put("ten bytes.")
+        self.assertEqual(writer.queue.qsize(), 1)
+
+    def test_record_larger_than_max_bytes(self):
+        writer = self.build_writer(max_bytes=4, full_policy="sync")
+        writer.put("queued alone")
+        writer.put("written")
+        self.assertEqual(self.batches, [["written"]])
+        writer.flush()
+        self.assertEqual(self.batches, [["written"], ["queued alone"]])
+
+    def test_block_until_bytes_are_written(self):
+        writer = self.build_writer(max_bytes=10, full_policy="block")
+        writer.put("eight...")
+        thread = threading.Thread(target=writer.put, args=["blocked"])
+        thread.start()
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        writer.flush()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        writer.flush()
+        self.assertEqual(self.batches, [["eight..."], ["blocked"]])
+
+    def test_stop_without_thread_flushes(self):
+        writer = self.build_writer()
+        writer.put("record")
+        writer.stop()
+        self.assertEqual(self.batches, [["record"]])
+
+
+class QueuedLogWriterThreadTests(TransactionTestCase):
+    def test_background_thread_writes_and_flushes_on_stop(self):
+        batches = []
+        writer = QueuedLogWriter(
+            write=batches.append, flush_size=2, flush_interval=0.01
+        )
+        for record in range(3):
+            writer.put(record)
+        writer.start()
+        writer.stop(timeout=5)
+        self.assertEqual(sorted(sum(batches, [])), [0, 1, 2])
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        self.assertTrue(writer.queue.empty())
+
+    def test_background_thread_saves_emails(self):
+        writer = QueuedLogWriter(write=write_queued_records, flush_interval=0.01)
+        writer.put((Email(subject="Queued"), None))
+        writer.stop(timeout=5)
+        self.assertEqual(Email.objects.get().subject, "Queued")
+
+
+@override_settings(EMAIL_BACKEND="email_log.backends.AsyncEmailBackend")
+class AsyncEmailBackendTests(TestCase):
+    async def test_asend_messages(self):
+        sent = await get_connection().asend_messages(build_messages(3))
+        self.assertEqual(sent, 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(await Email.objects.filter(ok=True).acount(), 3)
+
+    async def test_asend_no_messages(self):
+        self.assertEqual(await get_connection().asend_messages([]), 0)
+
+    def test_asend_query_count(self):
+        # One INSERT for all Email rows and one UPDATE for the sent ones
+        with self.assertNumQueries(2):
+            async_to_sync(get_connection().asend_messages)(build_messages(10))
+
+    @override_settings(EMAIL_LOG_BACKEND=COUNTING_BACKEND)
+    async def test_asend_reuses_connection(self):
+        ConnectionCountingEmailBackend.opened = 0
+        await get_connection().asend_messages(build_messages(3))
+        self.assertEqual(ConnectionCountingEmailBackend.opened, 1)
+
+    @override_settings(EMAIL_LOG_BACKEND=FAILING_BACKEND)
+    async def test_asend_failure(self):
+        with self.assertRaises(NotImplementedError):
+            await get_connection().asend_messages(build_messages(2))
+        self.assertEqual(await Email.objects.filter(ok=False).acount(), 2)
+
+    @override_settings(EMAIL_LOG_BACKEND=FAILING_BACKEND)
+    async def test_asend_failure_silent(self):
+        connection = get_connection(fail_silently=True)
+        self.assertEqual(await connection.asend_messages(build_messages(2)), 0)
+        self.assertEqual(await Email.objects.filter(ok=False).acount(), 2)
+
+    async def test_asend_db_problem_create(self):
+        with mock.patch.object(
+            Email.objects, "abulk_create", side_effect=Exception("DB problem")
+        ):
+            with self.assertLogs() as captured:
+                sent = await get_connection().asend_messages(build_messages(2))
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(
+            [record.getMessage() for record in captured.records],
+            ["Failed to save email to database (create)"],
+        )
+
+    async def test_asend_db_problem_update(self):
+        with mock.patch.object(
+            QuerySet, "aupdate", side_effect=Exception("DB problem")
+        ):
+            with self.assertLogs() as captured:
+                sent = await get_connection().asend_messages(build_messages(2))
+        self.assertEqual(sent, 2)
+        self.assertEqual(await Email.objects.filter(ok=False).acount(), 2)
+        self.assertEqual(
+            [record.getMessage() for record in captured.records],
+            ["Failed to save email to database (update)"],
+        )
+
+    async def test_asend_without_bulk_insert_returning_rows(self):
+        features = type(connections["default"].features)
+        with mock.patch.object(features, "can_return_rows_from_bulk_insert", False):
+            sent = await get_connection().asend_messages(build_messages(2))
+        self.assertEqual(sent, 2)
+        self.assertEqual(await Email.objects.filter(ok=True).acount(), 2)
+
+    @override_settings(EMAIL_LOG_SAVE_ATTACHMENTS=True)
+    async def test_asend_with_attachments(self):
+        messages = build_messages(2)
+        for message in messages:
+            message.attach(f"{ATTACHMENTS_TEST_FOLDER}/async.txt", b"test")
+        try:
+            await get_connection().asend_messages(messages)
+            self.assertEqual(await Attachment.objects.acount(), 2)
+        finally:
+            shutil.rmtree(ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+
+    @override_settings(EMAIL_LOG_QUEUE=True)
+    async def test_asend_queued(self):
+        writer = QueuedLogWriter(write=write_queued_records)
+        with mock.patch("email_log.backends._log_writer", writer):
+            with mock.patch.object(QueuedLogWriter, "start"):
+                sent = await get_connection().asend_messages(build_messages(2))
+        self.assertEqual(sent, 2)
+        self.assertEqual(writer.queue.qsize(), 2)
+
+    def test_send_messages(self):
+        self.assertEqual(get_connection().send_messages(build_messages(2)), 2)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 2)
+
+
+class AttachmentStreamingTests(TestCase):
+    def setUp(self):
+        self.email = Email.objects.create(subject="Attachments")
+        self.addCleanup(shutil.rmtree, ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+
+    def read(self, file):
+        return b"".join(file.chunks())
+
+    def test_decode_base64_in_chunks(self):
+        for data in (b"", b"a", b"ab", b"abc", bytes(range(256)) * 40):
+            payload = base64.encodebytes(data).decode()
+            for chunk_size in (1, 3, 7, 76, 4096):
+                with self.subTest(size=len(data), chunk_size=chunk_size):
+                    decoded = b"".join(decode_base64(payload, chunk_size))
+                    self.assertEqual(decoded, data)
+                    self.assertEqual(base64_size(payload), len(data))
+
+    def test_decode_base64_unpadded(self):
+        self.assertEqual(b"".join(decode_base64("YWJjZA")), b"abcd")
+
+    def test_mime_base64_attachment_is_decoded(self):
+        data = os.urandom(200_000)
+        file = mime_file(MIMEApplication(data))
+        self.assertEqual(file.size, len(data))
+        self.assertEqual(self.read(file), data)
+
+    def test_mime_quoted_printable_attachment_is_decoded(self):
+        data = "caf\u00e9 ".encode() * 10
+        attachment = MIMEBase("text", "plain")
+        attachment.set_payload(quopri.encodestring(data).decode())
+        attachment["Content-Transfer-Encoding"] = "quoted-printable"
+        self.assertEqual(self.read(mime_file(attachment)), data)
+
+    def test_mime_multipart_attachment(self):
+        attachment = MIMEMultipart()
+        attachment.attach(MIMEText("Inner message"))
+        self.assertIn(b"Inner message", self.read(mime_file(attachment)))
+
+    def test_text_content(self):
+        for text in ("ascii text", "caf\u00e9 \u2603" * 10000):
+            with self.subTest(text=text[:10]):
+                file = content_file(text)
+                self.assertTrue(file.readable())
+                self.assertEqual(file.size, len(text.encode()))
+                self.assertEqual(self.read(file), text.encode())
+
+    def test_bytes_content(self):
+        self.assertEqual(self.read(content_file(b"\x00\x01")), b"\x00\x01")
+
+    def measure_peak_memory(self, message):
+        tracemalloc.start()
+        try:
+            log_attachments(self.email, message)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    @override_settings(EMAIL_LOG_ATTACHMENTS_PATH=ATTACHMENTS_TEST_FOLDER)
+    def test_memory_with_large_attachments(self):
+        size = 8 * 2**20
+        message = EmailMessage("Large", "Body", "from@example.com", ["to@example.com"])
+        message.attach(MIMEApplication(os.urandom(size), Name="large.bin"))
+        message.attach("large.txt", "x" * size, "text/plain")
+        message.attach("large.dat", os.urandom(size), "application/octet-stream")
+
+        peak = self.measure_peak_memory(message)
+
+        # Each attachment is written in chunks rather than being copied whole
+        self.assertLess(peak, 2**20)
+        self.assertEqual(
+            sorted(a.file.size for a in self.email.attachments.all()), [size] * 3
+        )
+
+    @override_settings(EMAIL_LOG_ATTACHMENTS_PATH=ATTACHMENTS_TEST_FOLDER)
+    def test_memory_with_many_attachments(self):
+        size = 512 * 2**10
+        message = EmailMessage("Many", "Body", "from@example.com", ["to@example.com"])
+        for number in range(20):
+            message.attach(MIMEApplication(os.urandom(size), Name=f"{number}.bin"))
+
+        peak = self.measure_peak_memory(message)
+
+        # A fraction of the 10 MiB of attachment data
+        self.assertLess(peak, 2 * 2**20)
+        self.assertEqual(self.email.attachments.count(), 20)
+
+
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.EmailBackend",
+    EMAIL_LOG_SAVE_ATTACHMENTS=True,
+    EMAIL_LOG_ATTACHMENTS_PATH=ATTACHMENTS_TEST_FOLDER,
+    EMAIL_LOG_ATTACHMENTS_DEDUPLICATE=True,
+)
+class AttachmentDeduplicationTests(TestCase):
+    def setUp(self):
+        os.makedirs(ATTACHMENTS_TEST_FOLDER, exist_ok=True)
+        self.addCleanup(shutil.rmtree, ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+
+    def send(self, *attachments):
+        message = EmailMessage(
+            "Invoice", "Body", "from@example.com", ["to@example.com"]
+        )
+        for attachment in attachments:
+            message.attach(*attachment)
+        message.send()
+        return Email.objects.latest("pk")
+
+    def stored_files(self):
+        return sorted(os.listdir(ATTACHMENTS_TEST_FOLDER))
+
+    def test_identical_attachments_share_one_file(self):
+        first = self.send(("terms.pdf", b"terms"), ("logo.png", b"logo"))
+        second = self.send(("terms.pdf", b"terms"), ("logo.png", b"logo"))
+
+        self.assertEqual(Attachment.objects.count(), 4)
+        self.assertEqual(self.stored_files(), ["logo.png", "terms.pdf"])
+        for name in ("terms.pdf", "logo.png"):
+            self.assertEqual(
+                first.attachments.get(name=name).file.name,
+                second.attachments.get(name=name).file.name,
+            )
+        terms = second.attachments.get(name="terms.pdf")
+        self.assertEqual(terms.digest, hashlib.sha256(b"terms").hexdigest())
+        self.assertEqual(terms.file.read(), b"terms")
+
+    def test_identical_streamed_attachments_share_one_file(self):
+        for _ in range(2):
+            self.send(("terms.txt", "Terms and conditions", "text/plain"))
+        self.assertEqual(self.stored_files(), ["terms.txt"])
+
+    def test_different_attachments_are_stored_separately(self):
+        self.send(("terms.pdf", b"old terms"))
+        self.send(("terms.pdf", b"new terms"))
+        self.assertEqual(len(self.stored_files()), 2)
+        self.assertEqual(Attachment.objects.values("digest").distinct().count(), 2)
+
+    def test_file_is_deleted_with_its_last_reference(self):
+        first = self.send(("terms.pdf", b"terms"))
+        second = self.send(("terms.pdf", b"terms"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self.stored_files(), ["terms.pdf"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.stored_files(), [])
+
+    def test_reused_files_are_locked(self):
+        self.send(("terms.pdf", b"terms"))
+        with mock.patch.object(
+            QuerySet,
+            "select_for_update",
+            autospec=True,
+            side_effect=QuerySet.select_for_update,
+        ) as select_for_update:
+            self.send(("terms.pdf", b"terms"))
+        self.assertEqual(select_for_update.call_args.args[0].model, Attachment)
+        self.assertEqual(self.stored_files(), ["terms.pdf"])
+
+    @override_settings(EMAIL_LOG_ATTACHMENTS_DEDUPLICATE=False)
+    def test_files_are_kept_without_deduplication(self):
+        email = self.send(("terms.pdf", b"terms"))
+        self.assertEqual(email.attachments.get().digest, "")
+        with self.captureOnCommitCallbacks(execute=True):
+            email.delete()
+        self.assertEqual(self.stored_files(), ["terms.pdf"])
+
+    def test_streamed_file_can_be_read_twice(self):
+        file = content_file("caf\u00e9")
+        self.assertEqual(file_digest(file), file_digest(file))
+        self.assertEqual(b"".join(file.chunks()), "caf\u00e9".encode())
+        with self.assertRaises(io.UnsupportedOperation):
+            file.seek(1)
+
+
+@override_settings(EMAIL_LOG_ATTACHMENTS_PATH=ATTACHMENTS_TEST_FOLDER)
+class AttachmentPersistenceTests(TestCase):
+    def setUp(self):
+        os.makedirs(ATTACHMENTS_TEST_FOLDER, exist_ok=True)
+        self.addCleanup(shutil.rmtree, ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+        self.email = Email.objects.create(subject="Attachments")
+
+    def build_message(self, count, content=None):
+        message = EmailMessage("Many", "Body", "from@example.com", ["to@example.com"])
+        for number in range(count):
+            data = content if content is not None else f"content {number}".encode()
+            message.attach(f"{number}.txt", data, "text/plain")
+        return message
+
+    def stored_files(self):
+        return sorted(os.listdir(ATTACHMENTS_TEST_FOLDER))
+
+    def test_one_insert_for_all_attachments(self):
+        with self.assertNumQueries(1):
+            log_attachments(self.email, self.build_message(5))
+        self.assertEqual(
+            [a.file.read() for a in self.email.attachments.order_by("name")],
+            [f"content {number}".encode() for number in range(5)],
+        )
+        self.assertEqual(len(self.stored_files()), 5)
+
+    @override_settings(EMAIL_LOG_ATTACHMENTS_DEDUPLICATE=True)
+    def test_one_lookup_and_one_insert_with_deduplication(self):
+        with self.assertNumQueries(2):
+            log_attachments(self.email, self.build_message(5))
+        self.assertEqual(len(self.stored_files()), 5)
+
+    @override_settings(EMAIL_LOG_ATTACHMENTS_DEDUPLICATE=True)
+    def test_identical_attachments_in_one_message_share_one_file(self):
+        log_attachments(self.email, self.build_message(3, b"same"))
+        self.assertEqual(self.stored_files(), ["0.txt"])
+        self.assertEqual(
+            set(self.email.attachments.values_list("file", flat=True)),
+            {f"{ATTACHMENTS_TEST_FOLDER}/0.txt"},
+        )
+
+    @override_settings(EMAIL_LOG_ATTACHMENTS_WORKERS=4)
+    def test_parallel_writes(self):
+        storage = Attachment._meta.get_field("file").storage
+        threads = set()
+        original_save = storage.save
+
+        def save(*args, **kwargs):
+            threads.add(threading.current_thread().name)
+            return original_save(*args, **kwargs)
+
+        with mock.patch.object(storage, "save", side_effect=save):
+            log_attachments(self.email, self.build_message(8))
+
+        self.assertEqual(self.email.attachments.count(), 8)
+        self.assertEqual(len(self.stored_files()), 8)
+        self.assertTrue(all(name.startswith("ThreadPoolExecutor") for name in threads))
+
+    def test_files_are_deleted_when_database_write_fails(self):
+        with mock.patch.object(
+            Attachment.objects, "bulk_create", side_effect=Exception("DB problem")
+        ):
+            with self.assertRaisesMessage(Exception, "DB problem"):
+                log_attachments(self.email, self.build_message(3))
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(EMAIL_LOG_ATTACHMENTS_WORKERS=2)
+    def test_files_are_deleted_when_a_write_fails(self):
+        storage = Attachment._meta.get_field("file").storage
+        original_save = storage.save
+
+        def save(name, *args, **kwargs):
+            if name.endswith("1.txt"):
+                raise OSError("Disk full")
+            return original_save(name, *args, **kwargs)
+
+        with mock.patch.object(storage, "save", side_effect=save):
+            with self.assertRaisesMessage(OSError, "Disk full"):
+                log_attachments(self.email, self.build_message(3))
+        self.assertEqual(self.stored_files(), [])
+        self.assertEqual(Attachment.objects.count(), 0)
+
+    def test_failure_to_delete_files_is_logged(self):
+        storage = Attachment._meta.get_field("file").storage
+        with mock.patch.object(
+            Attachment.objects, "bulk_create", side_effect=Exception("DB problem")
+        ), mock.patch.object(storage, "delete", side_effect=OSError("Busy")):
+            with self.assertLogs() as captured, self.assertRaises(Exception):
+                log_attachments(self.email, self.build_message(1))
+        self.assertEqual(
+            captured.records[0].getMessage(),
+            f"Failed to delete attachment file {ATTACHMENTS_TEST_FOLDER}/0.txt",
+        )
+
+
+class BackfillEspMessageIdMigrationTests(TestCase):
+    def backfill(self):
+        migration = import_module("email_log.migrations.0010_backfill_esp_message_id")
+        schema_editor = mock.Mock(connection=connections["default"])
+        with mock.patch.object(migration, "BATCH_SIZE", 2):
+            migration.backfill_esp_message_id(apps, schema_editor)
+
+    def test_copies_anymail_id(self):
+        emails = [
+            Email.objects.create(extra_headers={"anymail_id": f"id-{n}"})
+            for n in range(3)
+        ]
+        unsent = Email.objects.create(extra_headers={"anymail_id": None})
+        other = Email.objects.create(extra_headers={"X-Other": "1"})
+        kept = Email.objects.create(
+            extra_headers={"anymail_id": "old"}, esp_message_id="new"
+        )
+        self.backfill()
+        self.assertEqual(
+            [Email.objects.get(pk=email.pk).esp_message_id for email in emails],
+            ["id-0", "id-1", "id-2"],
+        )
+        unsent.refresh_from_db()
+        other.refresh_from_db()
+        kept.refresh_from_db()
+        self.assertEqual(unsent.esp_message_id, "")
+        self.assertEqual(other.esp_message_id, "")
+        self.assertEqual(kept.esp_message_id, "new")
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        call_command("index_email_log")
+        self.hello = Email.objects.create(
+            subject="Hello there",
+            body="First body",
+            recipients="alice@example.com",
+            extra_headers={"X-Campaign": "spring-sale"},
+        )
+        self.goodbye = Email.objects.create(
+            subject="Goodbye",
+            body="Second body with hello",
+            recipients="bob@example.com",
+        )
+
+    def search(self, search_term):
+        return list(search_emails(Email.objects.all(), search_term).order_by("pk"))
+
+    def test_search_columns(self):
+        self.assertEqual(self.search("HELLO"), [self.hello, self.goodbye])
+        self.assertEqual(self.search("alice@example"), [self.hello])
+        self.assertEqual(self.search("spring-sale"), [self.hello])
+
+    def test_every_term_matches(self):
+        self.assertEqual(self.search("hello second"), [self.goodbye])
+        self.assertEqual(self.search('"body with"'), [self.goodbye])
+        self.assertEqual(self.search('"body\\" with"'), [])
+
+    def test_index_follows_changes(self):
+        Email.objects.filter(pk=self.hello.pk).update(subject="Welcome")
+        self.assertEqual(self.search("welcome"), [self.hello])
+        self.assertEqual(self.search("hello"), [self.goodbye])
+        self.goodbye.delete()
+        self.assertEqual(self.search("hello"), [])
+
+    def test_short_terms_are_not_searched(self):
+        self.assertIsNone(search_emails(Email.objects.all(), "hello hi"))
+        self.assertIsNone(search_emails(Email.objects.all(), ""))
+
+    def test_without_fts_table(self):
+        call_command("index_email_log", "--drop")
+        self.assertIsNone(search_emails(Email.objects.all(), "hello"))
+
+    def test_without_triggers(self):
+        # Like a migration rebuilding the email table on SQLite
+        with connections["default"].cursor() as cursor:
+            cursor.execute('DROP TRIGGER "email_log_email_fts_insert"')
+        self.assertIsNone(search_emails(Email.objects.all(), "hello"))
+        call_command("index_email_log")
+        email = Email.objects.create(subject="Indexed again")
+        self.assertEqual(self.search("indexed"), [email])
+
+    def test_not_used_on_other_databases(self):
+        with mock.patch.object(connections["default"], "vendor", "postgresql"):
+            self.assertIsNone(search_emails(Email.objects.all(), "hello"))
+
+
+class UniqueEventMigrationTests(TestCase):
+    def run_migration(self, function, relkind):
+        migration = import_module("email_log.migrations.0012_log_unique_event")
+        schema_editor = mock.MagicMock()
+        schema_editor.connection.vendor = "postgresql"
+        cursor = schema_editor.connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (relkind,)
+        schema_editor.quote_name.side_effect = lambda name: f'"{name}"'
+        getattr(migration, function)(apps, schema_editor)
+        return schema_editor
+
+    def test_constraint(self):
+        schema_editor = self.run_migration("add_unique_event", "r")
+        model, constraint = schema_editor.add_constraint.call_args.args
+        self.assertEqual(constraint.name, "email_log_log_unique_event")
+        schema_editor = self.run_migration("remove_unique_event", "r")
+        self.assertTrue(schema_editor.remove_constraint.called)
+
+    def test_partitioned_logs(self):
+        schema_editor = self.run_migration("add_unique_event", "p")
+        self.assertFalse(schema_editor.add_constraint.called)
+        schema_editor.execute.assert_called_once_with(
+            'CREATE UNIQUE INDEX IF NOT EXISTS "email_log_log_unique_event_part_idx" '
+            'ON "email_log_log" ("esp", "event_id", "timestamp") '
+            "WHERE \"event_id\" <> ''"
+        )
+        schema_editor = self.run_migration("remove_unique_event", "p")
+        schema_editor.execute.assert_called_once_with(
+            'DROP INDEX IF EXISTS "email_log_log_unique_event_part_idx"'
+        )
+
+
+class DeleteDuplicateLogsMigrationTests(TransactionTestCase):
+    before = [("email_log", "0010_backfill_esp_message_id")]
+    after = [("email_log", "0012_log_unique_event")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connections["default"])
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(
+            MigrationExecutor(connections["default"]).loader.graph.leaf_nodes()
+        )
+
+    def test_keeps_first_log_of_each_event(self):
+        old_apps = self.migrate(self.before)
+        OldEmail = old_apps.get_model("email_log", "Email")
+        OldLog = old_apps.get_model("email_log", "Log")
+        email = OldEmail.objects.create()
+
+        def create_log(esp, event_id):
+            return OldLog.objects.create(
+                email=email,
+                esp=esp,
+                event_id=event_id,
+                type="delivered",
+                metadata={},
+                timestamp=now(),
+                tags=[],
+                raw={},
+            ).pk
+
+        kept = [
+            create_log("esp", "1"),
+            create_log("other", "1"),
+            create_log("esp", "2"),
+            create_log("esp", ""),
+            create_log("esp", ""),
+        ]
+        for esp, event_id in [("esp", "1"), ("esp", "1"), ("esp", "2")]:
+            create_log(esp, event_id)
+
+        self.migrate(self.after)
+        self.assertEqual(
+            list(Log.objects.order_by("pk").values_list("pk", flat=True)), kept
+        )
+
+
+class AddIndexConcurrentlyTests(TestCase):
+    def run_operation(self, direction, vendor, in_atomic_block=False, relkind="r"):
+        migration = import_module("email_log.migrations.0017_log_email_timestamp_index")
+        (operation,) = migration.Migration.operations
+        schema_editor = mock.Mock()
+        schema_editor.connection = mock.MagicMock(
+            alias="default", vendor=vendor, in_atomic_block=in_atomic_block
+        )
+        cursor = schema_editor.connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (relkind,)
+        state = mock.Mock(apps=apps)
+        getattr(operation, f"database_{direction}")(
+            "email_log", schema_editor, state, state
+        )
+        return schema_editor
+
+    def test_concurrently_on_postgresql(self):
+        schema_editor = self.run_operation("forwards", "postgresql")
+        model, index = schema_editor.add_index.call_args.args
+        self.assertEqual(model, Log)
+        self.assertEqual(index.name, "email_log_log_email_time")
+        self.assertEqual(
+            schema_editor.add_index.call_args.kwargs, {"concurrently": True}
+        )
+        schema_editor = self.run_operation("backwards", "postgresql")
+        self.assertEqual(
+            schema_editor.remove_index.call_args.kwargs, {"concurrently": True}
+        )
+
+    def test_not_in_a_transaction_on_postgresql(self):
+        with self.assertRaises(NotSupportedError):
+            self.run_operation("forwards", "postgresql", in_atomic_block=True)
+
+    def test_partitioned_table_on_postgresql(self):
+        schema_editor = self.run_operation(
+            "forwards", "postgresql", in_atomic_block=True, relkind="p"
+        )
+        self.assertEqual(schema_editor.add_index.call_args.kwargs, {})
+
+    def test_plain_index_on_other_databases(self):
+        schema_editor = self.run_operation("forwards", "sqlite")
+        self.assertEqual(schema_editor.add_index.call_args.kwargs, {})
+        schema_editor = self.run_operation("backwards", "sqlite")
+        self.assertEqual(schema_editor.remove_index.call_args.kwargs, {})
+
+
+class RedundantIndexesMigrationTests(TransactionTestCase):
+    def migrate(self, targets):
+        executor = MigrationExecutor(connections["default"])
+        executor.loader.build_graph()
+        executor.migrate(targets)
+
+    def tearDown(self):
+        self.migrate(
+            MigrationExecutor(connections["default"]).loader.graph.leaf_nodes()
+        )
+
+    def single_column_indexes(self):
+        connection = connections["default"]
+        columns = set()
+        with connection.cursor() as cursor:
+            for table in ("email_log_email", "email_log_log"):
+                constraints = connection.introspection.get_constraints(cursor, table)
+                for constraint in constraints.values():
+                    if constraint["index"] and not constraint["unique"]:
+                        if len(constraint["columns"]) == 1:
+                            columns.update(constraint["columns"])
+        return columns
+
+    def run_on_postgresql(self, function, relkind):
+        migration = import_module("email_log.migrations.0018_email_failed_index")
+        schema_editor = mock.MagicMock()
+        schema_editor.connection.vendor = "postgresql"
+        cursor = schema_editor.connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (relkind,)
+        schema_editor._constraint_names.return_value = ["email_log_email_ok_idx"]
+        getattr(migration, function)(apps, schema_editor)
+        return schema_editor
+
+    def test_concurrently_on_postgresql(self):
+        schema_editor = self.run_on_postgresql("drop_redundant_indexes", "r")
+        for call in schema_editor._delete_index_sql.call_args_list:
+            self.assertEqual(call.kwargs, {"concurrently": True})
+        self.assertEqual(schema_editor._delete_index_sql.call_count, 2)
+        schema_editor = self.run_on_postgresql("create_redundant_indexes", "r")
+        for call in schema_editor._create_index_sql.call_args_list:
+            self.assertEqual(call.kwargs["concurrently"], True)
+
+    def test_partitioned_table_on_postgresql(self):
+        schema_editor = self.run_on_postgresql("drop_redundant_indexes", "p")
+        for call in schema_editor._delete_index_sql.call_args_list:
+            self.assertEqual(call.kwargs, {})
+        self.assertEqual(schema_editor._delete_index_sql.call_count, 2)
+        schema_editor = self.run_on_postgresql("create_redundant_indexes", "p")
+        for call in schema_editor._create_index_sql.call_args_list:
+            self.assertNotIn("concurrently", call.kwargs)
+
+    def test_drops_indexes_without_rebuilding_tables(self):
+        call_command("index_email_log")
+        self.addCleanup(call_command, "index_email_log", "--drop")
+        self.assertFalse({"ok", "email_id"} & self.single_column_indexes())
+        self.migrate([("email_log", "0017_log_email_timestamp_index")])
+        self.assertLessEqual({"ok", "email_id"}, self.single_column_indexes())
+        self.migrate([("email_log", "0018_email_failed_index")])
+        self.assertFalse({"ok", "email_id"} & self.single_column_indexes())
+        # The triggers of the search table are still there
+        email = Email.objects.create(subject="Indexed subject")
+        self.assertEqual(list(search_emails(Email.objects.all(), "indexed")), [email])
+
+
+@override_settings(EMAIL_BACKEND="email_log.backends.EmailBackend")
+class CaptureEmailBackendTests(TestCase):
+    def send(self, **kwargs):
+        message = EmailMultiAlternatives(
+            "Subject line",
+            "Message body " * 100,
+            "from@example.com",
+            ["to@example.com"],
+            headers={"X-Campaign": "launch", "X-Token": "secret"},
+            **kwargs,
+        )
+        message.attach_alternative("<p>HTML</p>" * 100, "text/html")
+        message.send()
+        return Email.objects.get()
+
+    @override_settings(
+        EMAIL_LOG_CAPTURE={"html_message": False, "extra_headers": False}
+    )
+    def test_skip_fields(self):
+        email = self.send()
+        self.assertEqual(email.html_message, "")
+        self.assertEqual(email.extra_headers, {})
+        self.assertEqual(email.body, "Message body " * 100)
+        self.assertEqual(len(mail.outbox[0].alternatives), 1)
+
+    @override_settings(
+        EMAIL_LOG_CAPTURE={"body": 50, "extra_headers": 4, "subject": 50}
+    )
+    def test_truncate_fields(self):
+        email = self.send()
+        self.assertEqual(len(email.body), 50)
+        self.assertTrue(email.body.startswith("Message body"))
+        self.assertTrue(email.body.endswith(TRUNCATION_MARKER))
+        self.assertEqual(email.subject, "Subject line")
+        self.assertEqual(
+            email.extra_headers,
+            {"X-Campaign": TRUNCATION_MARKER, "X-Token": TRUNCATION_MARKER},
+        )
+        self.assertEqual(mail.outbox[0].body, "Message body " * 100)
+
+    def test_callable(self):
+        def redact(headers, message):
+            self.assertEqual(message.subject, "Subject line")
+            return {
+                name: "***" if name == "X-Token" else value
+                for name, value in headers.items()
+            }
+
+        with override_settings(
+            EMAIL_LOG_CAPTURE={
+                "extra_headers": redact,
+                "bcc_recipients": lambda value, message: value.count("@"),
+            }
+        ):
+            email = self.send(bcc=["a@example.com", "b@example.com"])
+        self.assertEqual(
+            email.extra_headers, {"X-Campaign": "launch", "X-Token": "***"}
+        )
+        self.assertEqual(email.bcc_recipients, "2")
+
+    @override_settings(EMAIL_LOG_CAPTURE={"subject": True})
+    def test_keep_field(self):
+        self.assertEqual(self.send().subject, "Subject line")
+
+    @override_settings(EMAIL_LOG_CAPTURE={"attachments": False, "from": False})
+    def test_unknown_fields(self):
+        with self.assertLogs() as captured:
+            message = EmailMessage(
+                "Subject", "Body", "from@example.com", ["to@example.com"]
+            )
+            message.send()
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertIn(
+            "EMAIL_LOG_CAPTURE has unknown fields: attachments, from",
+            captured.output[0],
+        )
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_truncate(self):
+        self.assertEqual(truncate("short", 5), "short")
+        self.assertEqual(truncate("longer", 5), TRUNCATION_MARKER)
+        self.assertEqual(truncate(None, 5), None)
+
+
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.EmailBackend", EMAIL_LOG_COMPRESS=True
+)
+class CompressionTests(TestCase):
+    html = "<table><tr><td>Your order has shipped</td></tr></table>\n" * 200
+
+    def send(self, body="Your order has shipped.\n" * 200):
+        message = EmailMultiAlternatives(
+            "Shipped", body, "from@example.com", ["to@example.com"]
+        )
+        message.attach_alternative(self.html, "text/html")
+        message.send()
+        return Email.objects.get()
+
+    def test_compressed_on_send(self):
+        email = self.send()
+        self.assertEqual(email.body, "")
+        self.assertEqual(email.html_message, "")
+        self.assertLess(len(email.body_compressed), len(self.html) // 20)
+        self.assertEqual(email.get_body(), "Your order has shipped.\n" * 200)
+        self.assertEqual(email.get_html_message(), self.html)
+        self.assertEqual(mail.outbox[0].alternatives[0][0], self.html)
+
+    def test_empty_fields_are_not_compressed(self):
+        email = self.send(body="")
+        self.assertIsNone(email.body_compressed)
+        self.assertEqual(email.get_body(), "")
+
+    @override_settings(EMAIL_LOG_COMPRESS=False)
+    def test_uncompressed(self):
+        email = self.send()
+        self.assertIsNone(email.html_message_compressed)
+        self.assertEqual(email.get_html_message(), self.html)
+
+    def test_dictionary(self):
+        dictionary = b"<table><tr><td>Your order has shipped</td></tr></table>"
+        with override_settings(EMAIL_LOG_COMPRESSION_DICTIONARY=dictionary):
+            compressed = compress(
+                "<table><tr><td>Your order has shipped</td></tr></table>"
+            )
+            self.assertLess(len(compressed), len(compress("")) + 10)
+            self.assertEqual(
+                decompress(memoryview(compressed)),
+                "<table><tr><td>Your order has shipped</td></tr></table>",
+            )
+            # Content compressed without the dictionary can still be read
+            with override_settings(EMAIL_LOG_COMPRESSION_DICTIONARY=None):
+                plain = compress("plain")
+            self.assertEqual(decompress(plain), "plain")
+        with self.assertRaises(zlib.error):
+            decompress(compressed)
+
+    def test_admin(self):
+        email = self.send()
+        user = User(username="user", is_superuser=True, is_staff=True)
+        user.set_password("pass")
+        user.save()
+        self.client.login(username="user", password="pass")
+        page = self.client.get(f"/admin/email_log/email/{email.pk}/", follow=True)
+        self.assertContains(page, "Your order has shipped.<br>Your order", html=False)
+        self.assertContains(page, "&lt;table&gt;&lt;tr&gt;", html=False)
+        self.assertContains(page, "<iframe", html=False)
+
+
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.EmailBackend", EMAIL_LOG_DEDUPLICATE_BODIES=True
+)
+class DeduplicateBodiesTests(TestCase):
+    html = "<p>Scheduled maintenance tonight</p>"
+
+    def build_messages(self, count, body="Scheduled maintenance tonight"):
+        messages = build_messages(count, body)
+        for message in messages:
+            message.attach_alternative(self.html, "text/html")
+        return messages
+
+    def assert_shared(self, count):
+        self.assertEqual(Content.objects.count(), 2)
+        emails = Email.objects.all()
+        self.assertEqual(len(emails), count)
+        for email in emails:
+            self.assertEqual((email.body, email.html_message), ("", ""))
+            self.assertEqual(email.get_body(), "Scheduled maintenance tonight")
+            self.assertEqual(email.get_html_message(), self.html)
+        self.assertEqual(len({email.body_content_id for email in emails}), 1)
+
+    def test_broadcast_stores_bodies_once(self):
+        get_connection().send_messages(self.build_messages(5))
+        self.assert_shared(5)
+        self.assertEqual(Email.objects.filter(ok=True).count(), 5)
+
+    @override_settings(EMAIL_LOG_BULK_WRITES=True)
+    def test_bulk_writes(self):
+        # One INSERT for the contents, one SELECT locking them and one INSERT
+        # for the emails, in a transaction (a savepoint here), and one UPDATE
+        with self.assertNumQueries(6):
+            get_connection().send_messages(self.build_messages(5))
+        self.assert_shared(5)
+
+    def test_queued_records(self):
+        records = [(build_email(m), None) for m in self.build_messages(3)]
+        write_queued_records(records)
+        self.assert_shared(3)
+
+    @override_settings(EMAIL_BACKEND="email_log.backends.AsyncEmailBackend")
+    def test_async(self):
+        asend_messages(self.build_messages(3))
+        self.assert_shared(3)
+
+    def test_existing_contents_are_reused(self):
+        get_connection().send_messages(self.build_messages(1))
+        get_connection().send_messages(self.build_messages(2, body="Other"))
+        self.assertEqual(Content.objects.count(), 3)
+        self.assertEqual(
+            sorted(e.get_body() for e in Email.objects.all()),
+            ["Other", "Other", "Scheduled maintenance tonight"],
+        )
+
+    def test_contents_deleted_before_they_are_locked(self):
+        get_connection().send_messages(self.build_messages(1))
+        Email.objects.all().delete()
+        bulk_create = Content.objects.bulk_create
+
+        def prune_after_insert(contents, **kwargs):
+            bulk_create(contents, **kwargs)
+            # As if prune_email_log deleted them before they were locked
+            Content.objects.all().delete()
+            patcher.stop()
+
+        patcher = mock.patch.object(
+            Content.objects, "bulk_create", side_effect=prune_after_insert
+        )
+        patcher.start()
+        with self.assertNoLogs(level="ERROR"):
+            get_connection().send_messages(self.build_messages(1))
+        self.assert_shared(1)
+
+    def test_empty_body(self):
+        get_connection().send_messages(self.build_messages(1, body=""))
+        email = Email.objects.get()
+        self.assertIsNone(email.body_content)
+        self.assertEqual(email.get_body(), "")
+        self.assertEqual(Content.objects.count(), 1)
+
+    @override_settings(EMAIL_LOG_COMPRESS=True)
+    def test_compressed_contents(self):
+        get_connection().send_messages(self.build_messages(2))
+        content = Content.objects.get(
+            digest=hashlib.sha256(self.html.encode()).hexdigest()
+        )
+        self.assertEqual(content.text, "")
+        self.assertIsNotNone(content.compressed)
+        self.assertEqual(str(content), content.digest)
+        self.assert_shared(2)
+
+
+def skip_noreply(message):
+    return policies.by_sender({"noreply@example.com": policies.SKIP})
+
+
+@override_settings(EMAIL_BACKEND="email_log.backends.EmailBackend")
+class LoggingPolicyTests(TestCase):
+    def build_message(self, from_email="from@example.com", headers=None):
+        message = EmailMessage(
+            "Subject line",
+            "Message body",
+            from_email,
+            ["to@example.com"],
+            headers=headers,
+        )
+        message.attach("file.txt", b"test", "text/plain")
+        return message
+
+    def test_default_policy_logs(self):
+        self.assertEqual(policies.get_decision(self.build_message()), policies.LOG)
+
+    @override_settings(EMAIL_LOG_POLICY=lambda message: "maybe")
+    def test_unknown_decision(self):
+        with self.assertRaises(ValueError):
+            policies.get_decision(self.build_message())
+
+    @override_settings(EMAIL_LOG_POLICY="tests.test_email_log.skip_noreply")
+    def test_dotted_path_and_nested_policies(self):
+        self.assertEqual(
+            policies.get_decision(self.build_message("noreply@example.com")),
+            policies.SKIP,
+        )
+        self.assertEqual(policies.get_decision(self.build_message()), policies.LOG)
+
+    def test_by_header(self):
+        policy = policies.by_header(
+            "X-Category", {"alert": policies.LOG_WITHOUT_ATTACHMENTS}, policies.SKIP
+        )
+        message = self.build_message(headers={"x-category": "alert"})
+        self.assertEqual(policy(message), policies.LOG_WITHOUT_ATTACHMENTS)
+        self.assertEqual(policy(self.build_message()), policies.SKIP)
+
+    def test_sample(self):
+        policy = policies.sample(0.25, otherwise=policies.LOG_IF_FAILED)
+        with mock.patch("random.random", return_value=0.1):
+            self.assertEqual(policy(self.build_message()), policies.LOG)
+        with mock.patch("random.random", return_value=0.5):
+            self.assertEqual(policy(self.build_message()), policies.LOG_IF_FAILED)
+
+    @override_settings(EMAIL_LOG_POLICY=policies.log_all)
+    def test_log_all(self):
+        self.assertEqual(mail.get_connection().send_messages([self.build_message()]), 1)
+        self.assertTrue(Email.objects.get().ok)
+
+    @override_settings(EMAIL_LOG_POLICY=lambda message: policies.SKIP)
+    def test_skip_without_queries(self):
+        for bulk_writes in (False, True):
+            with self.subTest(bulk_writes=bulk_writes), override_settings(
+                EMAIL_LOG_BULK_WRITES=bulk_writes
+            ), self.assertNumQueries(0):
+                sent = mail.get_connection().send_messages([self.build_message()])
+            self.assertEqual(sent, 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(EMAIL_LOG_POLICY=policies.log_failures)
+    def test_log_failures_skips_sent_messages(self):
+        for bulk_writes in (False, True):
+            with self.subTest(bulk_writes=bulk_writes), override_settings(
+                EMAIL_LOG_BULK_WRITES=bulk_writes
+            ), self.assertNumQueries(0):
+                mail.get_connection().send_messages([self.build_message()])
+
+    @override_settings(
+        EMAIL_LOG_POLICY=policies.log_failures, EMAIL_LOG_BACKEND=FAILING_BACKEND
+    )
+    def test_log_failures(self):
+        for bulk_writes in (False, True):
+            with self.subTest(bulk_writes=bulk_writes), override_settings(
+                EMAIL_LOG_BULK_WRITES=bulk_writes
+            ):
+                with self.assertRaises(NotImplementedError):
+                    mail.get_connection().send_messages([self.build_message()])
+        self.assertEqual(Email.objects.filter(ok=False).count(), 2)
+
+    @override_settings(
+        EMAIL_LOG_POLICY=policies.log_failures,
+        EMAIL_LOG_BACKEND=FAILING_BACKEND,
+        EMAIL_LOG_SAVE_ATTACHMENTS=True,
+        EMAIL_LOG_ATTACHMENTS_PATH=ATTACHMENTS_TEST_FOLDER,
+    )
+    def test_log_failures_with_attachments(self):
+        try:
+            connection = mail.get_connection(fail_silently=True)
+            self.assertEqual(connection.send_messages([self.build_message()]), 0)
+            self.assertEqual(Email.objects.get().attachments.count(), 1)
+        finally:
+            shutil.rmtree(ATTACHMENTS_TEST_FOLDER, ignore_errors=True)
+
+    @override_settings(
+        EMAIL_LOG_POLICY=policies.log_failures, EMAIL_LOG_BACKEND=FAILING_BACKEND
+    )
+    def test_log_failures_db_problem(self):
+        with mock.patch.object(Email, "save", side_effect=Exception("DB problem")):
+            with self.assertLogs() as captured:
+                connection = mail.get_connection(fail_silently=True)
+                self.assertEqual(connection.send_messages([self.build_message()]), 0)
+        self.assertEqual(
+            [record.getMessage() for record in captured.records],
+            ["Failed to save email to database (create)"],
+        )
+
+    @override_settings(
+        EMAIL_LOG_POLICY=lambda message: policies.LOG_WITHOUT_ATTACHMENTS,
+        EMAIL_LOG_SAVE_ATTACHMENTS=True,
+    )
+    def test_log_without_attachments(self):
+        for bulk_writes in (False, True):
+            with self.subTest(bulk_writes=bulk_writes), override_settings(
+                EMAIL_LOG_BULK_WRITES=bulk_writes
+            ):
+                mail.get_connection().send_messages([self.build_message()])
+        self.assertEqual(Email.objects.filter(ok=True).count(), 2)
+        self.assertFalse(Attachment.objects.exists())
+
+    @override_settings(EMAIL_LOG_POLICY=skip_noreply, EMAIL_LOG_BULK_WRITES=True)
+    def test_bulk_writes_mixed_decisions(self):
+        messages = [
+            self.build_message("noreply@example.com"),
+            self.build_message(),
+            self.build_message("noreply@example.com"),
+        ]
+        with self.assertNumQueries(2):
+            self.assertEqual(mail.get_connection().send_messages(messages), 3)
+        self.assertEqual(
+            list(Email.objects.values_list("from_email", "ok")),
+            [("from@example.com", True)],
+        )
+
+
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.EmailBackend", EMAIL_LOG_QUEUE=True
+)
+class QueuedLoggingPolicyTests(TestCase):
+    def setUp(self):
+        self.writer = QueuedLogWriter(write=write_queued_records)
+        patchers = [
+            mock.patch("email_log.backends._log_writer", self.writer),
+            mock.patch.object(QueuedLogWriter, "start"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @override_settings(EMAIL_LOG_POLICY=lambda message: policies.SKIP)
+    def test_skip(self):
+        self.assertEqual(mail.get_connection().send_messages(build_messages(2)), 2)
+        self.assertEqual(self.writer.queue.qsize(), 0)
+
+    @override_settings(EMAIL_LOG_POLICY=policies.log_failures)
+    def test_log_failures_skips_sent_messages(self):
+        mail.get_connection().send_messages(build_messages(2))
+        self.assertEqual(self.writer.queue.qsize(), 0)
+
+    @override_settings(
+        EMAIL_LOG_POLICY=policies.log_failures, EMAIL_LOG_BACKEND=FAILING_BACKEND
+    )
+    def test_log_failures(self):
+        connection = mail.get_connection(fail_silently=True)
+        self.assertEqual(connection.send_messages(build_messages(2)), 0)
+        self.writer.flush()
+        self.assertEqual(Email.objects.filter(ok=False).count(), 2)
+
+    @override_settings(
+        EMAIL_LOG_POLICY=lambda message: policies.LOG_WITHOUT_ATTACHMENTS,
+        EMAIL_LOG_SAVE_ATTACHMENTS=True,
+    )
+    def test_log_without_attachments(self):
+        message = build_messages(1)[0]
+        message.attach("file.txt", b"test", "text/plain")
+        with self.assertNoLogs(level="ERROR"):
+            mail.get_connection().send_messages([message])
+            self.writer.flush()
+        self.assertTrue(Email.objects.get().ok)
+        self.assertFalse(Attachment.objects.exists())
+
+
+@override_settings(EMAIL_BACKEND="email_log.backends.AsyncEmailBackend")
+class AsyncLoggingPolicyTests(TestCase):
+    @override_settings(EMAIL_LOG_POLICY=lambda message: policies.SKIP)
+    def test_skip_without_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(asend_messages(build_messages(2)), 2)
+
+    @override_settings(EMAIL_LOG_POLICY=policies.log_failures)
+    def test_log_failures_skips_sent_messages(self):
+        with self.assertNumQueries(0):
+            asend_messages(build_messages(2))
+
+    @override_settings(
+        EMAIL_LOG_POLICY=policies.log_failures, EMAIL_LOG_BACKEND=FAILING_BACKEND
+    )
+    def test_log_failures(self):
+        with self.assertRaises(NotImplementedError):
+            asend_messages(build_messages(2))
+        self.assertEqual(Email.objects.filter(ok=False).count(), 2)
+
+    @override_settings(
+        EMAIL_LOG_POLICY=lambda message: policies.LOG_WITHOUT_ATTACHMENTS,
+        EMAIL_LOG_SAVE_ATTACHMENTS=True,
+    )
+    def test_log_without_attachments(self):
+        message = build_messages(1)[0]
+        message.attach("file.txt", b"test", "text/plain")
+        asend_messages([message])
+        self.assertTrue(Email.objects.get().ok)
+        self.assertFalse(Attachment.objects.exists())
+
+
+@override_settings(
+    EMAIL_BACKEND="email_log.backends.AsyncEmailBackend", EMAIL_LOG_RECIPIENTS=True
+)
+class RecipientTests(TestCase):
+    def build_message(self, to="Alice <Alice@Example.com>"):
+        return EmailMessage(
+            "Subject line",
+            "Message body",
+            "from@example.com",
+            [to, "bob@example.com"],
+            cc=["carol@example.com"],
+            bcc=["alice@example.com"],
+        )
+
+    def recipients(self):
+        return sorted(Recipient.objects.values_list("address", "kind"))
+
+    def test_send_message(self):
+        mail.get_connection().send_messages([self.build_message()])
+        self.assertEqual(
+            self.recipients(),
+            [
+                ("alice@example.com", "bcc"),
+                ("alice@example.com", "to"),
+                ("bob@example.com", "to"),
+                ("carol@example.com", "cc"),
+            ],
+        )
+
+    def test_sent_to(self):
+        mail.get_connection().send_messages(
+            [self.build_message(), self.build_message(to="dave@example.com")]
+        )
+        first, second = Email.objects.order_by("pk")
+        self.assertEqual(
+            list(Email.objects.sent_to("ALICE@example.com", Recipient.TO)), [first]
+        )
+        self.assertEqual(list(Email.objects.sent_to("dave@example.com")), [second])
+        self.assertEqual(
+            list(Email.objects.sent_to("Bob <bob@example.com>").order_by("pk")),
+            [first, second],
+        )
+        self.assertEqual(list(Email.objects.sent_to("bob@example.com", "cc")), [])
+        self.assertEqual(
+            list(Email.objects.filter(ok=True).sent_to("dave@example.com")), [second]
+        )
+
+    @override_settings(EMAIL_LOG_BULK_WRITES=True)
+    def test_bulk_writes(self):
+        # One INSERT each for the emails and their recipients, one UPDATE
+        with self.assertNumQueries(3):
+            mail.get_connection().send_messages([self.build_message()] * 3)
+        self.assertEqual(Recipient.objects.count(), 12)
+
+    def test_asend_messages(self):
+        async_to_sync(mail.get_connection().asend_messages)([self.build_message()])
+        self.assertEqual(len(self.recipients()), 4)
+
+    def test_queued_writes(self):
+        email = build_email(self.build_message())
+        write_queued_records([(email, None)])
+        self.assertEqual(email.recipient_set.count(), 4)
+
+    @override_settings(
+        EMAIL_LOG_POLICY="email_log.policies.log_failures",
+        EMAIL_LOG_BACKEND=FAILING_BACKEND,
+    )
+    def test_failed_message(self):
+        mail.get_connection(fail_silently=True).send_messages([self.build_message()])
+        self.assertEqual(len(self.recipients()), 4)
+
+    @override_settings(EMAIL_LOG_CAPTURE={"recipients": False, "bcc_recipients": 5})
+    def test_capture_policy(self):
+        mail.get_connection().send_messages([self.build_message()])
+        self.assertEqual(self.recipients(), [("carol@example.com", "cc")])
+
+    def test_str(self):
+        self.assertEqual(str(Recipient(address="to@example.com")), "to@example.com")
+
+    @override_settings(EMAIL_LOG_RECIPIENTS=False)
+    def test_disabled(self):
+        mail.get_connection().send_messages([self.build_message()])
+        self.assertFalse(Recipient.objects.exists())
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        Email.objects.bulk_create(Email(subject=str(number)) for number in range(5))
+
+    @override_settings(EMAIL_LOG_ADMIN_COUNT_LIMIT=3)
+    def test_count_is_capped(self):
+        paginator = EstimatedCountPaginator(Email.objects.all(), 2)
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(paginator.num_pages, 2)
+
+    def test_count_below_limit(self):
+        self.assertEqual(EstimatedCountPaginator(Email.objects.all(), 2).count, 5)
+
+    @override_settings(EMAIL_LOG_ADMIN_COUNT_LIMIT=None)
+    def test_no_limit(self):
+        self.assertEqual(EstimatedCountPaginator(Email.objects.all(), 2).count, 5)
+
+    @override_settings(EMAIL_LOG_ADMIN_COUNT_LIMIT=3)
+    def test_large_estimate_is_used(self):
+        paginator = EstimatedCountPaginator(Email.objects.all(), 2)
+        with mock.patch(
+            "email_log.pagination.estimate_count", return_value=10**8
+        ), self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 10**8)
+
+    def test_no_estimate_without_postgresql(self):
+        self.assertIsNone(estimate_count(Email.objects.all()))
+
+    def test_estimate_on_postgresql(self):
+        connection = mock.MagicMock(vendor="postgresql")
+        connection.ops.quote_name.side_effect = lambda name: f'"{name}"'
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (1234.0,)
+        with mock.patch.dict("email_log.pagination.connections", default=connection):
+            self.assertEqual(estimate_count(Email.objects.all()), 1234)
+            self.assertIsNone(estimate_count(Email.objects.filter(ok=True)))
+        self.assertEqual(cursor.execute.call_args[0][1], ['"email_log_email"'] * 2)
+
+
+class IndexUsageTests(TestCase):
+    """The admin and tracking handler queries read the indexes made for them"""
+
+    def assertUsesIndex(self, queryset, index, ordered=True):
+        plan = queryset.explain()
+        self.assertRegex(plan, rf"USING (COVERING )?INDEX {index}")
+        if ordered:
+            # Rows are read in index order rather than sorted
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_admin_email_list(self):
+        emails = Email.objects.all()
+        self.assertUsesIndex(emails[:100], "email_log_email_date_sent_")
+        self.assertUsesIndex(emails.filter(ok=True)[:100], "email_log_email_date_sent_")
+        self.assertUsesIndex(emails.filter(ok=False)[:100], "email_log_email_failed")
+        self.assertUsesIndex(
+            emails.filter(ok=False, date_sent__gte=now())[:100],
+            "email_log_email_failed",
+        )
+
+    def test_admin_log_inline(self):
+        logs = Log.objects.filter(email_id=1)
+        self.assertUsesIndex(
+            logs.order_by("timestamp", "pk").values_list("pk", "timestamp")[:51],
+            "email_log_log_email_time",
+        )
+        self.assertUsesIndex(
+            logs.order_by("type").values_list("type").annotate(Count("pk")),
+            "email_log_log_email_time",
+            ordered=False,
+        )
+
+    def test_tracking_handler(self):
+        self.assertUsesIndex(
+            Email.objects.filter(esp_message_id__in=["a", "b"]).values_list(
+                "esp_message_id", "pk"
+            ),
+            "email_log_email_esp_message_id_",
+            # The few emails sharing a message id are sorted newest first
+            ordered=False,
+        )
+        # Deleting an email cascades to its logs through the same index
+        self.assertUsesIndex(
+            Log.objects.filter(email_id=1).values_list("pk"),
+            "email_log_log_email_time",
+        )
+
+
 class AdminNonsuperuserTests(TestCase):
     def setUp(self):
         # Can login to admin site but is not a superuser
@@ -575,6 +2311,256 @@ class AdminWithEmailLogsSuperuserTests(BaseAdminSuperuserTests):
         self.assertEqual(page.status_code, 403)
 
 
+class AdminListScalingTests(BaseAdminSuperuserTests):
+    url = "/admin/email_log/email/"
+
+    def setUp(self):
+        super().setUp()
+        Email.objects.bulk_create(
+            Email(subject=f"Email {number}") for number in range(5)
+        )
+        self.old = Email.objects.create(subject="Old email")
+        Email.objects.filter(pk=self.old.pk).update(
+            date_sent=now() - timedelta(days=60)
+        )
+
+    def subjects(self, response):
+        return [email.subject for email in response.context["cl"].result_list]
+
+    def test_default_date_window(self):
+        response = self.client.get(self.url)
+        self.assertNotIn("Old email", self.subjects(response))
+        self.assertContains(response, "Past 30 days")
+        self.assertFalse(response.context["cl"].show_full_result_count)
+
+    def test_any_date(self):
+        tomorrow = now() + timedelta(days=1)
+        response = self.client.get(self.url, {"date_sent__lt": tomorrow.isoformat()})
+        self.assertIn("Old email", self.subjects(response))
+
+    @override_settings(EMAIL_LOG_ADMIN_DATE_WINDOW=None)
+    def test_no_date_window(self):
+        response = self.client.get(self.url)
+        self.assertIn("Old email", self.subjects(response))
+        self.assertNotContains(response, "Past 30 days")
+
+    @override_settings(EMAIL_LOG_ADMIN_KEYSET_PAGINATION=True)
+    def test_keyset_pagination(self):
+        with mock.patch.object(EmailAdmin, "list_per_page", 2):
+            tomorrow = now() + timedelta(days=1)
+            response = self.client.get(
+                self.url, {"date_sent__lt": tomorrow.isoformat()}
+            )
+            pages = [self.subjects(response)]
+            while response.context["cl"].next_page_url:
+                response = self.client.get(
+                    self.url + response.context["cl"].next_page_url
+                )
+                self.assertContains(response, "Newest")
+                pages.append(self.subjects(response))
+        expected = list(Email.objects.values_list("subject", flat=True))
+        self.assertEqual(pages, [expected[:2], expected[2:4], expected[4:]])
+
+    def test_search(self):
+        response = self.client.get(self.url, {"q": '"email 3"'})
+        self.assertEqual(self.subjects(response), ["Email 3"])
+        response = self.client.get(self.url, {"q": "3"})
+        self.assertEqual(self.subjects(response), ["Email 3"])
+
+    @override_settings(EMAIL_LOG_RECIPIENTS=True)
+    def test_recipient_filter(self):
+        email = Email.objects.get(subject="Email 2")
+        Recipient.objects.create(email=email, address="alice@example.com", kind="to")
+        response = self.client.get(self.url, {"recipient": "Alice@example.com"})
+        self.assertEqual(self.subjects(response), ["Email 2"])
+        response = self.client.get(self.url, {"ok__exact": "0"})
+        self.assertContains(
+            response, '<input type="hidden" name="ok__exact" value="0">'
+        )
+        self.assertContains(response, 'name="recipient" value=""')
+        self.assertEqual(len(self.subjects(response)), 5)
+
+    def test_no_recipient_filter_by_default(self):
+        self.assertNotContains(self.client.get(self.url), 'name="recipient"')
+
+    @override_settings(EMAIL_LOG_ADMIN_KEYSET_PAGINATION=True)
+    def test_keyset_pagination_invalid_cursor(self):
+        response = self.client.get(self.url, {"before": "yesterday"})
+        self.assertRedirects(response, self.url + "?e=1", fetch_redirect_response=False)
+
+    @override_settings(EMAIL_LOG_ADMIN_KEYSET_PAGINATION=True)
+    def test_keyset_pagination_disables_sorting(self):
+        response = self.client.get(self.url)
+        self.assertEqual(self.subjects(response)[0], "Email 4")
+        self.assertNotContains(response, "sortable")
+
+
+class LogInlineTests(BaseAdminSuperuserTests):
+    def setUp(self):
+        super().setUp()
+        self.email = Email.objects.create(subject="Campaign")
+        start = now()
+        types = ["opened", "clicked", "opened", "opened", "delivered"]
+        for number, event_type in enumerate(types):
+            Log.objects.create(
+                email=self.email,
+                esp="esp",
+                metadata={"large": "metadata"},
+                type=event_type,
+                # The last logs share a timestamp to exercise the id tie-breaker
+                timestamp=start + timedelta(minutes=min(number, 3)),
+                event_id=str(number),
+                tags=[],
+                raw={"event": number},
+            )
+        Log.objects.create(
+            email=Email.objects.create(),
+            esp="esp",
+            metadata={},
+            type="bounced",
+            timestamp=start,
+            event_id="other",
+            tags=[],
+            raw={},
+        )
+        self.url = f"/admin/email_log/email/{self.email.pk}/change/"
+
+    def get(self, query=""):
+        with mock.patch.object(LogInline, "per_page", 2):
+            return self.client.get(self.url + query)
+
+    def log_inline(self, response):
+        return response.context["inline_admin_formsets"][1]
+
+    def event_ids(self, response):
+        return [form.instance.event_id for form in self.log_inline(response).formset]
+
+    def test_type_counts(self):
+        response = self.get()
+        self.assertContains(response, "clicked: 1, delivered: 1, opened: 3")
+        self.assertNotContains(response, "bounced")
+
+    def test_pages(self):
+        response = self.get()
+        self.assertNotContains(response, "First logs")
+        pages = [self.event_ids(response)]
+        while self.log_inline(response).opts.next_cursor:
+            cursor = self.log_inline(response).opts.next_cursor
+            self.assertContains(response, "Next logs")
+            response = self.get("?" + urlencode({"logs_after": cursor}))
+            self.assertContains(response, "First logs")
+            pages.append(self.event_ids(response))
+        self.assertNotContains(response, "Next logs")
+        self.assertEqual(pages, [["0", "1"], ["2", "3"], ["4"]])
+
+    def test_invalid_cursor_shows_first_page(self):
+        self.assertEqual(self.event_ids(self.get("?logs_after=yesterday")), ["0", "1"])
+
+    def test_metadata_is_deferred(self):
+        response = self.get()
+        self.assertContains(response, "{&quot;event&quot;: 0}")
+        for form in self.log_inline(response).formset:
+            self.assertEqual(form.instance.get_deferred_fields(), {"metadata"})
+
+    def test_queries_do_not_grow_with_logs(self):
+        with CaptureQueriesContext(connections["default"]) as before:
+            self.get()
+        for number in range(20):
+            Log.objects.create(
+                email=self.email,
+                esp="esp",
+                metadata={},
+                type="opened",
+                timestamp=now(),
+                event_id=f"more-{number}",
+                tags=[],
+                raw={},
+            )
+        with CaptureQueriesContext(connections["default"]) as after:
+            self.get()
+        self.assertEqual(len(after), len(before))
+
+
+@override_settings(EMAIL_LOG_ADMIN_LAZY=True)
+class AdminLazyModeTests(BaseAdminSuperuserTests):
+    def setUp(self):
+        super().setUp()
+        self.email = Email.objects.create(
+            subject="Subject here",
+            body="Test email content",
+            html_message="<p>Secret HTML</p>",
+        )
+        for number in range(3):
+            Log.objects.create(
+                email=self.email,
+                esp="esp",
+                metadata={},
+                type="opened",
+                timestamp=now() + timedelta(minutes=number),
+                event_id=str(number),
+                tags=[],
+                raw={"event": f"raw-event-{number}"},
+            )
+        self.url = f"/admin/email_log/email/{self.email.pk}/"
+
+    def change_page(self, query=""):
+        with mock.patch.object(LogInline, "per_page", 2):
+            return self.client.get(f"{self.url}change/{query}")
+
+    def test_change_page_links_to_parts(self):
+        response = self.change_page()
+        self.assertNotContains(response, "Secret HTML")
+        self.assertNotContains(response, "raw-event")
+        self.assertContains(response, f'src="{self.url}html/"')
+        self.assertContains(response, f'href="{self.url}html/source/"')
+        log = Log.objects.get(event_id="0")
+        self.assertContains(response, f'href="{self.url}logs/{log.pk}/raw/"')
+
+    def test_raw_is_deferred(self):
+        response = self.change_page()
+        self.assertEqual(response.content.count(b"/raw/"), 2)
+        for form in response.context["inline_admin_formsets"][1].formset:
+            self.assertEqual(form.instance.get_deferred_fields(), {"metadata", "raw"})
+
+    def test_html_message(self):
+        response = self.client.get(f"{self.url}html/")
+        self.assertEqual(response.content, b"<p>Secret HTML</p>")
+        self.assertEqual(response["Content-Security-Policy"], "sandbox")
+        self.assertEqual(response["X-Frame-Options"], "SAMEORIGIN")
+        self.assertIn("max-age=86400", response["Cache-Control"])
+
+    def test_html_message_source(self):
+        response = self.client.get(f"{self.url}html/source/")
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+        self.assertEqual(response.content, b"<p>Secret HTML</p>")
+
+    def test_log_raw(self):
+        log = Log.objects.get(event_id="1")
+        response = self.client.get(f"{self.url}logs/{log.pk}/raw/")
+        self.assertEqual(response.json(), {"event": "raw-event-1"})
+        other = Email.objects.create()
+        response = self.client.get(
+            f"/admin/email_log/email/{other.pk}/logs/{log.pk}/raw/"
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_missing_email(self):
+        response = self.client.get("/admin/email_log/email/0/html/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_requires_view_permission(self):
+        user = User.objects.create_user("staff", password="pass", is_staff=True)
+        self.client.force_login(user)
+        response = self.client.get(f"{self.url}html/")
+        self.assertEqual(response.status_code, 403)
+
+    def test_email_without_html_message(self):
+        email = Email.objects.create(subject="Plain")
+        response = self.client.get(f"/admin/email_log/email/{email.pk}/change/")
+        self.assertContains(response, "No HTML content")
+        self.assertNotContains(response, "/html/source/")
+
+
 class ChecksTest(TestCase):
     def test_not_raising_warning_check(self):
         warnings = checks.run_checks(app_configs=apps.get_app_configs())
@@ -1,3 +1,7 @@
+import os
+import tracemalloc
+from datetime import timedelta
+from unittest import mock
 from unittest.mock import Mock
 
 from django.core.mail import EmailMultiAlternatives
@@ -8,8 +12,14 @@ from anymail.signals import AnymailTrackingEvent, post_send, tracking
 
 import email_log
 from email_log.apps import EmailLogConfig
-from email_log.models import Attachment, Email, Log
-from email_log.signal_handlers import handle_tracking_event, log_successful_email
+from email_log.models import Attachment, Content, Email, Log, PendingEvent
+from email_log.recorder import TRUNCATION_MARKER
+from email_log.signal_handlers import (
+    handle_tracking_event,
+    handle_tracking_events,
+    log_successful_email,
+    reconcile_pending_events,
+)
 
 
 class EmailLogConfigTestCase(TestCase):
@@ -81,6 +91,130 @@ class LogSuccessfulEmailTestCase(TestCase):
         self.assertEqual(Email.objects.count(), 1)
         email = Email.objects.first()
         self.assertEqual(email.html_message, self.html_content)
+        self.assertEqual(email.esp_message_id, "4561230987")
+        self.assertEqual(email.extra_headers["anymail_id"], "4561230987")
+
+    def test_log_successful_email_without_message_id(self):
+        mock_status = Mock()
+        mock_status.message_id = None
+        log_successful_email(
+            sender=Mock(),
+            message=self.message,
+            status=mock_status,
+            esp_name="test_esp",
+        )
+        self.assertEqual(Email.objects.get().esp_message_id, "")
+
+    def test_log_successful_email_with_message_id_per_recipient(self):
+        log_successful_email(
+            sender=Mock(),
+            message=self.message,
+            status=Mock(message_id={"2", "1"}),
+            esp_name="test_esp",
+        )
+        email = Email.objects.get()
+        self.assertEqual(email.esp_message_id, "")
+        self.assertEqual(email.extra_headers["anymail_id"], ["1", "2"])
+
+    def test_log_successful_email_headers(self):
+        self.message.cc = ["cc@example.com", "cc2@example.com"]
+        self.message.reply_to = ["reply@example.com"]
+        self.message.extra_headers["X-Campaign"] = "launch"
+        log_successful_email(
+            sender=Mock(),
+            message=self.message,
+            status=Mock(message_id="123"),
+            esp_name="test_esp",
+        )
+        self.assertEqual(
+            Email.objects.get().extra_headers,
+            {
+                "Cc": "cc@example.com, cc2@example.com",
+                "Reply-To": "reply@example.com",
+                "List-Unsubscribe": "<mailto:unsub@example.com>",
+                "X-Campaign": "launch",
+                "anymail_id": "123",
+            },
+        )
+
+    def test_log_successful_email_without_backend_connection(self):
+        with mock.patch("email_log.backends.get_connection") as get_connection:
+            log_successful_email(
+                sender=Mock(),
+                message=self.message,
+                status=Mock(message_id="123"),
+                esp_name="test_esp",
+            )
+        get_connection.assert_not_called()
+        email = Email.objects.get()
+        self.assertEqual(email.from_email, "from@example.com")
+        self.assertEqual(email.recipients, "to@example.com")
+        self.assertEqual(email.body, self.text_content)
+
+    @override_settings(EMAIL_LOG_CAPTURE={"html_message": False, "body": 20})
+    def test_log_successful_email_capture_policy(self):
+        log_successful_email(
+            sender=Mock(),
+            message=self.message,
+            status=Mock(message_id="123"),
+            esp_name="test_esp",
+        )
+        email = Email.objects.get()
+        self.assertEqual(email.html_message, "")
+        self.assertEqual(email.body, "Test " + TRUNCATION_MARKER)
+        self.assertEqual(email.esp_message_id, "123")
+
+    @override_settings(EMAIL_LOG_DEDUPLICATE_BODIES=True)
+    def test_log_successful_email_deduplicates_bodies(self):
+        for message_id in ("1", "2"):
+            log_successful_email(
+                sender=Mock(),
+                message=self.message,
+                status=Mock(message_id=message_id),
+                esp_name="test_esp",
+            )
+        self.assertEqual(Content.objects.count(), 2)
+        for email in Email.objects.all():
+            self.assertEqual(email.body, "")
+            self.assertEqual(email.get_body(), self.text_content)
+            self.assertEqual(email.get_html_message(), self.html_content)
+
+    def test_extra_headers_override_message_headers(self):
+        self.message.cc = ["cc@example.com"]
+        self.message.extra_headers = {"Cc": "Team <cc@example.com>"}
+        log_successful_email(
+            sender=Mock(),
+            message=self.message,
+            status=Mock(message_id="123"),
+            esp_name="test_esp",
+        )
+        self.assertEqual(
+            Email.objects.get().extra_headers,
+            {"Cc": "Team <cc@example.com>", "anymail_id": "123"},
+        )
+
+    @override_settings(EMAIL_LOG_SAVE_ATTACHMENTS=False)
+    def test_log_successful_email_with_large_attachments(self):
+        for number in range(10):
+            self.message.attach(f"{number}.bin", os.urandom(2**20))
+        with mock.patch.object(
+            self.message, "message", wraps=self.message.message
+        ) as render:
+            tracemalloc.start()
+            try:
+                log_successful_email(
+                    sender=Mock(),
+                    message=self.message,
+                    status=Mock(message_id="123"),
+                    esp_name="test_esp",
+                )
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        # Rendering the MIME message would base64 encode all 10 MiB of
+        # attachments, peaking at about 20 MiB.
+        render.assert_not_called()
+        self.assertLess(peak, 2**20)
 
     @override_settings(EMAIL_LOG_SAVE_ATTACHMENTS=False)
     def test_log_successful_email_but_no_attachments(self):
@@ -138,6 +272,47 @@ class LogSuccessfulEmailTestCase(TestCase):
             ],
         )
 
+    @override_settings(EMAIL_LOG_POLICY="email_log.policies.log_failures")
+    def test_log_failures_skips_sent_email(self):
+        mock_status = Mock(message_id="4561230987", status={"sent", "queued"})
+        with self.assertNumQueries(0):
+            log_successful_email(
+                sender=Mock(), message=self.message, status=mock_status, esp_name="esp"
+            )
+
+    @override_settings(EMAIL_LOG_POLICY="email_log.policies.log_failures")
+    def test_log_failures_logs_rejected_email(self):
+        mock_status = Mock(message_id="4561230987", status={"sent", "rejected"})
+        log_successful_email(
+            sender=Mock(), message=self.message, status=mock_status, esp_name="esp"
+        )
+        email = Email.objects.get()
+        self.assertEqual(email.esp_message_id, "4561230987")
+        self.assertFalse(email.ok)
+
+    @override_settings(EMAIL_LOG_POLICY=lambda message: "skip")
+    def test_skip(self):
+        with self.assertNumQueries(0):
+            log_successful_email(
+                sender=Mock(), message=self.message, status=Mock(), esp_name="esp"
+            )
+
+    @override_settings(
+        EMAIL_LOG_POLICY=lambda message: "log_without_attachments",
+        EMAIL_LOG_SAVE_ATTACHMENTS=True,
+    )
+    def test_log_without_attachments(self):
+        self.message.attach("data.json", '{"raw": "data"}', "application/json")
+        self.test_log_successful_email()
+        self.assertFalse(Attachment.objects.exists())
+
+    @override_settings(EMAIL_LOG_RECIPIENTS=True)
+    def test_log_successful_email_saves_recipients(self):
+        self.test_log_successful_email()
+        self.assertEqual(
+            list(Email.objects.sent_to("to@example.com")), [Email.objects.get()]
+        )
+
 
 class HandleTrackingEventTestCase(TestCase):
     def setUp(self):
@@ -163,12 +338,20 @@ class HandleTrackingEventTestCase(TestCase):
         )
         self.assertQuerySetEqual(email.logs.all(), Log.objects.none())
 
+    def test_handle_tracking_event_without_message_id(self):
+        Email.objects.create()
+        self.event.message_id = None
+        with self.assertNumQueries(0):
+            handle_tracking_event(sender=Mock(), event=self.event, esp_name="test_esp")
+        self.assertEqual(Log.objects.count(), 0)
+
+    def test_handle_tracking_event_ignores_extra_headers(self):
+        Email.objects.create(extra_headers={"anymail_id": "4321"})
+        handle_tracking_event(sender=Mock(), event=self.event, esp_name="test_esp")
+        self.assertEqual(Log.objects.count(), 0)
+
     def test_handle_tracking_event_with_email(self):
-        email = Email.objects.create(
-            extra_headers={
-                "anymail_id": "4321",
-            },
-        )
+        email = Email.objects.create(esp_message_id="4321")
 
         self.assertEqual(email.logs.count(), 0)
 
@@ -185,3 +368,137 @@ class HandleTrackingEventTestCase(TestCase):
         self.assertEqual(log.esp, "test_esp")
         self.assertEqual(log.type, "custom_event")
         self.assertEqual(log.raw, "Custom ESP event data")
+
+
+def make_event(message_id, event_type="delivered"):
+    """Return a tracking event for the email sent with ``message_id``."""
+    return AnymailTrackingEvent(
+        event_type=event_type,
+        message_id=message_id,
+        event_id=f"{message_id}-{event_type}",
+        timestamp=now(),
+        esp_event={"id": message_id},
+    )
+
+
+class HandleTrackingEventsTestCase(TestCase):
+    def test_logs_batch_with_two_queries(self):
+        emails = [Email.objects.create(esp_message_id=f"id-{n}") for n in range(50)]
+        events = [make_event(f"id-{n}") for n in range(50)]
+        events += [make_event("id-0", "opened"), make_event("unknown")]
+
+        with self.assertNumQueries(2):
+            logs = handle_tracking_events(events, esp_name="test_esp")
+
+        self.assertEqual(len(logs), 51)
+        self.assertEqual(Log.objects.count(), 51)
+        self.assertEqual(
+            list(emails[0].logs.order_by("type").values_list("type", flat=True)),
+            ["delivered", "opened"],
+        )
+        self.assertEqual(emails[49].logs.get().raw, {"id": "id-49"})
+        self.assertEqual(Log.objects.filter(esp="test_esp").count(), 51)
+
+    def test_newest_email_wins_for_shared_message_id(self):
+        Email.objects.create(esp_message_id="shared")
+        newest = Email.objects.create(esp_message_id="shared")
+        handle_tracking_events([make_event("shared")], esp_name="test_esp")
+        self.assertEqual(Log.objects.get().email, newest)
+
+    def test_no_matching_events(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(handle_tracking_events([], esp_name="test_esp"), [])
+        with self.assertNumQueries(1):
+            logs = handle_tracking_events([make_event("unknown")], esp_name="test_esp")
+        self.assertEqual(logs, [])
+
+    def test_retried_events_are_logged_once(self):
+        email = Email.objects.create(esp_message_id="id")
+        events = [make_event("id"), make_event("id", "opened")]
+        handle_tracking_events(events, esp_name="test_esp")
+        with self.assertNumQueries(2):
+            handle_tracking_events(events + events, esp_name="test_esp")
+        handle_tracking_events(events, esp_name="other_esp")
+        self.assertEqual(email.logs.filter(esp="test_esp").count(), 2)
+        self.assertEqual(email.logs.filter(esp="other_esp").count(), 2)
+
+    def test_events_without_event_id_are_all_logged(self):
+        email = Email.objects.create(esp_message_id="id")
+        event = make_event("id")
+        event.event_id = None
+        handle_tracking_events([event, event], esp_name="test_esp")
+        self.assertEqual(list(email.logs.values_list("event_id", flat=True)), ["", ""])
+
+
+@override_settings(EMAIL_LOG_PENDING_EVENTS_TTL=3600)
+class PendingEventsTestCase(TestCase):
+    @override_settings(EMAIL_LOG_PENDING_EVENTS_TTL=None)
+    def test_disabled(self):
+        handle_tracking_events([make_event("early")], esp_name="test_esp")
+        self.assertFalse(PendingEvent.objects.exists())
+
+    def test_unmatched_events_are_kept(self):
+        Email.objects.create(esp_message_id="known")
+        events = [make_event("known"), make_event("early", "opened")]
+        with self.assertNumQueries(3):
+            handle_tracking_events(events, esp_name="test_esp")
+        self.assertEqual(Log.objects.get().event_id, "known-delivered")
+        pending = PendingEvent.objects.get()
+        self.assertEqual(pending.message_id, "early")
+        self.assertEqual(pending.esp, "test_esp")
+        self.assertEqual(pending.event_type, "opened")
+        self.assertEqual(pending.esp_event, {"id": "early"})
+
+    def test_reconciled_when_email_is_logged(self):
+        handle_tracking_events(
+            [make_event("early"), make_event("other")], esp_name="test_esp"
+        )
+        status = Mock(message_id="early")
+        message = EmailMultiAlternatives("Subject", "Body", "from@example.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            log_successful_email(
+                sender=Mock(), message=message, status=status, esp_name="test_esp"
+            )
+        log = Email.objects.get().logs.get()
+        self.assertEqual(log.type, "delivered")
+        self.assertEqual(log.esp, "test_esp")
+        self.assertEqual(log.event_id, "early-delivered")
+        self.assertEqual(log.raw, {"id": "early"})
+        self.assertEqual(
+            list(PendingEvent.objects.values_list("message_id", flat=True)),
+            ["other"],
+        )
+
+    def test_reconcile_all_pending_events(self):
+        handle_tracking_events(
+            [make_event(f"id-{n}") for n in range(5)], esp_name="test_esp"
+        )
+        for n in range(3):
+            Email.objects.create(esp_message_id=f"id-{n}")
+        self.assertEqual(reconcile_pending_events(batch_size=2), 3)
+        self.assertEqual(Log.objects.count(), 3)
+        self.assertEqual(PendingEvent.objects.count(), 2)
+        # Reconciling again doesn't log the events twice
+        self.assertEqual(reconcile_pending_events(), 0)
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_expired_events_are_deleted(self):
+        handle_tracking_events(
+            [make_event("old"), make_event("new")], esp_name="test_esp"
+        )
+        PendingEvent.objects.filter(message_id="old").update(
+            received=now() - timedelta(hours=2)
+        )
+        Email.objects.create(esp_message_id="old")
+        reconcile_pending_events()
+        self.assertFalse(Log.objects.exists())
+        self.assertEqual(
+            list(PendingEvent.objects.values_list("message_id", flat=True)), ["new"]
+        )
+
+    def test_nothing_expires_once_disabled(self):
+        handle_tracking_events([make_event("old")], esp_name="test_esp")
+        PendingEvent.objects.update(received=now() - timedelta(days=2))
+        with override_settings(EMAIL_LOG_PENDING_EVENTS_TTL=None):
+            self.assertEqual(reconcile_pending_events(), 0)
+        self.assertEqual(PendingEvent.objects.count(), 1)